@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import time
+import tracemalloc
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from functions import split_by_grid, merge_shapefiles
+from zonal_rasterstats import resample_rasters_from_dict, close_pool
+from pipeline import process_patch
+from synthetic_data import make_synthetic_data
+from main import (RESOLUTION, METHOD, ZONAL_MODE, OVERLAY_MODE, INTERSECT_MODE, DISTANCE_FILTER, MAX_DIST,
+                  CELL_SIZE, CLASS_MAPPING)
+
+### BENCHMARK PARAMETERS ###
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_data") # Arbeitsordner
+N_POLYGONS = 2000 # Anzahl synthetischer WZ-Polygone
+SEED = 0 # Zufallsstartwert der synthetischen Daten
+GRID = (2, 2) # Aufteilung in Patches (Zeilen, Spalten) für split_by_grid
+BENCHMARK_CORES = 1 # Prozessorkerne der Zonalstatistik (Speichermessung erfasst nur den Hauptprozess)
+TRACE_MEMORY = True # Spitzenspeicher je Schritt über tracemalloc messen (verlangsamt Python-lastige Schritte)
+WRITE_GOLDEN = False # Referenz neu mit dem ursprünglichen Code erzeugen
+BASELINE_REF = "a7c847d" # Git-Commit des ursprünglichen Codes, mit dem die Referenz erzeugt wird
+
+def benchmark_config(data, resampled_dict, output_folder, cores=1):
+    """Konfiguration für process_patch mit den Parametern aus main.py, ohne Cache."""
+    return {
+        "classification": data["classification"],
+        "resampled_dict": resampled_dict,
+        "cores": cores,
+        "zonal_mode": ZONAL_MODE,
+        "overlay_mode": OVERLAY_MODE,
+        "intersect_mode": INTERSECT_MODE,
+        "distance_filter": DISTANCE_FILTER,
+        "max_dist": MAX_DIST,
+        "cell_size": CELL_SIZE,
+        "class_mapping": CLASS_MAPPING,
+        "output_folder": output_folder,
+        "cache_dir": None,
+        "sweep_folder": None
+    }
+
+def timing_stage(timings, current, trace_memory=True):
+    """Stage-Funktion für process_patch, die Laufzeit und Spitzenspeicher jedes Schritts in timings sammelt."""
+    def stage(name, func, *args, **kwargs):
+        if trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] / 1024 ** 2 if trace_memory else np.nan
+        timings.append({"patch": current["patch"], "stage": name, "seconds": seconds, "peak_mb": peak})
+        return result
+    return stage
+
+def run_benchmark(data, work_dir, grid=(2, 2), cores=1, trace_memory=True):
+    """
+    Führt die komplette Pipeline auf einem (synthetischen) Datensatz aus und misst jeden Schritt.
+
+    Returns:
+        tuple: (Pfad des zusammengeführten Ergebnisses, pd.DataFrame mit einer Zeile je Schrittaufruf)
+    """
+    split_dir = os.path.join(work_dir, "split")
+    temp_dir = os.path.join(work_dir, "temp")
+    results_dir = os.path.join(work_dir, "temp_results")
+    for folder in (split_dir, temp_dir, results_dir):
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder)
+
+    timings = []
+    current = {"patch": None}
+    stage = timing_stage(timings, current, trace_memory)
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        patch_paths = stage("split_by_grid", split_by_grid, data["wz"], split_dir, *grid)
+        resampled_dict = stage("resample_rasters_from_dict", resample_rasters_from_dict, data["tif_dict"], temp_dir,
+                               RESOLUTION, METHOD)
+        config = benchmark_config(data, resampled_dict, results_dir, cores)
+
+        for patch_path in patch_paths:
+            current["patch"] = os.path.splitext(os.path.basename(patch_path))[0]
+            process_patch(patch_path, config, stage)
+        current["patch"] = None
+        close_pool()
+
+        final = stage("merge_shapefiles", merge_shapefiles, results_dir, work_dir)
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+
+    return final, pd.DataFrame(timings)
+
+def record_baseline_golden(data, work_dir, golden_path, grid=(2, 2), cores=1, baseline_ref=BASELINE_REF):
+    """
+    Erzeugt die Referenz mit dem ursprünglichen Code: der Commit baseline_ref wird per git archive entpackt und
+    benchmark_baseline.py dort in einem eigenen Prozess ausgeführt (raster_to_points -> filter_points_by_distance ->
+    points_to_raster_cells -> extract_top_classes -> gpd.overlay -> groupby-Plausibilität). So prüft der Vergleich
+    alle Optimierungen gegen das ursprüngliche Ergebnis.
+
+    Returns:
+        pd.DataFrame: Referenztabelle (siehe result_table)
+    """
+    project_dir = os.path.dirname(os.path.abspath(__file__))
+    baseline_dir = os.path.join(work_dir, "baseline")
+    code_dir = os.path.join(baseline_dir, "code")
+    shutil.rmtree(baseline_dir, ignore_errors=True)
+    os.makedirs(code_dir)
+
+    archive = os.path.join(baseline_dir, "baseline.tar")
+    subprocess.run(["git", "archive", "--format=tar", "-o", archive, baseline_ref], cwd=project_dir, check=True)
+    with tarfile.open(archive) as tar:
+        tar.extractall(code_dir)
+    shutil.copy(os.path.join(project_dir, "benchmark_baseline.py"), code_dir)
+
+    params_path = os.path.join(baseline_dir, "params.json")
+    with open(params_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "wz": os.path.abspath(data["wz"]),
+            "classification": os.path.abspath(data["classification"]),
+            "tif_dict": {name: path and os.path.abspath(path) for name, path in data["tif_dict"].items()},
+            "work_dir": os.path.abspath(os.path.join(baseline_dir, "run")),
+            "grid": list(grid),
+            "cores": cores,
+            "resolution": RESOLUTION,
+            "method": METHOD,
+            "max_dist": MAX_DIST,
+            "cell_size": CELL_SIZE,
+            "class_mapping": CLASS_MAPPING
+        }, f)
+
+    print(f"Referenz wird mit dem ursprünglichen Code ({baseline_ref}) erzeugt")
+    subprocess.run([sys.executable, "benchmark_baseline.py", params_path], cwd=code_dir, check=True)
+    table = result_table(os.path.join(baseline_dir, "run", "final_result_merged.gpkg"))
+    table.to_csv(golden_path, index=False)
+    print(f"Referenz gespeichert unter: {golden_path}")
+    return table
+
+def result_table(final_path):
+    """BAGR und PROB je Polygon, über die gerundeten Zentroid-Koordinaten unabhängig von der Patch-Reihenfolge."""
+    gdf = gpd.read_file(final_path)
+    centroids = gdf.geometry.centroid
+    table = pd.DataFrame({
+        "x": centroids.x.round(2),
+        "y": centroids.y.round(2),
+        "BAGR": gdf["BAGR"],
+        "PROB": pd.to_numeric(gdf["PROB"], errors="coerce")
+    })
+    return table.sort_values(["x", "y"]).reset_index(drop=True)
+
+def compare_golden(table, golden_path):
+    """
+    Vergleicht BAGR und PROB mit der gespeicherten Referenz.
+
+    Returns:
+        dict: Anzahl fehlender/zusätzlicher Polygone und abweichender BAGR- bzw. PROB-Werte
+    """
+    golden = pd.read_csv(golden_path)
+    merged = golden.merge(table, on=["x", "y"], how="outer", suffixes=("_golden", "_neu"), indicator=True)
+    both = merged["_merge"] == "both"
+
+    def differs(col):
+        old, new = merged[f"{col}_golden"], merged[f"{col}_neu"]
+        return both & (old != new) & ~(old.isna() & new.isna())
+
+    return {
+        "polygone": int(both.sum()),
+        "fehlend": int((merged["_merge"] == "left_only").sum()),
+        "zusaetzlich": int((merged["_merge"] == "right_only").sum()),
+        "BAGR_abweichend": int(differs("BAGR").sum()),
+        "PROB_abweichend": int(differs("PROB").sum())
+    }
+
+def summarize(timings):
+    """Summiert die Messungen je Schritt über alle Patches."""
+    return timings.groupby("stage", sort=False).agg(
+        aufrufe=("seconds", "size"),
+        sekunden=("seconds", "sum"),
+        peak_mb=("peak_mb", "max")
+    )
+
+# Benchmark
+if __name__ == "__main__":
+    data_dir = os.path.join(BENCHMARK_DIR, f"synthetic_{N_POLYGONS}_{SEED}")
+    if not os.path.exists(os.path.join(data_dir, "classification_synthetic.tif")):
+        make_synthetic_data(data_dir, N_POLYGONS, CLASS_MAPPING, SEED)
+    data = {
+        "wz": os.path.join(data_dir, "wz_synthetic.shp"),
+        "classification": os.path.join(data_dir, "classification_synthetic.tif"),
+        "tif_dict": {
+            "wuchskl": os.path.join(data_dir, "wuchskl_synthetic.tif"),
+            "ndomDiff": os.path.join(data_dir, "ndomDiff_synthetic.tif"),
+            "ndom": None
+        }
+    }
+
+    work_dir = os.path.join(BENCHMARK_DIR, "run")
+    os.makedirs(work_dir, exist_ok=True)
+    startzeit = time.time()
+    final, timings = run_benchmark(data, work_dir, GRID, BENCHMARK_CORES, TRACE_MEMORY)
+    gesamt = time.time() - startzeit
+
+    summary = summarize(timings)
+    print(summary.to_string(float_format=lambda v: f"{v:.2f}"))
+    print(f"Gesamt: {gesamt:.1f} s, {N_POLYGONS / gesamt:.0f} Polygone/s")
+    timings.to_csv(os.path.join(work_dir, "benchmark_timings.csv"), index=False)
+
+    # Ergebnis gegen die Referenz des ursprünglichen Codes prüfen
+    golden_path = os.path.join(data_dir, "golden.csv")
+    if WRITE_GOLDEN or not os.path.exists(golden_path):
+        record_baseline_golden(data, work_dir, golden_path, GRID, BENCHMARK_CORES)
+    comparison = compare_golden(result_table(final), golden_path)
+    print("Vergleich mit Referenz:", comparison)
+    if any(comparison[key] for key in ("fehlend", "zusaetzlich", "BAGR_abweichend", "PROB_abweichend")):
+        print("ACHTUNG: Ergebnis weicht von der Referenz ab")
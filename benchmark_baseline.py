@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# Ursprüngliche Verarbeitungskette (Stand des Baseline-Commits) als Referenz für benchmark.py.
+#
+# Das Skript wird nicht im Projektordner ausgeführt: benchmark.record_baseline_golden entpackt den Baseline-Commit in
+# einen eigenen Ordner, kopiert dieses Skript dorthin und startet es dort in einem eigenen Prozess, sodass alle
+# Importe die ursprünglichen Module laden. Der Ablauf entspricht der Patch-Schleife der ursprünglichen main.py.
+
+import json
+import os
+import sys
+import time
+from datetime import datetime
+import geopandas as gpd
+import pandas as pd
+from functions import *
+from zonal_rasterstats import *
+from classification_to_vector import *
+from union import *
+from plausibility import *
+from postprocessing import *
+
+def run_baseline(params):
+    """
+    Führt die ursprüngliche Pipeline aus: Zonalstatistik, raster_to_points -> filter_points_by_distance ->
+    points_to_raster_cells -> extract_top_classes, gpd.overlay, groupby-Plausibilität und Postprocessing.
+
+    Returns:
+        str: Pfad des zusammengeführten Ergebnisses
+    """
+    work_dir = params["work_dir"]
+    temp_folder = os.path.join(work_dir, "temp")
+    temp_folder_results = os.path.join(work_dir, "temp_results")
+    temp_folder_split = os.path.join(work_dir, "split")
+    for folder in (temp_folder, temp_folder_results, temp_folder_split):
+        os.makedirs(folder, exist_ok=True)
+
+    rows, cols = params["grid"]
+    split_by_grid(params["wz"], temp_folder_split, rows, cols)
+    resampled_dict = resample_rasters_from_dict(params["tif_dict"], temp_folder, params["resolution"], params["method"])
+    class_mapping = {int(key): value for key, value in params["class_mapping"].items()}
+
+    for chunk_file in sorted(os.listdir(temp_folder_split)):
+        if chunk_file.endswith(".shp"):
+            chunk_path = os.path.join(temp_folder_split, chunk_file)
+
+            clipped_dict = clip_dict_to_patch(resampled_dict, chunk_path, temp_folder)
+            wz_wuchskl_ndomDiff = calculate_zonal_stats(chunk_path, clipped_dict, params["cores"])
+
+            classification = clip_raster_to_patch(params["classification"], chunk_path, temp_folder)
+            classification_to_points = raster_to_points(classification, temp_folder)
+            points_filtered = filter_points_by_distance(classification_to_points, chunk_path, params["max_dist"])
+            polygon_grids = points_to_raster_cells(points_filtered, params["cell_size"])
+            top3_classes_probs_spec = extract_top_classes(polygon_grids, class_mapping)
+
+            union_wz_classification = intersect_polygons(wz_wuchskl_ndomDiff, top3_classes_probs_spec)
+            post_union = filter_polygons(union_wz_classification)
+
+            ID = "OBJECTID"
+            gdf = compute_majority_spec(post_union, ID, "area_m2", "FLAECHE", "prob1", "spec1")
+            gdf = compute_mode_filtered_stats(gdf, ID, "area_m2", "prob1", "spec1")
+            gdf_filtered = filter_gdf_by_area(gdf, "FLAECHE")
+            final_aggregated = aggregate_final_values(gdf_filtered, ID, "FLAECHE")
+            final_aggregated = apply_plausibility(final_aggregated)
+            final_result = merge_plaus_spec_to_wzba(wz_wuchskl_ndomDiff, final_aggregated, ID)
+
+            post_processed_1 = change_attributes(final_result)
+            post_processed_2 = add_bhoeh(post_processed_1)
+            post_processed_3 = change_attribute_for_bl(post_processed_2)
+            # Ergebnisse werden mit sekundengenauem Zeitstempel benannt: nicht zwei Patches in derselben Sekunde
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            while datetime.now().strftime("%Y%m%d_%H%M%S") == timestamp:
+                time.sleep(0.1)
+            update_attributes(post_processed_3, temp_folder_results)
+
+    # Die ursprüngliche merge_shapefiles bricht ab, sobald Blößen vorkommen (astype(int) auf geleerten Werten, Text
+    # und Zeitstempel gemischt in DATUM). Für die Referenz genügen Geometrie, BAGR und PROB je Polygon.
+    results = [os.path.join(temp_folder_results, f) for f in sorted(os.listdir(temp_folder_results)) if f.endswith(".gpkg")]
+    merged = pd.concat([gpd.read_file(f)[["BAGR", "PROB", "geometry"]] for f in results], ignore_index=True)
+    output_file = os.path.join(work_dir, "final_result_merged.gpkg")
+    gpd.GeoDataFrame(merged, crs=gpd.read_file(results[0]).crs).to_file(output_file, driver="GPKG")
+    return output_file
+
+if __name__ == "__main__":
+    with open(sys.argv[1], encoding="utf-8") as f:
+        params = json.load(f)
+    print(run_baseline(params))
@@ -0,0 +1,180 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import time
+from contextlib import closing
+from xml.etree import ElementTree
+import shapely
+from manifest import SIDECAR_EXTENSIONS, fingerprint
+
+# Geschätzter Platzbedarf einer Zonalstatistik-Zeile in der Cache-Datenbank (Bytes)
+ZONAL_ROW_BYTES = 64
+# Blockgröße beim Hashen von Rasterdateien
+HASH_BLOCK_SIZE = 16 * 1024 ** 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (path TEXT, size INTEGER, mtime INTEGER, sha256 TEXT, PRIMARY KEY (path, size, mtime));
+CREATE TABLE IF NOT EXISTS files (key TEXT PRIMARY KEY, path TEXT, size INTEGER, last_used REAL);
+CREATE TABLE IF NOT EXISTS zonal_groups (raster_key TEXT PRIMARY KEY, rows INTEGER, last_used REAL);
+CREATE TABLE IF NOT EXISTS zonal (raster_key TEXT, geom_hash BLOB, value REAL, PRIMARY KEY (raster_key, geom_hash)) WITHOUT ROWID;
+"""
+
+def connect(cache_dir):
+    """Öffnet die Index-Datenbank des Caches (cache.sqlite), mehrere Prozesse dürfen gleichzeitig zugreifen."""
+    os.makedirs(cache_dir, exist_ok=True)
+    con = sqlite3.connect(os.path.join(cache_dir, "cache.sqlite"), timeout=300)
+    con.executescript(SCHEMA)
+    return con
+
+def raster_hash(tif_path, cache_dir):
+    """
+    SHA-256 über den Inhalt eines Rasters inkl. Begleitdateien. Das Ergebnis wird je (Pfad, Größe, Änderungszeit)
+    im Cache gespeichert, sodass jede Datei nur einmal gelesen wird.
+    """
+    path = os.path.abspath(tif_path)
+    stat = os.stat(path)
+    with closing(connect(cache_dir)) as con:
+        row = con.execute("SELECT sha256 FROM hashes WHERE path = ? AND size = ? AND mtime = ?",
+                          (path, stat.st_size, stat.st_mtime_ns)).fetchone()
+    if row is not None:
+        return row[0]
+
+    print(f"Berechne Inhalts-Hash von {tif_path}")
+    base, ext = os.path.splitext(path)
+    digest = hashlib.sha256()
+    for file_path in [path] + [base + sidecar for sidecar in SIDECAR_EXTENSIONS.get(ext.lower(), [])]:
+        if not os.path.exists(file_path):
+            continue
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+    sha256 = digest.hexdigest()
+
+    with closing(connect(cache_dir)) as con, con:
+        con.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)",
+                    (path, stat.st_size, stat.st_mtime_ns, sha256))
+    return sha256
+
+def vrt_key(vrt_path, cache_dir):
+    """
+    Schlüssel einer VRT aus den Schlüsseln ihrer Quellraster und dem VRT-XML (Gitter und Resampling-Parameter).
+    Das XML enthält nur die Pfade der Quellen, ein an gleicher Stelle ersetztes Quellraster ändert so trotzdem
+    den Schlüssel.
+    """
+    sources = []
+    for element in ElementTree.parse(vrt_path).iter("SourceFilename"):
+        source = element.text.strip()
+        if element.get("relativeToVRT") == "1":
+            source = os.path.join(os.path.dirname(vrt_path), source)
+        sources.append(os.path.abspath(source))
+
+    with open(vrt_path, "rb") as f:
+        xml_hash = hashlib.sha256(f.read()).hexdigest()
+    return fingerprint("vrt", xml_hash, [raster_key(source, cache_dir) for source in dict.fromkeys(sources)])
+
+def raster_key(tif_path, cache_dir):
+    """
+    Schlüssel eines Rasters: der Cache-Schlüssel, falls es aus dem Cache stammt, bei einer VRT der Schlüssel aus
+    ihren Quellen (vrt_key), sonst sein Inhalts-Hash.
+    """
+    with closing(connect(cache_dir)) as con:
+        row = con.execute("SELECT key FROM files WHERE path = ?", (os.path.abspath(tif_path),)).fetchone()
+    if row is not None:
+        return row[0]
+    if os.path.splitext(tif_path)[1].lower() == ".vrt":
+        return vrt_key(tif_path, cache_dir)
+    return raster_hash(tif_path, cache_dir)
+
+def cached_file(cache_dir, key):
+    """Liefert den Pfad eines Cache-Eintrags (und markiert ihn als benutzt) oder None."""
+    with closing(connect(cache_dir)) as con, con:
+        row = con.execute("SELECT path FROM files WHERE key = ?", (key,)).fetchone()
+        if row is None or not os.path.exists(row[0]):
+            return None
+        con.execute("UPDATE files SET last_used = ? WHERE key = ?", (time.time(), key))
+    return row[0]
+
+def store_file(cache_dir, key, path):
+    """Vermerkt eine im Cache-Ordner erzeugte Datei unter key."""
+    path = os.path.abspath(path)
+    with closing(connect(cache_dir)) as con, con:
+        con.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                    (key, path, os.path.getsize(path), time.time()))
+
+def file_folder(cache_dir, key):
+    """Eigener Ordner für die Dateien eines Cache-Eintrags."""
+    folder = os.path.join(cache_dir, "files", key)
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+def geometry_hashes(geoms):
+    """16-Byte-Hash (BLAKE2b über WKB) je Geometrie."""
+    return [hashlib.blake2b(wkb, digest_size=16).digest() for wkb in shapely.to_wkb(geoms)]
+
+def zonal_key(tif_path, stat, cache_dir, engine):
+    """
+    Schlüssel der Zonalstatistik stat auf einem Raster. engine ("rasterstats" oder "labels") geht mit ein, da
+    beide Verfahren Randpixel unterschiedlich zuordnen.
+    """
+    return fingerprint("zonal", raster_key(tif_path, cache_dir), stat, engine)
+
+def lookup_zonal(cache_dir, key, hashes):
+    """
+    Sucht die Zonalstatistik der Geometrien im Cache.
+
+    Returns:
+        dict: {Geometrie-Hash: Wert} für alle gefundenen Geometrien (Wert None = keine gültigen Pixel)
+    """
+    with closing(connect(cache_dir)) as con, con:
+        con.execute("CREATE TEMP TABLE wanted (geom_hash BLOB PRIMARY KEY) WITHOUT ROWID")
+        con.executemany("INSERT OR IGNORE INTO wanted VALUES (?)", ((h,) for h in hashes))
+        found = dict(con.execute(
+            "SELECT z.geom_hash, z.value FROM zonal z JOIN wanted w ON z.geom_hash = w.geom_hash "
+            "WHERE z.raster_key = ?", (key,)
+        ))
+        if found:
+            con.execute("UPDATE zonal_groups SET last_used = ? WHERE raster_key = ?", (time.time(), key))
+    return found
+
+def store_zonal(cache_dir, key, hashes, values):
+    """Speichert die Zonalstatistik (ein Wert je Geometrie-Hash) im Cache."""
+    with closing(connect(cache_dir)) as con, con:
+        con.executemany("INSERT OR REPLACE INTO zonal VALUES (?, ?, ?)",
+                        ((key, h, v) for h, v in zip(hashes, values)))
+        rows = con.execute("SELECT COUNT(*) FROM zonal WHERE raster_key = ?", (key,)).fetchone()[0]
+        con.execute("INSERT OR REPLACE INTO zonal_groups VALUES (?, ?, ?)", (key, rows, time.time()))
+
+def evict_cache(cache_dir, max_size_gb):
+    """
+    Hält den Cache unter max_size_gb: die am längsten nicht benutzten Einträge (Dateien bzw. die Zonalstatistik
+    eines Rasters als Ganzes) werden gelöscht, bis die Gesamtgröße unter der Grenze liegt.
+    """
+    if not os.path.exists(cache_dir):
+        return
+    max_bytes = max_size_gb * 1024 ** 3
+
+    with closing(connect(cache_dir)) as con:
+        entries = [("file", key, path, size, last_used)
+                   for key, path, size, last_used in con.execute("SELECT key, path, size, last_used FROM files")]
+        entries += [("zonal", key, None, rows * ZONAL_ROW_BYTES, last_used)
+                    for key, rows, last_used in con.execute("SELECT raster_key, rows, last_used FROM zonal_groups")]
+
+        total = sum(entry[3] for entry in entries)
+        evicted = 0
+        with con:
+            for kind, key, path, size, _ in sorted(entries, key=lambda entry: entry[4]):
+                if total <= max_bytes:
+                    break
+                if kind == "file":
+                    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+                    con.execute("DELETE FROM files WHERE key = ?", (key,))
+                else:
+                    con.execute("DELETE FROM zonal WHERE raster_key = ?", (key,))
+                    con.execute("DELETE FROM zonal_groups WHERE raster_key = ?", (key,))
+                total -= size
+                evicted += 1
+
+        if evicted:
+            con.execute("VACUUM")
+            print(f"Cache: {evicted} Einträge entfernt, {total / 1024 ** 3:.1f} GB belegt")
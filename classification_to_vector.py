@@ -1,13 +1,17 @@
 import rasterio
+from rasterio.features import geometry_mask
 import geopandas as gpd
 from shapely.geometry import Point, box
-from shapely.strtree import STRtree
 import numpy as np
+import math
 import os
 import pandas as pd
-from shapely.strtree import STRtree
 import shapely
 import pyogrio
+from functions import iter_windows, open_patch_raster, as_patch, species_dtype
+
+# Segmente je Viertelkreis beim Puffern (shapely-Standard)
+QUAD_SEGS = 8
 
 def raster_to_points(tif_path, output_path, layer_name="classification_to_points", batch_size=10000000):
     print("Starte speicherschonende Umwandlung des Rasters in Punkte...")
@@ -19,7 +23,7 @@ def raster_to_points(tif_path, output_path, layer_name="classification_to_points
     if os.path.exists(gpkg_path):
         os.remove(gpkg_path)
 
-    with rasterio.open(tif_path) as src:
+    with open_patch_raster(tif_path) as src:
         bands = src.read()  # shape: (11, rows, cols)
         transform = src.transform
         rows, cols = bands.shape[1:]
@@ -39,7 +43,7 @@ def raster_to_points(tif_path, output_path, layer_name="classification_to_points
 
                 x, y = rasterio.transform.xy(transform, row, col)
                 all_points.append(Point(x, y))
-                all_data.append(vals.tolist())
+                all_data.append(vals.astype(np.float32))
 
                 # Sicherheit: zu viele Punkte -> zwischendurch speichern
                 if len(all_points) >= batch_size:
@@ -60,7 +64,7 @@ def raster_to_points(tif_path, output_path, layer_name="classification_to_points
 
 def save_batch(points, data, gpkg_path, crs, layer_name, first_batch):
     gdf = gpd.GeoDataFrame(
-        data,
+        np.asarray(data, dtype=np.float32),
         columns=[f"cl{i+1}" for i in range(len(data[0]))],
         geometry=points,
         crs=crs
@@ -71,17 +75,195 @@ def save_batch(points, data, gpkg_path, crs, layer_name, first_batch):
     else:
         gdf.to_file(gpkg_path, layer=layer_name, driver="GPKG", mode='a')
 
-def filter_points_by_distance(classification_to_points, polygons_path, max_dist, output_path=None):
+def top_k_classes(probs, top_n=3, axis=-1):
+    """
+    Vektorisierter Top-n-Kernel über eine Wahrscheinlichkeitsmatrix, z. B. (n_cells, n_classes) oder einen
+    Rasterblock (n_classes, rows, cols) mit axis=0.
+
+    Über argpartition werden zuerst die n größten Werte gesucht, danach nur diese n Werte sortiert.
+
+    Returns:
+        tuple: (Klassen-IDs (1-basiert, Integer), Wahrscheinlichkeiten), die Top-n liegen jeweils auf der Achse axis.
+    """
+    probs = np.moveaxis(np.asarray(probs), axis, -1)
+    num_classes = probs.shape[-1]
+    top_n = min(top_n, num_classes)
+
+    # NaN nie als Top-Klasse auswählen
+    values = np.where(np.isnan(probs), -np.inf, probs)
+    if top_n < num_classes:
+        idx = np.argpartition(-values, top_n - 1, axis=-1)[..., :top_n]
+    else:
+        idx = np.broadcast_to(np.arange(num_classes), values.shape)
+    order = np.argsort(-np.take_along_axis(values, idx, axis=-1), axis=-1, kind="stable")
+    idx = np.take_along_axis(idx, order, axis=-1)
+
+    classes = (idx + 1).astype(np.min_scalar_type(num_classes))
+    top_probs = np.take_along_axis(probs, idx, axis=-1)
+    return np.moveaxis(classes, -1, axis), np.moveaxis(top_probs, -1, axis)
+
+def top_class_columns(classes, probs, class_mapping, num_classes, dtype=None):
+    """
+    Erzeugt die typisierten Spalten class1..n, prob1..n (float32) und spec1..n aus der Ausgabe von top_k_classes
+    (Top-n auf der ersten Achse). Die Kürzel werden als Categorical mit dem gemeinsamen Baumarten-Dictionary
+    (species_dtype) codiert.
+    """
+    if dtype is None:
+        dtype = species_dtype(class_mapping, num_classes)
+    top_n = classes.shape[0]
+
+    columns = {}
+    for i in range(top_n):
+        columns[f"class{i + 1}"] = classes[i]
+    for i in range(top_n):
+        columns[f"prob{i + 1}"] = probs[i].astype(np.float32)
+    for i in range(top_n):
+        columns[f"spec{i + 1}"] = pd.Categorical.from_codes(classes[i].astype(np.int64) - 1, dtype=dtype)
+    return columns
+
+def distance_keep_mask(patch, tif_path, max_dist):
+    """
+    Rasterbasierter Distanzfilter: Maske aller Pixel, deren Zentrum höchstens max_dist von einem Polygon entfernt ist.
+
+    Die Polygone werden um max_dist dilatiert (Buffer) und auf dem Gitter des Klassifikationsrasters rasterisiert
+    (Pixel gesetzt, wenn sein Zentrum im dilatierten Polygon liegt). Der Buffer nähert die Rundungen mit Sehnen an und
+    liegt daher ganz innerhalb des exakten Abstandsbereichs: diese Pixel werden ohne weitere Prüfung übernommen. Ein
+    zweiter Buffer umschließt den exakten Bereich (Radius max_dist / cos(Sehnenwinkel / 2) plus eine halbe
+    Pixeldiagonale); nur für die Pixel zwischen beiden wird der Abstand des Zentrums exakt geprüft. Das Ergebnis
+    entspricht damit dem Kriterium von filter_points_by_distance (Abstand <= max_dist), ohne jeden Punkt abzufragen.
+
+    Parameters:
+        patch: PatchContext (oder Pfad) des Patches.
+        tif_path: Pfad oder MemoryFile des (geclippten) Klassifikationsrasters.
+        max_dist (float): Maximale Distanz zu den Polygonen.
+
+    Returns:
+        np.ndarray: Boolesche Maske (rows, cols), True = Pixel wird berücksichtigt.
+    """
+    print("Distanzmaske wird berechnet")
+    polygons = as_patch(patch).gdf
+
+    with open_patch_raster(tif_path) as src:
+        out_shape = (src.height, src.width)
+        transform = src.transform
+        crs = src.crs
+
+    if crs is not None and polygons.crs != crs:
+        polygons = polygons.to_crs(crs)
+
+    geoms = np.asarray(polygons.geometry.values)
+    geoms = geoms[~(shapely.is_empty(geoms) | shapely.is_missing(geoms))]
+    if len(geoms) == 0:
+        return np.zeros(out_shape, dtype=bool)
+
+    def dilated_mask(distance):
+        dilated = shapely.buffer(geoms, distance, quad_segs=QUAD_SEGS)
+        return geometry_mask(dilated, out_shape=out_shape, transform=transform, invert=True)
+
+    inner = dilated_mask(max_dist)
+    half_diagonal = math.hypot(transform.a, transform.b, transform.d, transform.e) / 2
+    outer = dilated_mask(max_dist / math.cos(math.pi / (4 * QUAD_SEGS)) + half_diagonal)
+
+    # Randpixel: Abstand des Zentrums exakt prüfen
+    rows, cols = np.nonzero(outer & ~inner)
+    x, y = transform * (cols + 0.5, rows + 0.5)
+    point_idx, _ = shapely.STRtree(geoms).query(shapely.points(x, y), predicate="dwithin", distance=max_dist)
+    point_idx = np.unique(point_idx)
+    inner[rows[point_idx], cols[point_idx]] = True
+    return inner
+
+def raster_to_cells(tif_path, cell_size=None, block_size=1024, keep_mask=None, class_mapping=None, top_n=3,
+                    species=None):
+    """
+    Wandelt das Klassifikationsraster blockweise in Rasterzellen (Polygone) um und hält das Ergebnis im Speicher.
+
+    Gültige Pixel (ohne NaN in einem der Bänder) werden je Block über eine NumPy-Maske bestimmt, die
+    Pixelzentren über die Affine-Transformation berechnet und die Zellen gesammelt mit shapely.box erzeugt.
+    Ersetzt die Kette raster_to_points -> points_to_raster_cells ohne Zwischenspeicherung als GPKG.
+
+    Parameters:
+        tif_path: Pfad oder MemoryFile des (geclippten) Klassifikationsrasters.
+        cell_size (float): Kantenlänge der Zellen. Standard: Pixelgröße des Rasters.
+        block_size (int): Kantenlänge der Lesefenster in Pixeln.
+        keep_mask (np.ndarray): Optionale Maske aus distance_keep_mask. Nur Pixel innerhalb der Maske werden zu
+                                Zellen, Blöcke ohne ein Pixel in der Maske werden gar nicht gelesen.
+        class_mapping (dict): Wenn angegeben, werden die Top-n Klassen bereits je Block berechnet
+                              (wie extract_top_classes) und die Spalten cl1..cln verworfen.
+        top_n (int): Anzahl der Top-Klassen bei gesetztem class_mapping.
+        species (pd.CategoricalDtype): Gemeinsames Baumarten-Dictionary (species_dtype) für spec1..n.
+
+    Returns:
+        gpd.GeoDataFrame: Rasterzellen mit den Spalten cl1..cln (Klassenwahrscheinlichkeiten)
+                          bzw. class1..n, prob1..n, spec1..n.
+    """
+    print("Umwandlung des Rasters in Rasterzellen wird durchgeführt")
+
+    with open_patch_raster(tif_path) as src:
+        transform = src.transform
+        crs = src.crs
+        if cell_size is None:
+            cell_size = abs(transform.a)
+        half = cell_size / 2
+
+        all_cells = []
+        all_data = []
+        for window in iter_windows(src.width, src.height, block_size):
+            if keep_mask is not None:
+                block_mask = keep_mask[window.toslices()]
+                if not block_mask.any():
+                    continue
+
+            block = src.read(window=window)  # shape: (bands, rows, cols)
+            valid = ~np.isnan(block).any(axis=0)
+            if keep_mask is not None:
+                valid &= block_mask
+            rows, cols = np.nonzero(valid)
+            if rows.size == 0:
+                continue
+
+            # Pixelzentren des gesamten Blocks auf einmal berechnen
+            xs, ys = transform * (cols + window.col_off + 0.5, rows + window.row_off + 0.5)
+            all_cells.append(shapely.box(xs - half, ys - half, xs + half, ys + half))
+
+            values = block[:, rows, cols]  # shape: (bands, n)
+            if class_mapping is None:
+                all_data.append(values)
+            else:
+                all_data.append(top_k_classes(values, top_n, axis=0))
+
+        num_bands = src.count
+        dtype = src.dtypes[0]
+
+    cells = np.concatenate(all_cells) if all_cells else np.empty(0, dtype=object)
+
+    if class_mapping is None:
+        data = np.concatenate(all_data, axis=1) if all_data else np.empty((num_bands, 0), dtype=dtype)
+        columns = {f"cl{i+1}": data[i] for i in range(num_bands)}
+    else:
+        if all_data:
+            classes = np.concatenate([c for c, _ in all_data], axis=1)
+            probs = np.concatenate([p for _, p in all_data], axis=1)
+        else:
+            classes, probs = top_k_classes(np.empty((num_bands, 0), dtype=dtype), top_n, axis=0)
+        columns = top_class_columns(classes, probs, class_mapping, num_bands, species)
+
+    print(f"{len(cells):,} Rasterzellen erzeugt")
+    return gpd.GeoDataFrame(columns, geometry=cells, crs=crs)
+
+def filter_points_by_distance(classification_to_points, patch, max_dist, output_path=None):
     print("Punkte werden gefiltert")
-    #points = classification_to_points
-    points = gpd.read_file(classification_to_points)
-    polygons = gpd.read_file(polygons_path)
+    # GPKG-Pfad aus raster_to_points oder GeoDataFrame aus raster_to_cells
+    if isinstance(classification_to_points, str):
+        points = gpd.read_file(classification_to_points)
+    else:
+        points = classification_to_points
+    patch = as_patch(patch)
 
-    if points.crs != polygons.crs:
-        points = points.to_crs(polygons.crs)
+    if points.crs != patch.crs:
+        points = points.to_crs(patch.crs)
 
-    # STRtree erstellen für schnellere Abfragen
-    tree = STRtree(polygons.geometry)
+    # STRtree des Patches für schnellere Abfragen
+    tree = patch.tree
 
     # Funktion: Punkt innerhalb max_dist eines Polygons?
     def is_close_enough(point):
@@ -89,14 +271,15 @@ def filter_points_by_distance(classification_to_points, polygons_path, max_dist,
         nearest = tree.query(point.buffer(max_dist))
 
         # Holen Sie sich die Geometrien der benachbarten Polygone
-        nearest_geometries = [polygons.geometry.iloc[i] for i in nearest]
+        nearest_geometries = patch.geoms[nearest]
 
         # Prüfen Sie die Abstände zu den Geometrien
         return any(geom.distance(point) <= max_dist for geom in nearest_geometries)
 
     # Anwendung auf alle Punkte
     print("Prüfe Punkte")
-    mask = [is_close_enough(geom) for geom in points.geometry]
+    # Bei Rasterzellen zählt der Abstand des Zellzentrums
+    mask = [is_close_enough(geom) for geom in points.geometry.centroid]
     gdf = points[mask]
 
     # Ergebnis speichern
@@ -145,22 +328,12 @@ def extract_top_classes(polygon_grids, class_mapping, output_path=None, top_n=3)
     num_classes = len(class_mapping)
     prob_columns = [f"cl{i}" for i in range(1, num_classes + 1)]
 
-    def top_classes(row):
-        idx = np.argsort(-row.values)[:top_n]
-        probs = row.values[idx]
-        classes = idx + 1
-        specs = [class_mapping.get(i, f"cl{i}") for i in classes]
-        return pd.Series(
-            np.concatenate([classes, probs, specs]),
-            index=(
-                    [f"class{i + 1}" for i in range(top_n)] +
-                    [f"prob{i + 1}" for i in range(top_n)] +
-                    [f"spec{i + 1}" for i in range(top_n)]
-            )
-        )
-
-    gdf = gdf.join(gdf[prob_columns].apply(top_classes, axis=1))
-    gdf.drop(columns=prob_columns, inplace=True)
+    classes, probs = top_k_classes(gdf[prob_columns].to_numpy(), top_n)
+    columns = top_class_columns(classes.T, probs.T, class_mapping, num_classes)
+
+    gdf = gdf.drop(columns=prob_columns)
+    for name, values in columns.items():
+        gdf[name] = values
 
     if output_path:
         shapefile_name = "top3_classes_probs_spec.gpkg"
@@ -0,0 +1,141 @@
+import numpy as np
+import shapely
+import os
+from classification_to_vector import top_k_classes, top_class_columns
+from functions import open_patch_raster
+
+def pixel_pairs(row0, row1, col0, col1):
+    """
+    Erzeugt für jedes Polygon alle Pixel (Zeile, Spalte) innerhalb seines Pixel-Fensters [row0, row1) x [col0, col1).
+
+    Returns:
+        tuple: (Polygon-Index, Zeilen, Spalten) als flache Arrays
+    """
+    n_rows = np.maximum(row1 - row0, 0)
+    n_cols = np.maximum(col1 - col0, 0)
+    counts = n_rows * n_cols
+
+    poly_idx = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    rows = row0[poly_idx] + offsets // n_cols[poly_idx]
+    cols = col0[poly_idx] + offsets % n_cols[poly_idx]
+    return poly_idx, rows, cols
+
+def polygon_pixel_windows(geoms, transform, shape):
+    """Berechnet aus den Polygon-Bounds die Pixel-Fenster (row0, row1, col0, col1) auf dem Rastergitter."""
+    height, width = shape
+    bounds = shapely.bounds(geoms)
+    empty = np.isnan(bounds).any(axis=1)
+    bounds = np.nan_to_num(bounds)
+
+    col0 = np.clip(np.floor((bounds[:, 0] - transform.c) / transform.a), 0, width).astype(np.int64)
+    col1 = np.clip(np.ceil((bounds[:, 2] - transform.c) / transform.a), 0, width).astype(np.int64)
+    row0 = np.clip(np.floor((bounds[:, 3] - transform.f) / transform.e), 0, height).astype(np.int64)
+    row1 = np.clip(np.ceil((bounds[:, 1] - transform.f) / transform.e), 0, height).astype(np.int64)
+
+    # Leere Geometrien bekommen keine Pixel
+    col1[empty] = col0[empty]
+    return row0, row1, col0, col1
+
+def coverage_fractions(geoms, transform, valid, batch_size=2000):
+    """
+    Berechnet den exakten Flächenanteil jedes Polygons an jedem gültigen Rasterpixel.
+
+    Pixel, die vollständig im Polygon liegen, erhalten die volle Pixelfläche, nur Randpixel werden geometrisch
+    geschnitten. Die Polygone werden in Batches verarbeitet, um den Speicherbedarf zu begrenzen.
+
+    Parameters:
+        geoms (np.ndarray): shapely-Polygone im KBS des Rasters
+        transform (Affine): Transformation des Rasters (nordausgerichtet)
+        valid (np.ndarray): Boolesche Maske (rows, cols) der gültigen Pixel
+
+    Returns:
+        tuple: (Polygon-Index, Zeilen, Spalten, Fläche in m²) als flache Arrays
+    """
+    if not transform.is_rectilinear:
+        raise ValueError("Coverage-Overlay unterstützt nur nordausgerichtete Raster")
+
+    pixel_area = abs(transform.a * transform.e)
+    shapely.prepare(geoms)
+    row0, row1, col0, col1 = polygon_pixel_windows(geoms, transform, valid.shape)
+
+    result = {"poly": [], "rows": [], "cols": [], "area": []}
+    for start in range(0, len(geoms), batch_size):
+        stop = min(start + batch_size, len(geoms))
+        poly_idx, rows, cols = pixel_pairs(row0[start:stop], row1[start:stop], col0[start:stop], col1[start:stop])
+        poly_idx += start
+
+        # Nur Pixel mit gültigen Klassifikationswerten
+        keep = valid[rows, cols]
+        poly_idx, rows, cols = poly_idx[keep], rows[keep], cols[keep]
+
+        left = transform.c + cols * transform.a
+        top = transform.f + rows * transform.e
+        cells = shapely.box(left, top + transform.e, left + transform.a, top)
+        polys = geoms[poly_idx]
+
+        area = np.full(len(cells), pixel_area)
+        partial = ~shapely.covers(polys, cells)
+        area[partial] = shapely.area(shapely.intersection(polys[partial], cells[partial]))
+
+        keep = area > 0
+        result["poly"].append(poly_idx[keep])
+        result["rows"].append(rows[keep])
+        result["cols"].append(cols[keep])
+        result["area"].append(area[keep])
+
+    if not result["poly"]:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty, np.empty(0)
+    return tuple(np.concatenate(result[key]) for key in ("poly", "rows", "cols", "area"))
+
+def coverage_overlay(wz_wuchskl_ndomDiff, classification_path, class_mapping, top_n=3, output_path=None, species=None):
+    """
+    Rasterbasierte Alternative zur Kette raster_to_cells -> filter_points_by_distance -> extract_top_classes ->
+    intersect_polygons. Die WZ-Polygone werden mit exakten Flächenanteilen auf das Klassifikationsraster gelegt,
+    ohne Zellpolygone und ohne gpd.overlay.
+
+    Parameters:
+        wz_wuchskl_ndomDiff: GeoDataFrame aus calculate_zonal_stats
+        classification_path: Pfad oder MemoryFile des (geclippten) Klassifikationsrasters
+        class_mapping (dict): Mapping von class index (1-based) zu Kürzeln, z. B. {1: 'FI', 2: 'KI', ...}.
+        top_n (int): Anzahl der Top-Klassen, die extrahiert werden sollen.
+        output_path (str): Wenn angegeben, wird die Tabelle als CSV gespeichert.
+        species (pd.CategoricalDtype): Gemeinsames Baumarten-Dictionary (species_dtype) für spec1..n.
+
+    Returns:
+        pd.DataFrame: Ein Eintrag je Polygon und Pixel mit den WZ-Attributen, area_m2 sowie
+                      class1..n, prob1..n und spec1..n (wie intersect_polygons).
+    """
+    print("Coverage-Overlay wird durchgeführt")
+    with open_patch_raster(classification_path) as src:
+        bands = src.read()  # shape: (classes, rows, cols)
+        transform = src.transform
+        crs = src.crs
+
+    gdf = wz_wuchskl_ndomDiff
+    if crs is not None and gdf.crs != crs:
+        gdf = gdf.to_crs(crs)
+
+    geoms = np.asarray(gdf.geometry.values)
+    valid = ~np.isnan(bands).any(axis=0)
+    poly_idx, rows, cols, area = coverage_fractions(geoms, transform, valid)
+
+    # Top-n Klassen je Pixel
+    classes, probs = top_k_classes(bands[:, rows, cols], top_n, axis=0)
+    columns = top_class_columns(classes, probs, class_mapping, bands.shape[0], species)
+
+    attributes = gdf.drop(columns=[gdf.geometry.name, "area_m2"], errors="ignore")
+    df = attributes.iloc[poly_idx].reset_index(drop=True)
+    for name, values in columns.items():
+        df[name] = values
+    df["area_m2"] = area
+
+    print(f"{len(df):,} Polygon-Pixel-Anteile berechnet")
+
+    if output_path:
+        table_name = "coverage_wz_classification.csv"
+        table_path = os.path.join(output_path, table_name)
+        df.to_csv(table_path, index=False)
+
+    return df
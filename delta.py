@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import geopandas as gpd
+import numpy as np
+import pyogrio
+import rasterio
+import shapely
+from rasterio.windows import Window, bounds as window_bounds
+from functions import iter_windows, bounded_map, ThreadDatasets
+from manifest import fingerprint, file_fingerprint
+
+# Anzahl Polygone je Lese-/Schreibvorgang beim Übernehmen des vorherigen Ergebnisses
+KEEP_BATCH_SIZE = 100000
+
+def block_checksums(raster_path, block_size=1024, workers=4):
+    """
+    Prüfsummen (BLAKE2b über alle Bänder) je Block eines Rasters. Die Blöcke werden auf einem Thread-Pool gelesen,
+    jeder Thread mit eigenem Dataset (ThreadDatasets).
+
+    Returns:
+        dict: Blockgitter (width, height, transform, block_size) und {"Zeile_Spalte": Prüfsumme}
+    """
+    with rasterio.open(raster_path) as src:
+        width, height, transform = src.width, src.height, src.transform
+
+    datasets = ThreadDatasets(raster_path)
+
+    def checksum(window):
+        block = datasets.get().read(window=window)
+        return f"{int(window.row_off)}_{int(window.col_off)}", hashlib.blake2b(block.tobytes(), digest_size=16).hexdigest()
+
+    with datasets, ThreadPoolExecutor(workers) as executor:
+        blocks = dict(bounded_map(executor, checksum, iter_windows(width, height, block_size), 2 * workers))
+
+    print(f"Prüfsummen für {len(blocks):,} Blöcke berechnet")
+    return {
+        "width": width,
+        "height": height,
+        "transform": list(transform)[:6],
+        "block_size": block_size,
+        "blocks": blocks
+    }
+
+def load_checksums(path):
+    """Lädt die Prüfsummen eines früheren Laufs oder liefert None."""
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def save_checksums(checksums, run_fingerprint, path):
+    """Speichert die Prüfsummen zusammen mit dem Fingerabdruck der übrigen Eingaben (atomar)."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(dict(checksums, fingerprint=run_fingerprint), f)
+    os.replace(tmp_path, path)
+
+def changed_regions(previous, current, max_dist):
+    """
+    Vergleicht die Prüfsummen zweier Klassifikationen und liefert die geänderten Blöcke als Rechtecke, um max_dist
+    (Distanzfilter der Rasterzellen) gepuffert.
+
+    Returns:
+        np.ndarray: Geometrien der geänderten Bereiche (leer = keine Änderung) oder None, wenn sich das Blockgitter
+                    unterscheidet und alles neu berechnet werden muss
+    """
+    grid = ("width", "height", "transform", "block_size")
+    if previous is None or any(previous[key] != current[key] for key in grid):
+        return None
+
+    transform = rasterio.Affine(*current["transform"])
+    block_size = current["block_size"]
+    boxes = []
+    for key, checksum in current["blocks"].items():
+        if previous["blocks"].get(key) == checksum:
+            continue
+        row_off, col_off = (int(value) for value in key.split("_"))
+        window = Window(col_off, row_off, min(block_size, current["width"] - col_off),
+                        min(block_size, current["height"] - row_off))
+        boxes.append(shapely.box(*window_bounds(window, transform)))
+
+    print(f"{len(boxes):,} von {len(current['blocks']):,} Blöcken der Klassifikation geändert")
+    return shapely.buffer(np.array(boxes, dtype=object), max_dist, join_style="mitre")
+
+def select_delta_polygons(wz_path, regions, output_path):
+    """
+    Schreibt die WZ-Polygone, die einen geänderten Bereich schneiden, als wz_delta.gpkg. Die Datei wird nur neu
+    geschrieben, wenn sich die Auswahl geändert hat (wz_delta.json), damit ihr Fingerabdruck im Manifest gleich
+    bleibt und ein abgebrochener Delta-Lauf fortgesetzt werden kann.
+
+    Mit ZONAL_MODE "labels" werden Randpixel nur unter den Polygonen eines Patches aufgeteilt. Nachbarn, die nicht
+    neu berechnet werden, fehlen dabei, sodass die Zonalstatistik der Delta-Polygone an gemeinsamen Rändern von
+    einem vollständigen Lauf abweichen kann (mit "rasterstats" sind die Ergebnisse identisch).
+
+    Returns:
+        tuple: (Pfad, Anzahl Polygone)
+    """
+    wz = gpd.read_file(wz_path)
+    tree = shapely.STRtree(regions)
+    _, poly_idx = tree.query(np.asarray(wz.geometry.values), predicate="intersects")
+    selected = np.unique(poly_idx)
+    delta = wz.iloc[selected]
+
+    path = os.path.join(output_path, "wz_delta.gpkg")
+    selection_path = os.path.join(output_path, "wz_delta.json")
+    selection = fingerprint(file_fingerprint(wz_path), selected.tolist())
+    unchanged = False
+    if os.path.exists(selection_path) and os.path.exists(path):
+        with open(selection_path, encoding="utf-8") as f:
+            unchanged = json.load(f)["selection"] == selection
+    if len(delta) and not unchanged:
+        if os.path.exists(path):
+            os.remove(path)
+        delta.to_file(path, driver="GPKG")
+        with open(selection_path, "w", encoding="utf-8") as f:
+            json.dump({"selection": selection}, f)
+    print(f"{len(delta):,} von {len(wz):,} Polygonen werden neu berechnet")
+    return path, len(delta)
+
+def keep_unchanged_results(previous_merged, delta_wz_path, output_path):
+    """
+    Übernimmt alle Polygone des vorherigen Gesamtergebnisses, die nicht neu berechnet werden, als
+    final_result_previous.gpkg in den Ordner der Patch-Ergebnisse, sodass merge_shapefiles sie mit den neuen
+    Ergebnissen zusammenführt. Ein Polygon gilt als neu berechnet, wenn ein Punkt in seinem Inneren in einem
+    Polygon von wz_delta liegt (die WZ-Polygone überlappen sich nicht). Das Ergebnis wird blockweise gelesen.
+    Integer-Felder mit Nullwerten liest pyogrio als float64; sie werden als Int64 zurückgeschrieben, damit ihr Typ
+    (z. B. PROB) beim Zusammenführen mit den neuen Patches erhalten bleibt.
+
+    Returns:
+        str: Pfad der übernommenen Polygone
+    """
+    delta_geoms = np.asarray(gpd.read_file(delta_wz_path).geometry.values)
+    tree = shapely.STRtree(delta_geoms)
+
+    path = os.path.join(output_path, "final_result_previous.gpkg")
+    if os.path.exists(path):
+        os.remove(path)
+
+    info = pyogrio.read_info(previous_merged)
+    n_features = info["features"]
+    int_fields = [name for name, dtype in zip(info["fields"], info["dtypes"]) if dtype.startswith("int")]
+    kept = 0
+    for skip in range(0, n_features, KEEP_BATCH_SIZE):
+        batch = pyogrio.read_dataframe(previous_merged, skip_features=skip, max_features=KEEP_BATCH_SIZE)
+        for name in int_fields:
+            batch[name] = batch[name].astype("Int64")
+        points = shapely.point_on_surface(np.asarray(batch.geometry.values))
+        point_idx, _ = tree.query(points, predicate="within")
+        keep = np.ones(len(batch), dtype=bool)
+        keep[point_idx] = False
+        pyogrio.write_dataframe(batch[keep], path, driver="GPKG", layer="final_result_previous", append=skip > 0)
+        kept += int(keep.sum())
+
+    print(f"{kept:,} von {n_features:,} Polygonen aus dem vorherigen Ergebnis übernommen")
+    return path
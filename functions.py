@@ -1,12 +1,125 @@
 import geopandas as gpd
 from shapely.geometry import box
+import fiona
+import json
+import math
 import rasterio
-from rasterio.mask import mask
+import shapely
+from rasterio.io import MemoryFile
+from rasterio.windows import Window, from_bounds
+import numpy as np
 import os
 import pandas as pd
+import threading
+from collections import deque
+import pyarrow.parquet as pq
 
-def split_by_grid(shapefile_path, output_dir, rows=3, cols=5):
-    os.makedirs(output_dir, exist_ok=True)
+# Baumarten-Kürzel, die neben den Klassen der Klassifikation vorkommen (WZ und Postprocessing)
+EXTRA_SPECIES = ["uLW", "uNW", "LBH", "NDH", "BL", "oA"]
+# WZ-Spalten mit Baumarten-Kürzeln
+SPECIES_COLUMNS = ["BAGR", "BAGR1", "BAGR2", "HOLZART", "BA"]
+
+def species_dtype(class_mapping, num_classes=None, gdf=None):
+    """
+    Gemeinsames Categorical-Dictionary für alle Baumarten-Spalten (spec1..n, BAGR, BAGR1, BAGR2, HOLZART, BA).
+
+    Die Klassen der Klassifikation stehen vorne (Code = Klassen-ID - 1), danach EXTRA_SPECIES und alle weiteren
+    Kürzel, die in den WZ-Spalten von gdf vorkommen. Vergleiche und Gruppierungen laufen damit über Integer-Codes.
+    """
+    if num_classes is None:
+        num_classes = len(class_mapping)
+    categories = [class_mapping.get(i, f"cl{i}") for i in range(1, num_classes + 1)]
+
+    extra = list(EXTRA_SPECIES)
+    if gdf is not None:
+        for col in SPECIES_COLUMNS:
+            if col in gdf.columns:
+                extra.extend(gdf[col].dropna().astype(str).unique())
+    categories += [c for c in dict.fromkeys(extra) if c not in categories]
+    return pd.CategoricalDtype(categories)
+
+def compact_species(gdf, dtype):
+    """Wandelt die Baumarten-Spalten der WZ in das gemeinsame Categorical um (an Ort und Stelle)."""
+    for col in SPECIES_COLUMNS:
+        if col in gdf.columns:
+            gdf[col] = gdf[col].where(gdf[col].isna(), gdf[col].astype(str)).astype(dtype)
+    return gdf
+
+def iter_windows(width, height, block_size=1024):
+    """Liefert quadratische Fenster (max. block_size x block_size Pixel), die das Raster vollständig abdecken."""
+    for row_off in range(0, height, block_size):
+        for col_off in range(0, width, block_size):
+            yield Window(col_off, row_off, min(block_size, width - col_off), min(block_size, height - row_off))
+
+class PatchContext:
+    """
+    Ein Patch im Speicher. Er wird einmal geladen und an alle Verarbeitungsschritte übergeben, statt dass jeder
+    Schritt die Patch-Datei erneut liest.
+
+    Attributes:
+        name (str): Name des Patches (z. B. patch_3)
+        gdf (gpd.GeoDataFrame): Polygone des Patches (fortlaufender Index)
+        bounds (tuple): Ausdehnung (minx, miny, maxx, maxy)
+        geoms (np.ndarray): vorbereitete (prepared) shapely-Geometrien, gleiche Reihenfolge wie gdf
+        tree (shapely.STRtree): räumlicher Index über geoms, wird beim ersten Zugriff erzeugt
+    """
+
+    def __init__(self, gdf, name="patch"):
+        self.name = name
+        self.gdf = gdf.reset_index(drop=True)
+        self.bounds = tuple(self.gdf.total_bounds)
+        self.geoms = np.asarray(self.gdf.geometry.values)
+        shapely.prepare(self.geoms)
+        self._tree = None
+
+    @property
+    def crs(self):
+        return self.gdf.crs
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = shapely.STRtree(self.geoms)
+        return self._tree
+
+def write_patch(patch, output_dir, patch_counter):
+    """Speichert einen Patch als GeoParquet (patch_N.parquet) und gibt den Pfad zurück."""
+    patch_path = os.path.join(output_dir, f"patch_{patch_counter}.parquet")
+    patch.to_parquet(patch_path)
+    return patch_path
+
+def load_patch(patch_path):
+    """Lädt eine Patch-Datei (GeoParquet oder ein von GDAL lesbares Format) als PatchContext."""
+    name = os.path.splitext(os.path.basename(patch_path))[0]
+    if patch_path.endswith(".parquet"):
+        gdf = gpd.read_parquet(patch_path)
+    else:
+        gdf = gpd.read_file(patch_path)
+    return PatchContext(gdf, name)
+
+def as_patch(patch):
+    """Die Verarbeitungsschritte akzeptieren einen PatchContext oder, wie bisher, einen Pfad."""
+    return patch if isinstance(patch, PatchContext) else load_patch(patch)
+
+def patch_extent(patch_path):
+    """Ausdehnung und Anzahl Polygone einer Patch-Datei, ohne die Geometrien zu lesen."""
+    if patch_path.endswith(".parquet"):
+        metadata = pq.read_metadata(patch_path)
+        geo = json.loads(metadata.metadata[b"geo"])
+        return tuple(geo["columns"][geo["primary_column"]]["bbox"]), metadata.num_rows
+
+    with fiona.open(patch_path) as patch:
+        return patch.bounds, len(patch)
+
+def split_by_grid(shapefile_path, output_dir=None, rows=3, cols=5):
+    """
+    Teilt die Polygone nach ihren Zentroiden in ein festes Gitter aus rows x cols Patches.
+
+    Returns:
+        list: PatchContext je Patch (ohne output_dir) bzw. Pfade der geschriebenen GeoParquet-Patches
+    """
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
 
     # Lade Original-Shapefile
     gdf = gpd.read_file(shapefile_path)
@@ -14,11 +127,13 @@ def split_by_grid(shapefile_path, output_dir, rows=3, cols=5):
 
     # Gesamtausdehnung
     minx, miny, maxx, maxy = gdf.total_bounds
+    centroids = gdf.centroid
 
     # Höhe und Breite jeder Zelle
     cell_width = (maxx - minx) / cols
     cell_height = (maxy - miny) / rows
 
+    patches = []
     patch_counter = 1
     for row in range(rows):
         for col in range(cols):
@@ -30,41 +145,208 @@ def split_by_grid(shapefile_path, output_dir, rows=3, cols=5):
             cell_box = box(cell_minx, cell_miny, cell_maxx, cell_maxy)
 
             # Schneide Gitterzelle mit den Polygonen
-            patch = gdf[gdf.centroid.within(cell_box)]
+            patch = gdf[centroids.within(cell_box)]
 
             if not patch.empty:
-                # Speichern
-                patch_path = os.path.join(output_dir, f"patch_{patch_counter}.shp")
-                patch.to_file(patch_path)
+                # Im Speicher behalten oder speichern
+                if output_dir is None:
+                    patches.append(PatchContext(patch, f"patch_{patch_counter}"))
+                else:
+                    patches.append(write_patch(patch, output_dir, patch_counter))
 
                 print(f"Patch {patch_counter}: {len(patch)} Polygone")
                 patch_counter += 1
 
     print("Aufteilung abgeschlossen.")
+    return patches
 
-def clip_raster_to_patch(raster_path, shapefile_path, output_folder):
-    print("Clip Raster zum Patch")
-    # Dateinamen erzeugen
-    raster_name = os.path.splitext(os.path.basename(raster_path))[0]
-    patch_name = os.path.splitext(os.path.basename(shapefile_path))[0]
-    output_path = os.path.join(output_folder, f"{patch_name}_{raster_name}_clipped.tif")
+def split_balanced(shapefile_path, output_dir=None, max_polygons=20000, max_pixels=None, raster_path=None):
+    """
+    Teilt die Polygone adaptiv in ausgewogene, räumlich kompakte Patches.
+
+    Die Polygone werden rekursiv entlang der längeren Ausdehnung am Median ihrer Zentroide halbiert, bis jeder
+    Patch höchstens max_polygons Polygone enthält und die Ausdehnung seiner Polygone höchstens max_pixels Pixel
+    des Rasters umfasst. Mit raster_path liegen die Schnittlinien auf dem Blockgitter dieses Rasters, sodass
+    Fensterzugriffe keine Blöcke anteilig dekodieren.
+
+    Parameters:
+        shapefile_path (str): Pfad zur WZ-Shapefile
+        output_dir (str): Zielordner der Patches (patch_N.parquet). Ohne Ordner bleiben die Patches im Speicher.
+        max_polygons (int): Maximale Anzahl Polygone je Patch
+        max_pixels (int): Maximale Anzahl Rasterpixel je Patch (nur mit raster_path)
+        raster_path (str): Klassifikationsraster für Blockgitter und Pixelgröße
+
+    Returns:
+        list: PatchContext je Patch (ohne output_dir) bzw. Pfade der geschriebenen Patches
+    """
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
 
-    # Patch laden
+    # Lade Original-Shapefile
     gdf = gpd.read_file(shapefile_path)
-    geoms = gdf.geometry.values
+    gdf = gdf.reset_index(drop=True)
+
+    # Zentroide und Bounds nur einmal berechnen
+    centroids = gdf.centroid
+    xs = centroids.x.to_numpy()
+    ys = centroids.y.to_numpy()
+    bounds = gdf.bounds.to_numpy()
+
+    # Blockgitter und Pixelgröße des Rasters
+    grid = None
+    pixel_area = None
+    if raster_path is not None:
+        with rasterio.open(raster_path) as src:
+            block_height, block_width = src.block_shapes[0]
+            transform = src.transform
+        grid = {
+            "x": (transform.c, abs(transform.a) * block_width),
+            "y": (transform.f, abs(transform.e) * block_height)
+        }
+        pixel_area = abs(transform.a * transform.e)
+
+    def too_large(idx):
+        if len(idx) > max_polygons:
+            return True
+        if max_pixels is None or pixel_area is None:
+            return False
+        minx, miny = bounds[idx, 0].min(), bounds[idx, 1].min()
+        maxx, maxy = bounds[idx, 2].max(), bounds[idx, 3].max()
+        return (maxx - minx) * (maxy - miny) / pixel_area > max_pixels
+
+    def split(idx):
+        x, y = xs[idx], ys[idx]
+        axis = "x" if np.ptp(x) >= np.ptp(y) else "y"
+        values = x if axis == "x" else y
+        median = np.median(values)
+
+        # Schnittlinie auf das Blockgitter legen, falls dadurch keine Hälfte leer wird
+        cuts = [median]
+        if grid is not None:
+            origin, step = grid[axis]
+            cuts.insert(0, origin + round((median - origin) / step) * step)
+        for cut in cuts:
+            lower = values < cut
+            if lower.any() and not lower.all():
+                return idx[lower], idx[~lower]
+        return None
+
+    patches = []
+    stack = [np.arange(len(gdf))]
+    while stack:
+        idx = stack.pop()
+        halves = split(idx) if too_large(idx) else None
+        if halves is None:
+            patches.append(idx)
+        else:
+            stack.extend(reversed(halves))
+
+    results = []
+    for patch_counter, idx in enumerate(patches, start=1):
+        patch = gdf.iloc[idx]
+        if output_dir is None:
+            results.append(PatchContext(patch, f"patch_{patch_counter}"))
+        else:
+            results.append(write_patch(patch, output_dir, patch_counter))
+
+        print(f"Patch {patch_counter}: {len(patch)} Polygone")
+
+    print("Aufteilung abgeschlossen.")
+    return results
+
+def bounded_map(executor, func, items, max_pending):
+    """
+    Wie executor.map, hält aber höchstens max_pending Aufgaben gleichzeitig in Arbeit bzw. im Speicher.
+    Die Ergebnisse werden in der Reihenfolge von items geliefert.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+class ThreadDatasets:
+    """
+    Ein geöffnetes Dataset je Thread eines Thread-Pools (rasterio-Datasets dürfen nicht zwischen Threads geteilt
+    werden). Beim Verlassen des with-Blocks werden alle geöffneten Datasets geschlossen, der Block muss daher den
+    Thread-Pool umschließen.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._opened = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        src = getattr(self._local, "src", None)
+        if src is None:
+            src = self._local.src = rasterio.open(self.path)
+            with self._lock:
+                self._opened.append(src)
+        return src
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for src in self._opened:
+            src.close()
+        self._opened.clear()
+
+def open_patch_raster(raster):
+    """Öffnet ein Raster aus einem Pfad oder einem MemoryFile aus clip_raster_to_patch."""
+    if isinstance(raster, MemoryFile):
+        return raster.open()
+    return rasterio.open(raster)
+
+def clip_raster_to_patch(raster_path, patch, output_folder=None):
+    """
+    Liest das Rasterfenster über der Ausdehnung des Patches, nach außen auf das Blockgitter des Rasters erweitert.
+
+    Ohne output_folder bleibt der Ausschnitt als MemoryFile im Speicher (öffnen mit open_patch_raster, nach
+    Gebrauch mit close() freigeben), sonst wird er wie bisher als GeoTIFF gespeichert und der Pfad zurückgegeben.
+    """
+    print("Clip Raster zum Patch")
+
+    # Nur die Ausdehnung des Patches wird benötigt
+    patch = as_patch(patch)
+    minx, miny, maxx, maxy = patch.bounds
 
-    # Raster clippen
     with rasterio.open(raster_path) as src:
-        out_image, out_transform = mask(src, geoms, crop=True)
-        out_meta = src.meta.copy()
+        window = from_bounds(minx, miny, maxx, maxy, transform=src.transform)
+
+        # Fenster auf ganze Blöcke erweitern, damit keine Blöcke anteilig dekodiert werden
+        block_height, block_width = src.block_shapes[0]
+        col_off = math.floor(window.col_off / block_width) * block_width
+        row_off = math.floor(window.row_off / block_height) * block_height
+        window = Window(col_off, row_off,
+                        math.ceil((window.col_off + window.width) / block_width) * block_width - col_off,
+                        math.ceil((window.row_off + window.height) / block_height) * block_height - row_off)
+        window = window.intersection(Window(0, 0, src.width, src.height))
+
+        out_image = src.read(window=window)
+        out_meta = src.profile.copy()
+
+        # Metadaten aktualisieren
+        out_meta.update({
+            "driver": "GTiff",
+            "height": out_image.shape[1],
+            "width": out_image.shape[2],
+            "transform": src.window_transform(window)
+        })
 
-    # Metadaten aktualisieren
-    out_meta.update({
-        "driver": "GTiff",
-        "height": out_image.shape[1],
-        "width": out_image.shape[2],
-        "transform": out_transform
-    })
+    if output_folder is None:
+        memfile = MemoryFile()
+        with memfile.open(**out_meta) as dest:
+            dest.write(out_image)
+        return memfile
+
+    # Dateinamen erzeugen
+    raster_name = os.path.splitext(os.path.basename(raster_path))[0]
+    output_path = os.path.join(output_folder, f"{patch.name}_{raster_name}_clipped.tif")
 
     # Ordner anlegen und speichern
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
@@ -73,27 +355,87 @@ def clip_raster_to_patch(raster_path, shapefile_path, output_folder):
 
     return output_path
 
-def clip_dict_to_patch(tif_dict, shapefile_path, output_folder):
-    result_dict = {}
-    for layer_name, raster_path in tif_dict.items():
-        clipped_path = clip_raster_to_patch(raster_path, shapefile_path, output_folder)
-        result_dict[layer_name] = clipped_path
-    return result_dict
+# Numerische fiona-Feldtypen vom engsten zum breitesten
+NUMERIC_FIELD_RANK = {"bool": 0, "int16": 1, "int32": 2, "int": 3, "int64": 3, "float": 4}
+
+def widen_field_type(a, b):
+    """
+    Gemeinsamer fiona-Feldtyp zweier Patches wie bei pd.concat: Zahlen werden zum breiteren Typ (int32 -> int,
+    int -> float), date und datetime zu datetime. Nur unvereinbare Typen werden Text.
+    """
+    base_a, base_b = a.split(":")[0], b.split(":")[0]
+    if base_a == base_b:
+        return a if a == b else base_a
+    if base_a in NUMERIC_FIELD_RANK and base_b in NUMERIC_FIELD_RANK:
+        return max(base_a, base_b, key=NUMERIC_FIELD_RANK.get)
+    if {base_a, base_b} == {"date", "datetime"}:
+        return "datetime"
+    return "str"
+
+def merged_schema(files, int_columns=()):
+    """
+    Gemeinsames fiona-Schema aller Patch-Ergebnisse, ohne die Daten zu lesen. Felder, deren Typ sich zwischen den
+    Patches unterscheidet, erhalten den gemeinsamen Typ aus widen_field_type, int_columns werden als Integer geschrieben.
+    """
+    properties = {}
+    geometry_types = set()
+    crs = None
+    for f in files:
+        with fiona.open(f) as src:
+            crs = crs or src.crs
+            geometry_types.add(src.schema["geometry"])
+            for name, field_type in src.schema["properties"].items():
+                if name not in properties:
+                    properties[name] = field_type
+                else:
+                    properties[name] = widen_field_type(properties[name], field_type)
+
+    for name in int_columns:
+        if name in properties:
+            properties[name] = "int"
+
+    geometry = geometry_types.pop() if len(geometry_types) == 1 else "Unknown"
+    return {"geometry": geometry, "properties": properties}, crs
 
 def merge_shapefiles(folder_path, output_path):
-    shapefiles = [os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.endswith(".gpkg")]
+    """
+    Führt alle Patch-Ergebnisse zu einer GeoPackage-Datei zusammen.
+
+    Die Patches werden einzeln gelesen, typisiert und in einer einzigen Schreibsitzung angehängt, sodass der
+    Speicherbedarf nur vom größten Patch abhängt. Der räumliche Index wird von GDAL einmal beim Schließen aufgebaut.
+    Geschrieben wird in eine temporäre Datei, die erst am Ende das vorherige Ergebnis ersetzt.
 
-    merged_gdf = gpd.GeoDataFrame(pd.concat([gpd.read_file(f) for f in shapefiles], ignore_index=True), crs=gpd.read_file(shapefiles[0]).crs)
+    Returns:
+        str: Pfad der zusammengeführten Datei
+    """
+    shapefiles = sorted(os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.endswith(".gpkg"))
 
-    # Datentyp ändern
-    merged_gdf["ALTER_HOEH"] = merged_gdf["ALTER_HOEH"].astype(int)
-    merged_gdf["ALTER_WDB"] = merged_gdf["ALTER_WDB"].astype(int)
-    merged_gdf["SICHER"] = merged_gdf["SICHER"].astype(int)
-    merged_gdf["ERRORCODE"] = merged_gdf["ERRORCODE"].astype(int)
+    int_columns = ["ALTER_HOEH", "ALTER_WDB", "SICHER", "ERRORCODE"]
+    schema, crs = merged_schema(shapefiles, int_columns)
+    str_columns = [name for name, field_type in schema["properties"].items() if field_type.split(":")[0] == "str"]
 
-    output_filename = "final_result_merged.shp"
+    output_filename = "final_result_merged.gpkg"
     output_file = os.path.join(output_path, output_filename)
-    merged_gdf.to_file(output_file)
+    tmp_file = os.path.join(output_path, "final_result_merged_tmp.gpkg")
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+
+    merged = 0
+    with fiona.open(tmp_file, "w", driver="GPKG", layer="final_result_merged", schema=schema, crs=crs) as dst:
+        for f in shapefiles:
+            gdf = gpd.read_file(f)
+
+            # Datentyp ändern (je Patch), bei Blößen geleerte Werte bleiben leer
+            for col in int_columns:
+                if col in gdf.columns:
+                    gdf[col] = gdf[col].astype("Int64")
+            for col in str_columns:
+                if col in gdf.columns:
+                    gdf[col] = gdf[col].astype(object).where(gdf[col].isna(), gdf[col].astype(str))
+
+            dst.writerecords(gdf.iterfeatures(na="null", drop_id=True))
+            merged += len(gdf)
+    os.replace(tmp_file, output_file)
 
-    print(f"Merge abgeschlossen. Datei gespeichert unter: {output_file}")
-    return merged_gdf
\ No newline at end of file
+    print(f"Merge abgeschlossen ({merged:,} Polygone). Datei gespeichert unter: {output_file}")
+    return output_file
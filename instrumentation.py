@@ -0,0 +1,191 @@
+import cProfile
+import glob
+import json
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+import psutil
+import socket
+from rasterio.io import DatasetReader, MemoryFile
+from functions import PatchContext
+
+# Abtastintervall des Spitzenspeichers (RSS) in Sekunden
+RSS_INTERVAL = 0.05
+# Schritte, deren Ausgabe die Polygone bzw. die Klassifikationspixel eines Patches zählt
+PATCH_POLYGON_STAGE = "load_patch"
+PATCH_PIXEL_STAGE = "clip_raster_to_patch"
+
+class RssSampler:
+    """Misst den Spitzenspeicher (RSS) des Prozesses in einem Hintergrund-Thread, solange der Block läuft."""
+
+    def __init__(self, interval=RSS_INTERVAL):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while True:
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            if self._stop.wait(self.interval):
+                break
+
+    def __enter__(self):
+        self.peak = self.process.memory_info().rss
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+def count_items(obj):
+    """Zeilen (Polygone bzw. Tabellenzeilen) und Pixel eines Ein- oder Ausgabewerts eines Verarbeitungsschritts."""
+    if isinstance(obj, PatchContext):
+        return len(obj.gdf), 0
+    if isinstance(obj, pd.DataFrame):
+        return len(obj), 0
+    if isinstance(obj, np.ndarray):
+        return 0, obj.size
+    if isinstance(obj, DatasetReader):
+        return 0, obj.width * obj.height
+    if isinstance(obj, MemoryFile):
+        with obj.open() as src:
+            return 0, src.width * src.height
+    if isinstance(obj, (list, tuple)):
+        counts = [count_items(item) for item in obj]
+        return sum(rows for rows, _ in counts), sum(pixels for _, pixels in counts)
+    return 0, 0
+
+class StageRecorder:
+    """
+    Stage-Funktion für process_patch, run_patches und main.py (siehe pipeline.run_stage), die je Schrittaufruf
+    Laufzeit, CPU-Zeit (des eigenen Prozesses, ohne den Prozesspool der Zonalstatistik), Spitzenspeicher (RSS)
+    sowie Zeilen und Pixel der Ein- und Ausgabe erfasst.
+
+    Jeder Prozess hängt seine Messungen an eine eigene JSON-Lines-Datei (je Rechner und Prozess) in report_dir an,
+    sodass auch die Messungen der Patch-Prozesse und Worker beim Hauptprozess ankommen (write_run_report). Für Schritte in profile_stages
+    wird zusätzlich ein cProfile-Dump in profile_dir geschrieben.
+
+    Der Patch eines Aufrufs wird aus dem Schritt load_patch übernommen, mit dem process_patch beginnt.
+    """
+
+    def __init__(self, report_dir, profile_stages=(), profile_dir=None):
+        self.report_dir = report_dir
+        self.profile_stages = set(profile_stages)
+        self.profile_dir = profile_dir or report_dir
+        self.patch = None
+
+    def __call__(self, name, func, *args, **kwargs):
+        if name == "load_patch":
+            self.patch = os.path.splitext(os.path.basename(args[0]))[0]
+
+        rows_in, pixels_in = count_items(list(args) + list(kwargs.values()))
+        profiler = cProfile.Profile() if name in self.profile_stages else None
+
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        with RssSampler() as rss:
+            if profiler is not None:
+                result = profiler.runcall(func, *args, **kwargs)
+            else:
+                result = func(*args, **kwargs)
+        wall = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        rows_out, pixels_out = count_items(result)
+
+        record = {
+            "patch": self.patch,
+            "stage": name,
+            "pid": os.getpid(),
+            "start": time.time() - wall,
+            "wall_s": wall,
+            "cpu_s": cpu,
+            "peak_rss_mb": rss.peak / 1024 ** 2,
+            "rows_in": rows_in,
+            "rows_out": rows_out,
+            "pixels_in": pixels_in,
+            "pixels_out": pixels_out
+        }
+        os.makedirs(self.report_dir, exist_ok=True)
+        with open(os.path.join(self.report_dir, f"stages_{socket.gethostname()}_{os.getpid()}.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+
+        if profiler is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(self.profile_dir, f"{self.patch or 'run'}_{name}_{os.getpid()}.prof"))
+
+        if name == "postprocess":
+            self.patch = None
+        return result
+
+def load_records(report_dir):
+    """Liest die Messungen aller Prozesse eines Laufs."""
+    records = []
+    for path in sorted(glob.glob(os.path.join(report_dir, "stages_*.jsonl"))):
+        with open(path, encoding="utf-8") as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return pd.DataFrame(records)
+
+def write_run_report(report_dir, output_path):
+    """
+    Fasst die Messungen eines Laufs zusammen und speichert sie als run_report.csv (ein Eintrag je Schrittaufruf)
+    und run_report.json (Summen je Schritt und je Patch inkl. Durchsatz in Polygonen bzw. Pixeln pro Sekunde; je
+    Patch zählen die Polygone aus load_patch und die Pixel aus clip_raster_to_patch).
+
+    Returns:
+        pd.DataFrame: Zusammenfassung je Schritt
+    """
+    records = load_records(report_dir)
+    if records.empty:
+        return records
+
+    records = records.sort_values("start")
+    records.to_csv(os.path.join(output_path, "run_report.csv"), index=False)
+
+    by_stage = records.groupby("stage", sort=False).agg(
+        calls=("wall_s", "size"),
+        wall_s=("wall_s", "sum"),
+        cpu_s=("cpu_s", "sum"),
+        peak_rss_mb=("peak_rss_mb", "max"),
+        rows_in=("rows_in", "sum"),
+        rows_out=("rows_out", "sum"),
+        pixels_in=("pixels_in", "sum"),
+        pixels_out=("pixels_out", "sum")
+    )
+    wall = by_stage["wall_s"].where(by_stage["wall_s"] > 0)
+    by_stage["polygons_per_s"] = by_stage["rows_in"] / wall
+    by_stage["pixels_per_s"] = by_stage[["pixels_in", "pixels_out"]].max(axis=1) / wall
+
+    patch_records = records.dropna(subset=["patch"])
+    by_patch = patch_records.groupby("patch").agg(
+        wall_s=("wall_s", "sum"),
+        cpu_s=("cpu_s", "sum"),
+        peak_rss_mb=("peak_rss_mb", "max")
+    )
+    # Polygone und Pixel je Patch aus den Schritten, die den Patch laden bzw. das Raster zuschneiden
+    patch_counts = (("polygons", PATCH_POLYGON_STAGE, "rows_out"), ("pixels", PATCH_PIXEL_STAGE, "pixels_out"))
+    for column, stage, count in patch_counts:
+        counts = patch_records[patch_records["stage"] == stage].groupby("patch")[count].sum()
+        by_patch[column] = counts.reindex(by_patch.index, fill_value=0)
+    patch_wall = by_patch["wall_s"].where(by_patch["wall_s"] > 0)
+    by_patch["polygons_per_s"] = by_patch["polygons"] / patch_wall
+    by_patch["pixels_per_s"] = by_patch["pixels"] / patch_wall
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "wall_s": float(records["start"].add(records["wall_s"]).max() - records["start"].min()),
+        "stages": json.loads(by_stage.reset_index().to_json(orient="records")),
+        "patches": json.loads(by_patch.reset_index().to_json(orient="records"))
+    }
+    with open(os.path.join(output_path, "run_report.json"), "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    print(by_stage[["calls", "wall_s", "cpu_s", "peak_rss_mb", "polygons_per_s"]].to_string(float_format=lambda v: f"{v:.1f}"))
+    print(f"Laufbericht gespeichert unter: {output_path}")
+    return by_stage
@@ -6,9 +6,18 @@ from union import *
 from plausibility import *
 from postprocessing import *
 from raster_output import *
+from coverage_overlay import *
+from pipeline import *
+from manifest import *
+from cache import evict_cache
+from delta import (block_checksums, load_checksums, save_checksums, changed_regions, select_delta_polygons,
+                   keep_unchanged_results)
+from instrumentation import StageRecorder, write_run_report
+from task_queue import publish_tasks, run_worker, run_local_workers, wait_for_tasks
 import time
 from functions import *
 import shutil
+import sys
 
 ### INPUT PARAMETERS ###
 # Pfad zur WZ-Shapefile
@@ -33,10 +42,52 @@ UEBERHAELTER_F = r"C:\Users\frede\Documents\Projekte\Baumartenklassifikation\pla
 ### Advanced Parameters ###
 RESOLUTION = 1.0 # Auflösung zum Resampling der Input-Raster
 METHOD = "nearest" # Resampling Methode (Optionen: nearest, bilinear, cubic)
+RESAMPLE_MODE = "stream" # Resampling (Optionen: stream = fensterweise in GeoTIFF, virtual = VRT, resampled nur gelesene Fenster)
+RESAMPLE_MEMORY_MB = 1024 # Speicherobergrenze für das Resampling in MB
 CORES = 13 # Anzahl Prozessorkerne
+MAX_PARALLEL_PATCHES = 1 # Anzahl gleichzeitig verarbeiteter Patches (eigene Prozesse, die Kerne werden aufgeteilt)
+PATCH_MEMORY_GB = None # Speicherbudget für alle gleichzeitig laufenden Patches in GB (None = keine Begrenzung)
+MAX_POLYGONS_PER_PATCH = 20000 # Maximale Anzahl Polygone je Patch
+MAX_PIXELS_PER_PATCH = None # Maximale Anzahl Pixel des Klassifikationsrasters je Patch (None = keine Begrenzung)
+ZONAL_MODE = "rasterstats" # Zonalstatistik (Optionen: rasterstats = je Raster über rasterstats, labels = Label-Raster mit einem Durchlauf über alle Raster)
 MAX_DIST = 10 # Filter-Distanz der Zentroide des Klassifikationsrasters zu den Eingangspolygonen
+DISTANCE_FILTER = "raster" # Distanzfilter (Optionen: raster = Distanzmaske auf dem Rastergitter, vector = STRtree-Abfrage je Punkt)
 CELL_SIZE = 10 # Auflösung des Classification-Rasters
 OUTPUT_RASTER = False # Erstellt Raster mit einem Band, basierend auf dem höchsten Wert des Klassifikationsraster
+OUTPUT_RASTER_CLASS = False # Zusätzlich Raster der Klasse mit der höchsten Wahrscheinlichkeit (im selben Durchlauf)
+OUTPUT_RASTER_TOP_N = 0 # Zusätzlich Raster der Top-n Klassen und Wahrscheinlichkeiten (0 = nicht erstellen, z. B. 3)
+OVERLAY_MODE = "vector" # Verschneidung WZ/Klassifikation (Optionen: vector = Rasterzellen + Overlay, coverage = exakte Pixel-Flächenanteile)
+INTERSECT_MODE = "rect" # Intersection im Modus vector (Optionen: rect = Rechteck-Clipping der Rasterzellen, overlay = gpd.overlay)
+CACHE_DIR = None # Ordner für den dauerhaften Cache (resamplete Raster, Zonalstatistik je Polygon), None = kein Cache
+CACHE_MAX_GB = 50 # Maximale Größe des Caches in GB, älteste Einträge werden zuerst gelöscht
+RUN_REPORT = True # Laufbericht mit Laufzeit, CPU-Zeit, Speicher und Durchsatz je Schritt und Patch (run_report.json/.csv)
+SWEEP_MODE = False # Aggregierte Tabellen je Patch speichern und die Plausibilitätsregel für alle Kombinationen der Schwellenwerte auswerten (threshold_sweep.csv)
+SWEEP_ONLY = False # Nur den Sweep aus den gespeicherten Tabellen eines früheren Laufs mit SWEEP_MODE auswerten, ohne Pipeline
+SWEEP_AREA_SHARES = [0.4, 0.5, 0.6] # Mindestanteil der Fläche mit gleicher spec1
+SWEEP_PROB_HIGH = [0.8, 0.85, 0.9, 0.95] # Wahrscheinlichkeit, ab der die Baumart immer übernommen wird
+SWEEP_PROB_LOW = [0.6, 0.65, 0.7, 0.75] # Wahrscheinlichkeit, ab der die Baumart übernommen wird, wenn sie in BAGR, BAGR1 oder BAGR2 vorkommt
+DELTA_MODE = False # Nur Polygone im Bereich geänderter Blöcke der Klassifikation (inkl. MAX_DIST) neu berechnen und in das vorherige Ergebnis in results einfügen
+DELTA_BLOCK_SIZE = 1024 # Blockgröße der Prüfsummen des Klassifikationsrasters in Pixeln
+RUN_MODE = "local" # Verarbeitung der Patches (Optionen: local = auf diesem Rechner, coordinator = Aufgaben in der Warteschlange veröffentlichen und auf die Worker warten, worker = Aufgaben aus der Warteschlange abarbeiten)
+QUEUE_DIR = None # Gemeinsames Verzeichnis der Warteschlange (None = OUTPUT_PATH/queue), OUTPUT_PATH und alle Eingaben müssen für alle Rechner erreichbar sein
+QUEUE_LOCAL_WORKERS = 0 # Anzahl Worker-Prozesse, die der Koordinator zusätzlich auf diesem Rechner startet
+QUEUE_LEASE_SECONDS = 900 # Aufgaben eines Workers ohne Lebenszeichen seit dieser Zeit werden neu vergeben
+PROFILE_STAGES = [] # Schritte, für die ein cProfile-Dump geschrieben wird, z. B. ["intersect_polygons", "calculate_zonal_stats"]
+
+# Klassen des Klassifikationsrasters (Bandnummer → Baumartengruppe)
+CLASS_MAPPING = {
+    1: "FI",
+    2: "KI",
+    3: "LA",
+    4: "BU",
+    5: "EI",
+    6: "BI",
+    7: "ER",
+    8: "ES",
+    9: "SH",
+    10: "SW",
+    11: "SN"
+}
 
 # Maincode
 if __name__ == "__main__":
@@ -55,89 +106,171 @@ if __name__ == "__main__":
     results_folder = os.path.join(OUTPUT_PATH, "results")
     os.makedirs(results_folder, exist_ok=True)
 
-    split_files = split_by_grid(WZ, temp_folder_split)
-    resampled_dict = resample_rasters_from_dict(TIF_DICT, temp_folder, RESOLUTION, METHOD)
-
-    for chunk_file in os.listdir(temp_folder_split):
-        if chunk_file.endswith(".shp"):
-            chunk_path = os.path.join(temp_folder_split, chunk_file)
-
-            # Calculate zonal statistics (zonal_rasterstats.py)
-            clipped_dict = clip_dict_to_patch(resampled_dict, chunk_path, temp_folder)
-            wz_wuchskl_ndomDiff = calculate_zonal_stats(chunk_path, clipped_dict, CORES)
-
-            # Transform classification raster into polygon grids and insert attribut values (classification_to_vector.py)
-            classification = clip_raster_to_patch(CLASSIFICATION, chunk_path, temp_folder)
-            classification_to_points = raster_to_points(classification, temp_folder)
-            points_filtered = filter_points_by_distance(classification_to_points, chunk_path, MAX_DIST)
-            polygon_grids = points_to_raster_cells(points_filtered, CELL_SIZE)
-            class_mapping = {
-                1: "FI",
-                2: "KI",
-                3: "LA",
-                4: "BU",
-                5: "EI",
-                6: "BI",
-                7: "ER",
-                8: "ES",
-                9: "SH",
-                10: "SW",
-                11: "SN"
-            }
-            top3_classes_probs_spec = extract_top_classes(polygon_grids, class_mapping)
-
-            # Union and filtering (union.py)
-            union_wz_classification = intersect_polygons(wz_wuchskl_ndomDiff, top3_classes_probs_spec)
-            post_union = filter_polygons(union_wz_classification)
-
-            # Plausibility (plausibility.py)
-            # === Spaltennamen (einheitlich anpassen!) ===
-            ID = "OBJECTID"
-            union_area = "area_m2"
-            wzba_area = "FLAECHE"
-            bagr1 = "BAGR"
-            bagr2 = "BAGR1"
-            bagr3 = "BAGR2"
-            spec1 = "spec1"
-            prob1 = "prob1"
-
-            # Mehrheitliche spec1 bestimmen
-            gdf = compute_majority_spec(post_union, ID, union_area, wzba_area, prob1, spec1)
-            # Flächensummen & mittlere Wahrscheinlichkeit der Mehrheitsklasse berechnen
-            gdf = compute_mode_filtered_stats(gdf, ID, union_area, prob1, spec1)
-            # Flächen filtern (mind. 50 % der Fläche mit gleicher spec1)
-            gdf_filtered = filter_gdf_by_area(gdf, wzba_area)
-            # Endgültige Aggregation
-            final_aggregated = aggregate_final_values(gdf_filtered, ID, wzba_area)
-            # Plausibilitätsregel anwenden
-            final_aggregated = apply_plausibility(final_aggregated)
-            # Mit ursprünglichen wz_ba-Flächen mergen (nur wo Bedingungen erfüllt sind)
-            final_result = merge_plaus_spec_to_wzba(wz_wuchskl_ndomDiff, final_aggregated, ID)
-
-            # Postprocessing (postprocessing.py)
-            post_processed_1 = change_attributes(final_result)
-            post_processed_2 = add_bhoeh(post_processed_1)
-            post_processed_3 = change_attribute_for_bl(post_processed_2)
-            # Attribute aktualisieren und löschen
-            final_result_postprocessed = update_attributes(post_processed_3, temp_folder_results)
+    # Schwellenwert-Sweep aus den Tabellen eines früheren Laufs (plausibility.py)
+    sweep_folder = os.path.join(OUTPUT_PATH, "sweep") if SWEEP_MODE is True else None
+    if SWEEP_MODE is True and SWEEP_ONLY is True:
+        run_threshold_sweep(sweep_folder, results_folder, "FLAECHE", SWEEP_AREA_SHARES, SWEEP_PROB_HIGH,
+                            SWEEP_PROB_LOW)
+        sys.exit()
+
+    # Messung der Verarbeitungsschritte (instrumentation.py)
+    report_folder = os.path.join(OUTPUT_PATH, "temp_report")
+
+    # Worker: Patches aus der Warteschlange des Koordinators abarbeiten (task_queue.py)
+    queue_folder = QUEUE_DIR or os.path.join(OUTPUT_PATH, "queue")
+    if RUN_MODE == "worker":
+        if RUN_REPORT is True:
+            stage = StageRecorder(report_folder, PROFILE_STAGES, os.path.join(results_folder, "profile"))
+        else:
+            stage = run_stage
+        run_worker(queue_folder, lease_seconds=QUEUE_LEASE_SECONDS, stage=stage)
+        sys.exit()
+
+    shutil.rmtree(report_folder, ignore_errors=True)
+    if RUN_REPORT is True:
+        stage = StageRecorder(report_folder, PROFILE_STAGES, os.path.join(results_folder, "profile"))
+    else:
+        stage = run_stage
+
+    # Delta-Lauf: nur Polygone im Bereich geänderter Klassifikationsblöcke neu berechnen (delta.py)
+    wz_input = WZ
+    delta_wz = None
+    if DELTA_MODE is True:
+        checksum_path = os.path.join(results_folder, "classification_checksums.json")
+        previous_merged = os.path.join(results_folder, "final_result_merged.gpkg")
+        # Alle übrigen Eingaben und Parameter müssen dem vorherigen Lauf entsprechen
+        delta_fingerprint = fingerprint(
+            file_fingerprint(WZ),
+            {name: file_fingerprint(tif_path) for name, tif_path in TIF_DICT.items()},
+            RESOLUTION, METHOD, ZONAL_MODE, OVERLAY_MODE, INTERSECT_MODE, DISTANCE_FILTER, MAX_DIST, CELL_SIZE,
+            CLASS_MAPPING
+        )
+        checksums = stage("block_checksums", block_checksums, CLASSIFICATION, DELTA_BLOCK_SIZE, CORES)
+        previous_checksums = load_checksums(checksum_path)
+        regions = None
+        if (previous_checksums is not None and previous_checksums["fingerprint"] == delta_fingerprint and
+                os.path.exists(previous_merged)):
+            regions = changed_regions(previous_checksums, checksums, MAX_DIST)
+
+        if regions is None:
+            print("Kein passender vorheriger Lauf, alle Polygone werden berechnet")
+        else:
+            delta_wz, n_delta = stage("select_delta_polygons", select_delta_polygons, WZ, regions, temp_folder)
+            if n_delta == 0:
+                print("Keine Polygone von Änderungen betroffen, das vorherige Ergebnis bleibt bestehen")
+                save_checksums(checksums, delta_fingerprint, checksum_path)
+                sys.exit()
+            wz_input = delta_wz
+
+    # Manifest des Laufs: abgeschlossene Patches werden bei einem Neustart übersprungen (manifest.py)
+    manifest_path = os.path.join(OUTPUT_PATH, "run_manifest.json")
+    manifest = load_manifest(manifest_path)
+
+    # Aufteilung nur neu berechnen, wenn sich WZ, Klassifikation oder Aufteilungsparameter geändert haben
+    split_fingerprint = fingerprint(file_fingerprint(wz_input), file_fingerprint(CLASSIFICATION),
+                                    MAX_POLYGONS_PER_PATCH, MAX_PIXELS_PER_PATCH)
+    if split_is_current(manifest, split_fingerprint):
+        split_files = manifest["split"]["patches"]
+    else:
+        # Ergebnisse einer anderen Aufteilung verwerfen
+        for folder in (temp_folder_split, temp_folder_results, sweep_folder):
+            if folder is None:
+                continue
+            shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(temp_folder_results, exist_ok=True)
+        split_files = stage("split_balanced", split_balanced, wz_input, temp_folder_split, MAX_POLYGONS_PER_PATCH,
+                            MAX_PIXELS_PER_PATCH, CLASSIFICATION)
+        record_split(manifest, split_fingerprint, split_files, manifest_path)
+
+    resampled_dict = stage("resample_rasters_from_dict", resample_rasters_from_dict, TIF_DICT, temp_folder, RESOLUTION,
+                           METHOD, RESAMPLE_MODE, RESAMPLE_MEMORY_MB, CORES, CACHE_DIR)
+
+    # Patches verarbeiten (pipeline.py)
+    config = {
+        "classification": CLASSIFICATION,
+        "resampled_dict": resampled_dict,
+        "cores": max(1, CORES // MAX_PARALLEL_PATCHES),
+        "zonal_mode": ZONAL_MODE,
+        "overlay_mode": OVERLAY_MODE,
+        "intersect_mode": INTERSECT_MODE,
+        "distance_filter": DISTANCE_FILTER,
+        "max_dist": MAX_DIST,
+        "cell_size": CELL_SIZE,
+        "class_mapping": CLASS_MAPPING,
+        "output_folder": temp_folder_results,
+        "cache_dir": CACHE_DIR,
+        "sweep_folder": sweep_folder
+    }
+
+    # Nur fehlende oder veraltete Patches verarbeiten
+    run_fingerprint = fingerprint(
+        file_fingerprint(wz_input),
+        file_fingerprint(CLASSIFICATION),
+        {name: file_fingerprint(tif_path) for name, tif_path in TIF_DICT.items()},
+        RESOLUTION, METHOD,
+        {key: value for key, value in config.items() if key not in ("resampled_dict", "output_folder", "cores", "cache_dir")}
+    )
+    pending = pending_patches(manifest, split_files, run_fingerprint)
+    print(f"{len(split_files) - len(pending)} von {len(split_files)} Patches bereits abgeschlossen")
+
+    def patch_done(chunk_path, result_path):
+        record_patch(manifest, chunk_path, result_path, run_fingerprint, manifest_path)
+
+    if RUN_MODE == "coordinator":
+        # Patches als Aufgaben veröffentlichen, Worker auf beliebigen Rechnern beanspruchen sie
+        publish_tasks(queue_folder, pending, config)
+        workers = run_local_workers(queue_folder, QUEUE_LOCAL_WORKERS, QUEUE_LEASE_SECONDS, stage=stage)
+        wait_for_tasks(queue_folder, QUEUE_LEASE_SECONDS, on_done=patch_done, workers=workers)
+    else:
+        run_patches(pending, config, MAX_PARALLEL_PATCHES, PATCH_MEMORY_GB, on_done=patch_done, stage=stage)
+
+    # Gemeinsamen Prozesspool der Zonalstatistik beenden
+    close_pool()
+
+    # Unveränderte Polygone des vorherigen Ergebnisses übernehmen
+    if delta_wz is not None:
+        stage("keep_unchanged_results", keep_unchanged_results, previous_merged, delta_wz, temp_folder_results)
 
     # Merge results
-    final = merge_shapefiles(temp_folder_results, results_folder)
+    final = stage("merge_shapefiles", merge_shapefiles, temp_folder_results, results_folder)
+
+    # Prüfsummen für den nächsten Delta-Lauf
+    if DELTA_MODE is True:
+        save_checksums(checksums, delta_fingerprint, checksum_path)
+
+    # Schwellenwert-Sweep über alle Patches
+    if SWEEP_MODE is True:
+        stage("run_threshold_sweep", run_threshold_sweep, sweep_folder, results_folder, "FLAECHE", SWEEP_AREA_SHARES,
+              SWEEP_PROB_HIGH, SWEEP_PROB_LOW)
 
     # Anpassung von Ueberhaelter Shapefiles
     if ANPASSUNG_UEBERHAELTER is True:
-        update_ueberhaelter_p(UEBERHAELTER_P, final, results_folder)
-        update_ueberhaelter_f(UEBERHAELTER_F, final, results_folder)
+        stage("update_ueberhaelter_p", update_ueberhaelter_p, UEBERHAELTER_P, final, results_folder)
+        stage("update_ueberhaelter_f", update_ueberhaelter_f, UEBERHAELTER_F, final, results_folder)
 
     # Anpassung und AUsgabe der Klassifikationsraster
     if OUTPUT_RASTER is True:
-        compress_to_max_band_raster(CLASSIFICATION, results_folder)
+        stage("compress_to_max_band_raster", compress_to_max_band_raster, CLASSIFICATION, results_folder,
+              OUTPUT_RASTER_CLASS, OUTPUT_RASTER_TOP_N, workers=CORES)
+
+    # Cache auf die maximale Größe begrenzen
+    if CACHE_DIR is not None:
+        evict_cache(CACHE_DIR, CACHE_MAX_GB)
+
+    # Laufbericht schreiben
+    if RUN_REPORT is True:
+        write_run_report(report_folder, results_folder)
+        shutil.rmtree(report_folder, ignore_errors=True)
 
     # Temp-Folder löschen
     print("Temporäre Ergebnisse werden gelöscht")
     shutil.rmtree(temp_folder)
     shutil.rmtree(temp_folder_results)
     shutil.rmtree(temp_folder_split)
+    if RUN_MODE == "coordinator":
+        shutil.rmtree(queue_folder, ignore_errors=True)
+    # Lauf vollständig abgeschlossen, Manifest wird nicht mehr benötigt
+    os.remove(manifest_path)
 
     endzeit = time.time()
     print("process finished in " + str((endzeit - startzeit) / 60) + " minutes")
\ No newline at end of file
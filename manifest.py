@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+
+# Begleitdateien, die zu einem Datensatz gehören und in den Fingerabdruck eingehen
+SIDECAR_EXTENSIONS = {
+    ".shp": [".shx", ".dbf", ".prj", ".cpg"],
+    ".img": [".ige", ".rrd"]
+}
+
+def file_fingerprint(path):
+    """Fingerabdruck einer Eingabedatei (Pfad, Größe, Änderungszeit) inkl. Begleitdateien."""
+    if path is None:
+        return None
+    base, ext = os.path.splitext(path)
+    parts = []
+    for file_path in [path] + [base + sidecar for sidecar in SIDECAR_EXTENSIONS.get(ext.lower(), [])]:
+        if os.path.exists(file_path):
+            stat = os.stat(file_path)
+            parts.append([os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns])
+    return parts
+
+def fingerprint(*items):
+    """Stabiler Hash über beliebige JSON-serialisierbare Werte."""
+    payload = json.dumps(items, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def load_manifest(manifest_path):
+    """Lädt das Manifest eines Laufs oder liefert ein leeres Manifest."""
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            return json.load(f)
+    return {"split": None, "patches": {}}
+
+def save_manifest(manifest, manifest_path):
+    """Schreibt das Manifest atomar (temporäre Datei + os.replace), damit ein Abbruch es nicht beschädigt."""
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+def split_is_current(manifest, split_fingerprint):
+    """Prüft, ob die Aufteilung im Manifest zu den aktuellen Eingaben passt und alle Patches noch vorhanden sind."""
+    split = manifest.get("split")
+    return (
+        split is not None and
+        split["fingerprint"] == split_fingerprint and
+        all(os.path.exists(path) for path in split["patches"])
+    )
+
+def record_split(manifest, split_fingerprint, patch_paths, manifest_path):
+    """Speichert eine neue Aufteilung. Bisherige Patch-Einträge gehören zu einer anderen Aufteilung und werden verworfen."""
+    manifest["split"] = {"fingerprint": split_fingerprint, "patches": list(patch_paths)}
+    manifest["patches"] = {}
+    save_manifest(manifest, manifest_path)
+
+def patch_fingerprint(run_fingerprint, patch_path):
+    """Fingerabdruck eines Patches aus den Eingaben des Laufs und der Patch-Datei."""
+    return fingerprint(run_fingerprint, file_fingerprint(patch_path))
+
+def pending_patches(manifest, patch_paths, run_fingerprint):
+    """Liefert die Patches, die fehlen oder deren Ergebnis nicht mehr zu den Eingaben passt."""
+    pending = []
+    for patch_path in patch_paths:
+        entry = manifest["patches"].get(patch_path)
+        if (entry is None or
+                entry["fingerprint"] != patch_fingerprint(run_fingerprint, patch_path) or
+                not os.path.exists(entry["output"])):
+            pending.append(patch_path)
+    return pending
+
+def record_patch(manifest, patch_path, output_path, run_fingerprint, manifest_path):
+    """Vermerkt einen abgeschlossenen Patch und speichert das Manifest sofort."""
+    manifest["patches"][patch_path] = {
+        "fingerprint": patch_fingerprint(run_fingerprint, patch_path),
+        "output": output_path,
+        "finished": datetime.now().isoformat(timespec="seconds")
+    }
+    save_manifest(manifest, manifest_path)
@@ -0,0 +1,170 @@
+import os
+import rasterio
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from zonal_rasterstats import calculate_zonal_stats, calculate_zonal_stats_labels
+from classification_to_vector import distance_keep_mask, raster_to_cells, filter_points_by_distance
+from coverage_overlay import coverage_overlay
+from union import intersect_polygons, filter_polygons
+from plausibility import aggregate_majority_spec, apply_plausibility, merge_plaus_spec_to_wzba, save_sweep_table
+from postprocessing import postprocess
+from functions import clip_raster_to_patch, load_patch, patch_extent, species_dtype, compact_species
+
+# Geschätzter Speicherbedarf je Pixel und Band des Klassifikationsrasters (Lesen, Zellen, Overlay) und je Polygon
+BYTES_PER_PIXEL_BAND = 16
+BYTES_PER_POLYGON = 64 * 1024
+
+def run_stage(name, func, *args, **kwargs):
+    """Führt einen Verarbeitungsschritt aus. Benchmark und Messungen ersetzen diese Funktion, um Schritte zu erfassen."""
+    return func(*args, **kwargs)
+
+def process_patch(chunk_path, config, stage=run_stage):
+    """
+    Führt die komplette Verarbeitung eines Patches aus: Zonalstatistik, Verschneidung mit der Klassifikation,
+    Plausibilität und Postprocessing.
+
+    Der Patch wird einmal geladen und als PatchContext an alle Schritte übergeben.
+
+    Parameters:
+        chunk_path (str): Pfad zur Patch-Datei (GeoParquet)
+        config (dict): Parameter des Laufs (siehe main.py)
+        stage (callable): Aufruf je Schritt als stage(Name, Funktion, *args, **kwargs), siehe run_stage
+
+    Returns:
+        str: Pfad des Patch-Ergebnisses
+    """
+    patch = stage("load_patch", load_patch, chunk_path)
+    print(f"Verarbeite {patch.name}")
+
+    # Gemeinsames Baumarten-Dictionary für WZ-Attribute und Klassifikation, Text erst beim Schreiben
+    with rasterio.open(config["classification"]) as src:
+        num_classes = src.count
+    species = species_dtype(config["class_mapping"], num_classes, patch.gdf)
+    compact_species(patch.gdf, species)
+
+    # Calculate zonal statistics (zonal_rasterstats.py)
+    # Die Zonalstatistik liest nur die Fenster der Polygone, ein Zuschneiden der Raster ist nicht nötig
+    if config["zonal_mode"] == "labels":
+        wz_wuchskl_ndomDiff = stage("calculate_zonal_stats_labels", calculate_zonal_stats_labels, patch,
+                                    config["resampled_dict"], config["cores"], cache_dir=config["cache_dir"])
+    else:
+        wz_wuchskl_ndomDiff = stage("calculate_zonal_stats", calculate_zonal_stats, patch,
+                                    config["resampled_dict"], config["cores"], cache_dir=config["cache_dir"])
+
+    # Transform classification raster into polygon grids and insert attribut values (classification_to_vector.py)
+    classification = stage("clip_raster_to_patch", clip_raster_to_patch, config["classification"], patch)
+    class_mapping = config["class_mapping"]
+
+    if config["overlay_mode"] == "coverage":
+        # Exakte Flächenanteile der WZ-Polygone je Klassifikationspixel (coverage_overlay.py)
+        union_wz_classification = stage("coverage_overlay", coverage_overlay, wz_wuchskl_ndomDiff, classification,
+                                        class_mapping, species=species)
+    else:
+        # Top-3 Klassen werden bereits blockweise beim Erzeugen der Rasterzellen berechnet
+        if config["distance_filter"] == "raster":
+            keep_mask = stage("distance_keep_mask", distance_keep_mask, patch, classification, config["max_dist"])
+            top3_classes_probs_spec = stage("raster_to_cells", raster_to_cells, classification, config["cell_size"],
+                                            keep_mask=keep_mask, class_mapping=class_mapping, species=species)
+        else:
+            raster_cells = stage("raster_to_cells", raster_to_cells, classification, config["cell_size"],
+                                 class_mapping=class_mapping, species=species)
+            top3_classes_probs_spec = stage("filter_points_by_distance", filter_points_by_distance, raster_cells,
+                                            patch, config["max_dist"])
+
+        # Union and filtering (union.py)
+        union_wz_classification = stage("intersect_polygons", intersect_polygons, wz_wuchskl_ndomDiff,
+                                        top3_classes_probs_spec, method=config["intersect_mode"])
+
+    classification.close()
+    post_union = stage("filter_polygons", filter_polygons, union_wz_classification)
+
+    # Plausibility (plausibility.py)
+    # === Spaltennamen (einheitlich anpassen!) ===
+    ID = "OBJECTID"
+    union_area = "area_m2"
+    wzba_area = "FLAECHE"
+    spec1 = "spec1"
+    prob1 = "prob1"
+
+    # Mehrheitliche spec1, Flächensummen & mittlere Wahrscheinlichkeit der Mehrheitsklasse berechnen
+    aggregated = stage("aggregate_majority_spec", aggregate_majority_spec, post_union, ID, union_area, wzba_area,
+                       prob1, spec1)
+    # Aggregierte Tabelle für den Schwellenwert-Sweep aufbewahren
+    if config["sweep_folder"] is not None:
+        stage("save_sweep_table", save_sweep_table, aggregated, wz_wuchskl_ndomDiff, ID, wzba_area,
+              config["sweep_folder"], patch.name)
+    # Flächen filtern (mind. 50 % der Fläche mit gleicher spec1) und Plausibilitätsregel anwenden
+    final_aggregated = stage("apply_plausibility", apply_plausibility, aggregated, wzba_area)
+    # Mit ursprünglichen wz_ba-Flächen mergen (nur wo Bedingungen erfüllt sind)
+    final_result = stage("merge_plaus_spec_to_wzba", merge_plaus_spec_to_wzba, wz_wuchskl_ndomDiff, final_aggregated, ID)
+
+    # Postprocessing (postprocessing.py)
+    # Attribute in einem Durchlauf aktualisieren und löschen, ein Ergebnis je Patch
+    result_name = f"final_result_{patch.name}.gpkg"
+    stage("postprocess", postprocess, final_result, config["output_folder"], result_name)
+
+    return os.path.join(config["output_folder"], result_name)
+
+def estimate_patch_memory(chunk_path, classification):
+    """Schätzt den Speicherbedarf eines Patches (Bytes) aus seiner Ausdehnung im Klassifikationsraster und der Polygonanzahl."""
+    (minx, miny, maxx, maxy), n_polygons = patch_extent(chunk_path)
+
+    with rasterio.open(classification) as src:
+        pixels = (maxx - minx) * (maxy - miny) / abs(src.transform.a * src.transform.e)
+        bands = src.count
+
+    return int(pixels * bands * BYTES_PER_PIXEL_BAND + n_polygons * BYTES_PER_POLYGON)
+
+def run_patches(patch_paths, config, max_parallel=1, memory_limit_gb=None, on_done=None, stage=run_stage):
+    """
+    Verarbeitet die Patches seriell (max_parallel <= 1) oder parallel in eigenen Prozessen.
+
+    Im parallelen Modus werden höchstens max_parallel Patches gleichzeitig bearbeitet und neue Patches nur
+    gestartet, solange der geschätzte Speicherbedarf aller laufenden Patches unter memory_limit_gb bleibt.
+    Ein Patch wird immer gestartet, wenn gerade keiner läuft.
+
+    Parameters:
+        on_done (callable): Optional, wird im Hauptprozess nach jedem fertigen Patch mit
+                            (Patch-Pfad, Ergebnis-Pfad) aufgerufen.
+        stage (callable): Aufruf je Schritt, siehe process_patch (muss für Prozesse auf Modulebene liegen).
+
+    Returns:
+        list: Pfade der Patch-Ergebnisse
+    """
+    results = []
+    if max_parallel <= 1:
+        for chunk_path in patch_paths:
+            result_path = process_patch(chunk_path, config, stage)
+            results.append(result_path)
+            if on_done is not None:
+                on_done(chunk_path, result_path)
+        return results
+
+    budget = None if memory_limit_gb is None else memory_limit_gb * 1024 ** 3
+    queue = [(chunk_path, estimate_patch_memory(chunk_path, config["classification"])) for chunk_path in patch_paths]
+    # Große Patches zuerst, damit sie nicht am Ende allein laufen
+    queue.sort(key=lambda item: item[1], reverse=True)
+
+    running = {}
+    with ProcessPoolExecutor(max_parallel) as executor:
+        while queue or running:
+            in_use = sum(memory for _, memory in running.values())
+            started = True
+            while queue and len(running) < max_parallel and started:
+                started = False
+                for i, (chunk_path, memory) in enumerate(queue):
+                    if not running or budget is None or in_use + memory <= budget:
+                        running[executor.submit(process_patch, chunk_path, config, stage)] = (chunk_path, memory)
+                        in_use += memory
+                        del queue[i]
+                        started = True
+                        break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk_path, _ = running.pop(future)
+                result_path = future.result()
+                results.append(result_path)
+                if on_done is not None:
+                    on_done(chunk_path, result_path)
+
+    return results
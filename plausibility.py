@@ -1,91 +1,121 @@
 import geopandas as gpd
+import glob
+import itertools
 import os
 import pandas as pd
+import numpy as np
 
-def get_mode(series):
-    try:
-        return series.mode().iloc[0]
-    except IndexError:
-        return None
-
-def compute_majority_spec(post_union, id_col, union_area_col, wzba_area_col, prob1_col, spec_col):
+def aggregate_majority_spec(post_union, id_col, union_area_col, wzba_area_col, prob1_col, spec_col):
     """
-    Liest das Shapefile ein, konvertiert relevante Spalten zu numerisch und berechnet die Mehrheit spec1 pro Fläche.
+    Berechnet in einem vektorisierten Durchlauf je Fläche die mehrheitliche spec1, deren Flächensumme und die mittlere
+    Wahrscheinlichkeit. IDs und Baumarten werden dafür ganzzahlig codiert und mit np.bincount gruppiert.
+
+    Bei Gleichstand gewinnt wie bei Series.mode() auf Text die alphabetisch kleinste Baumart, auch wenn spec1
+    kategorial ist (die Kategorienreihenfolge spielt keine Rolle).
+
+    Returns:
+        pd.DataFrame: Eine Zeile je ID mit majority_spec1, mode_sum_union_area, mean_prob1_for_majority_spec1,
+                      BAGR, BAGR1, BAGR2 und der WZ-Fläche.
     """
     print("Prüfung der Plausibilität wird durchgeführt")
     gdf = post_union
 
     # Spalten sicher in numerisch umwandeln
-    gdf[union_area_col] = pd.to_numeric(gdf[union_area_col], errors="coerce")
-    gdf[wzba_area_col] = pd.to_numeric(gdf[wzba_area_col], errors="coerce")
-    gdf[prob1_col] = pd.to_numeric(gdf[prob1_col], errors="coerce")
-
-    gdf['majority_spec1'] = gdf.groupby(id_col)[spec_col].transform(get_mode)
-
-    return gdf
-
-def compute_mode_filtered_stats(gdf, id_col, union_area_col, prob1_col, spec_col):
-    mode_filtered = gdf[gdf[spec_col] == gdf['majority_spec1']]
-
-    sum_area = mode_filtered.groupby(id_col)[union_area_col].sum().reset_index(name='mode_sum_union_area')
-    mean_prob1 = mode_filtered.groupby(id_col)[prob1_col].mean().reset_index(name='mean_prob1_for_majority_spec1')
-
-    gdf = gdf.merge(sum_area, on=id_col, how='left')
-    gdf = gdf.merge(mean_prob1, on=id_col, how='left')
-
-    return gdf
-
-def filter_gdf_by_area(gdf, wzba_area_col):
-    union_area_sum_col = "mode_sum_union_area"
-    return gdf[gdf[union_area_sum_col] >= gdf[wzba_area_col] / 2].copy()
+    area = pd.to_numeric(gdf[union_area_col], errors="coerce").to_numpy(dtype=float)
+    prob = pd.to_numeric(gdf[prob1_col], errors="coerce").to_numpy(dtype=float)
+
+    id_codes, ids = pd.factorize(gdf[id_col], sort=True)
+    spec_codes, specs = pd.factorize(gdf[spec_col], sort=True)
+    n_ids, n_specs = len(ids), len(specs)
+
+    # Häufigkeit jeder Baumart je ID -> Modus
+    valid = (id_codes >= 0) & (spec_codes >= 0)
+    counts = np.bincount(id_codes[valid] * n_specs + spec_codes[valid], minlength=n_ids * n_specs)
+    counts = counts.reshape(n_ids, n_specs)
+    has_mode = counts.sum(axis=1) > 0
+    # argmax liefert das erste Maximum: Spalten dafür nach der Bezeichnung der Baumart ordnen
+    by_label = np.argsort(np.asarray(specs).astype(str), kind="stable")
+    majority = by_label[counts[:, by_label].argmax(axis=1)] if n_specs else np.zeros(n_ids, dtype=np.int64)
+
+    # Flächensumme und mittlere Wahrscheinlichkeit der Mehrheitsklasse
+    in_mode = valid & (spec_codes == majority[id_codes])
+    mode_sum = np.bincount(id_codes[in_mode], weights=np.nan_to_num(area[in_mode]), minlength=n_ids)
+    with_prob = in_mode & ~np.isnan(prob)
+    prob_sum = np.bincount(id_codes[with_prob], weights=prob[with_prob], minlength=n_ids)
+    prob_count = np.bincount(id_codes[with_prob], minlength=n_ids)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_prob = prob_sum / prob_count
+
+    majority_spec = np.asarray(specs, dtype=object)[majority] if n_specs else np.full(n_ids, None, dtype=object)
+    majority_spec[~has_mode] = None
+    mode_sum[~has_mode] = np.nan
+
+    # Polygon-Attribute der ersten Zeile je ID
+    rows = np.flatnonzero(id_codes >= 0)
+    _, first_pos = np.unique(id_codes[rows], return_index=True)
+    first = gdf.iloc[rows[first_pos]]
+
+    return pd.DataFrame({
+        id_col: np.asarray(ids),
+        'mean_prob1_for_majority_spec1': mean_prob,
+        'majority_spec1': majority_spec,
+        'BAGR': first['BAGR'].to_numpy(),
+        'BAGR1': first['BAGR1'].to_numpy(),
+        'BAGR2': first['BAGR2'].to_numpy(),
+        'mode_sum_union_area': mode_sum,
+        wzba_area_col: pd.to_numeric(first[wzba_area_col], errors="coerce").to_numpy(dtype=float),
+    })
+
+def majority_in_bagr(aggregated):
+    """Kommt die mehrheitliche spec1 bereits in BAGR, BAGR1 oder BAGR2 vor?"""
+    majority = aggregated['majority_spec1'].to_numpy(dtype=object)
+    in_bagr = np.zeros(len(aggregated), dtype=bool)
+    for col in ('BAGR', 'BAGR1', 'BAGR2'):
+        in_bagr |= aggregated[col].to_numpy(dtype=object) == majority
+    return in_bagr
+
+def apply_plausibility(aggregated, wzba_area_col, area_share=0.5, prob_high=0.9, prob_low=0.7):
+    """
+    Filtert die Flächen (mind. area_share der Fläche mit gleicher spec1) und wendet die Plausibilitätsregel an:
+    plaus_spec = majority_spec1, wenn die mittlere Wahrscheinlichkeit > prob_high ist oder > prob_low und die
+    Baumart bereits in BAGR, BAGR1 oder BAGR2 vorkommt.
+    """
+    majority = aggregated['majority_spec1'].to_numpy(dtype=object)
+    mean_prob = aggregated['mean_prob1_for_majority_spec1'].to_numpy(dtype=float)
 
-def aggregate_final_values(gdf_filtered, id_col, wzba_area_col):
-    return gdf_filtered.groupby(id_col).agg({
-        'mean_prob1_for_majority_spec1': 'first',
-        'majority_spec1': 'first',
-        'BAGR': 'first',
-        'BAGR1': 'first',
-        'BAGR2': 'first',
-        'mode_sum_union_area': 'first',
-        wzba_area_col: 'first',
-    }).reset_index()
+    area_ok = aggregated['mode_sum_union_area'].to_numpy(dtype=float) >= aggregated[wzba_area_col].to_numpy(dtype=float) * area_share
+    in_bagr = majority_in_bagr(aggregated)
 
-def determine_plaus_spec(row):
-    if row['mode_sum_union_area'] >= row['FLAECHE'] / 2:
-        if row['mean_prob1_for_majority_spec1'] > 0.9:
-            return row['majority_spec1']
-        elif row['mean_prob1_for_majority_spec1'] > 0.7 and row['majority_spec1'] in (row['BAGR'], row['BAGR1'], row['BAGR2']):
-            return row['majority_spec1']
-    return None
+    final_aggregated = aggregated[area_ok].copy()
+    final_aggregated['plaus_spec'] = np.select(
+        [mean_prob[area_ok] > prob_high, (mean_prob[area_ok] > prob_low) & in_bagr[area_ok]],
+        [majority[area_ok], majority[area_ok]],
+        default=None
+    )
 
-def apply_plausibility(final_aggregated):
-    final_aggregated['plaus_spec'] = final_aggregated.apply(determine_plaus_spec, axis=1)
+    return final_aggregated.reset_index(drop=True)
 
-    return final_aggregated
+def eligible_mask(wz_ba_gdf):
+    """Flächen, deren BAGR durch plaus_spec ersetzt werden darf."""
+    return (
+        ((wz_ba_gdf['ndomDiff'] > 4) & (wz_ba_gdf['wuchskl'] != 3)) |
+        ((wz_ba_gdf['BAGR'] == "uLW") & (wz_ba_gdf['wuchskl'] != 3)) |
+        ((wz_ba_gdf['BAGR'] == "uNW") & (wz_ba_gdf['wuchskl'] != 3))
+    )
 
 def merge_plaus_spec_to_wzba(wzba_path, final_aggregated, id_col, output_path=None):
     wz_ba_gdf = wzba_path
     wz_ba_gdf[id_col] = wz_ba_gdf[id_col].astype(final_aggregated[id_col].dtype)
 
     # Optionaler Filter vor dem Merge
-    filtered = wz_ba_gdf[
-        ((wz_ba_gdf['ndomDiff'] > 4) & (wz_ba_gdf['wuchskl'] != 3)) |
-        ((wz_ba_gdf['BAGR'] == "uLW") & (wz_ba_gdf['wuchskl'] != 3)) |
-        ((wz_ba_gdf['BAGR'] == "uNW") & (wz_ba_gdf['wuchskl'] != 3))
-    ]
-
-    # Merge nur für die ausgewählten IDs
-    cols_to_merge = [id_col, 'plaus_spec', 'mean_prob1_for_majority_spec1']
-    result_gdf = filtered.merge(final_aggregated[cols_to_merge], on=id_col, how='left')
+    eligible = eligible_mask(wz_ba_gdf)
 
-    # === Korrektes Zurückschreiben in den Original-DataFrame ===
+    # === Zurückschreiben in den Original-DataFrame (nur für die ausgewählten IDs) ===
     wz_ba_gdf_updated = wz_ba_gdf.copy()
+    lookup = final_aggregated.set_index(id_col)
 
     for col in ['plaus_spec', 'mean_prob1_for_majority_spec1']:
-        merged_values = result_gdf.set_index(id_col)[col]
-        wz_ba_gdf_updated.loc[wz_ba_gdf_updated[id_col].isin(merged_values.index), col] = (
-            wz_ba_gdf_updated[id_col].map(merged_values)
-        )
+        wz_ba_gdf_updated[col] = wz_ba_gdf_updated[id_col].map(lookup[col]).where(eligible)
 
     # === ERSETZUNGSLOGIK ===
 
@@ -112,4 +142,87 @@ def merge_plaus_spec_to_wzba(wzba_path, final_aggregated, id_col, output_path=No
         shapefile_path = os.path.join(output_path, shapefile_name)
         wz_ba_gdf_updated.to_file(shapefile_path, driver="GPKG")
 
-    return wz_ba_gdf_updated
\ No newline at end of file
+    return wz_ba_gdf_updated
+
+def save_sweep_table(aggregated, wz_ba_gdf, id_col, wzba_area_col, sweep_folder, name):
+    """
+    Speichert die aggregierte Tabelle eines Patches für den Schwellenwert-Sweep (threshold_sweep) als
+    sweep_<name>.parquet. Neben Flächensumme, WZ-Fläche und mittlerer Wahrscheinlichkeit der Mehrheitsklasse wird
+    je Fläche vermerkt, ob die Mehrheitsklasse in BAGR/BAGR1/BAGR2 vorkommt (in_bagr), ob die Fläche ersetzt werden
+    darf (eligible) und ob die Mehrheitsklasse von BAGR abweicht (differs).
+    """
+    majority = aggregated['majority_spec1'].to_numpy(dtype=object)
+    ids = aggregated[id_col].to_numpy()
+
+    # eligible je ID wie in merge_plaus_spec_to_wzba
+    eligible = pd.Series(eligible_mask(wz_ba_gdf).to_numpy(dtype=bool),
+                         index=wz_ba_gdf[id_col].astype(aggregated[id_col].dtype).to_numpy())
+    eligible = eligible.groupby(level=0).first()
+
+    table = pd.DataFrame({
+        id_col: ids,
+        'mean_prob1_for_majority_spec1': aggregated['mean_prob1_for_majority_spec1'].to_numpy(dtype=float),
+        'mode_sum_union_area': aggregated['mode_sum_union_area'].to_numpy(dtype=float),
+        wzba_area_col: aggregated[wzba_area_col].to_numpy(dtype=float),
+        'in_bagr': majority_in_bagr(aggregated),
+        'eligible': eligible.reindex(ids, fill_value=False).to_numpy(dtype=bool),
+        'differs': pd.notna(majority) & (aggregated['BAGR'].to_numpy(dtype=object) != majority)
+    })
+
+    os.makedirs(sweep_folder, exist_ok=True)
+    path = os.path.join(sweep_folder, f"sweep_{name}.parquet")
+    table.to_parquet(path, index=False)
+    return path
+
+def threshold_sweep(table, wzba_area_col, area_shares, prob_highs, prob_lows, max_cells=50_000_000):
+    """
+    Wertet die Plausibilitätsregel (apply_plausibility + merge_plaus_spec_to_wzba) für alle Kombinationen der
+    Schwellenwerte vektorisiert aus. Es werden nur Flächen betrachtet, die ersetzt werden dürfen und deren
+    Mehrheitsklasse von BAGR abweicht; die Kombinationen werden in Blöcken von höchstens max_cells
+    Fläche×Kombination ausgewertet.
+
+    Returns:
+        pd.DataFrame: Eine Zeile je Kombination mit Anzahl und Fläche (m²) der Polygone, deren BAGR sich ändert
+    """
+    combos = np.array(list(itertools.product(area_shares, prob_highs, prob_lows)), dtype=float).reshape(-1, 3)
+
+    candidates = table[table['eligible'] & table['differs']]
+    mode_sum = candidates['mode_sum_union_area'].to_numpy(dtype=float)
+    wzba_area = candidates[wzba_area_col].to_numpy(dtype=float)
+    mean_prob = candidates['mean_prob1_for_majority_spec1'].to_numpy(dtype=float)
+    in_bagr = candidates['in_bagr'].to_numpy(dtype=bool)
+
+    polygons = np.zeros(len(combos), dtype=np.int64)
+    area = np.zeros(len(combos))
+    step = max(1, max_cells // max(len(candidates), 1))
+    for start in range(0, len(combos), step):
+        area_share, prob_high, prob_low = (combos[start:start + step, i, np.newaxis] for i in range(3))
+        changed = (mode_sum >= wzba_area * area_share) & (
+            (mean_prob > prob_high) | ((mean_prob > prob_low) & in_bagr)
+        )
+        polygons[start:start + step] = changed.sum(axis=1)
+        area[start:start + step] = changed @ np.nan_to_num(wzba_area)
+
+    return pd.DataFrame({
+        'area_share': combos[:, 0],
+        'prob_high': combos[:, 1],
+        'prob_low': combos[:, 2],
+        'polygons_changed': polygons,
+        'area_changed_m2': area,
+        'polygons_changed_share': polygons / max(len(table), 1)
+    })
+
+def run_threshold_sweep(sweep_folder, output_path, wzba_area_col, area_shares, prob_highs, prob_lows):
+    """Liest die Tabellen aller Patches aus sweep_folder, wertet den Sweep aus und speichert threshold_sweep.csv."""
+    files = sorted(glob.glob(os.path.join(sweep_folder, "sweep_*.parquet")))
+    if not files:
+        print(f"Keine Sweep-Tabellen in {sweep_folder} gefunden")
+        return None
+    table = pd.concat([pd.read_parquet(path) for path in files], ignore_index=True)
+
+    result = threshold_sweep(table, wzba_area_col, area_shares, prob_highs, prob_lows)
+    path = os.path.join(output_path, "threshold_sweep.csv")
+    result.to_csv(path, index=False)
+    print(result.to_string(index=False, float_format=lambda v: f"{v:.2f}"))
+    print(f"Schwellenwert-Sweep über {len(table):,} Flächen gespeichert unter: {path}")
+    return result
@@ -1,141 +1,253 @@
 import geopandas as gpd
 import pandas as pd
+import numpy as np
+import math
 import os
-from datetime import datetime, date
-
-
-def change_attributes(final_result, output_path=None):
+import pyogrio
+import shapely
+from datetime import datetime
+
+# === Regeln des Postprocessings ===
+# Jede Regel setzt eine Spalte für alle Zeilen einer Maske (None = alle Zeilen) auf einen Wert. Ein Wert kann
+# eine Funktion sein, die die Werte aller Zeilen als Array liefert. Die Regeln werden in dieser Reihenfolge als
+# ganze Spalten angewendet (apply_rules).
+HERKUNFT_S2 = "Baumartengruppe aus Sentinel-2 Klassifikation"
+LBH_VALUES = {"BI", "BU", "EI", "ER", "ES", "SW", "SH"}
+NDH_VALUES = {"FI", "KI", "LA", "SN"}
+
+# Spalten, die bei Blößen (wuchskl == 3) erhalten bleiben, alle anderen werden geleert
+BL_KEEP_COLUMNS = ("HOLZART", "BA", "Shape", "OBJECTID", "FLAECHE", "WZ_OA", "Shape_Leng", "Shape_Area", "area_m2",
+                   "BEARBEITER", "DATUM", "DATUM_DFE", "geometry", "wuchskl")
+# Nicht benötigte Spalten im Ergebnis
+DROP_COLUMNS = ["mean_prob1_for_majority_spec1", "wuchskl", "ndomDiff", "OBJECTID", "plaus_spec"]
+
+def bhoeh(gdf):
+    """BHOEH_DFE = round(ndom * 2) / 2 (auf halbe Meter gerundet)."""
+    return np.round(pd.to_numeric(gdf["ndom"], errors="coerce").to_numpy(dtype="float64") * 2) / 2
+
+def plaus_rules(today):
+    """Plausible Spezies (change_attributes): HERKUNFT, HOLZART, BA, DATUM und DATUM_DFE."""
+    return [
+        ("HERKUNFT", "plausible", HERKUNFT_S2),
+        ("HOLZART", "lbh", "LBH"),
+        ("HOLZART", "ndh", "NDH"),
+        ("BA", None, "oA"),
+        ("DATUM", "plausible", pd.Timestamp(today)),
+        ("DATUM_DFE", "plausible", pd.Timestamp(today.year, 1, 1))
+    ]
+
+BHOEH_RULES = [("BHOEH_DFE", "ndom", bhoeh)]
+
+def bl_rules(today):
+    """Blößen (change_attribute_for_bl): HOLZART, BA und DATUM als Text."""
+    return [
+        ("HOLZART", "bl", "BL"),
+        ("BA", "bl", "BL"),
+        ("DATUM", "bl", today.strftime("%d.%m.%Y"))
+    ]
+
+def rule_masks(gdf):
+    """Zeilenmasken der Regeln, einmal je Durchlauf berechnet."""
+    masks = {}
+    if "plaus_spec" in gdf.columns:
+        plaus = gdf["plaus_spec"]
+        # Nur Zeilen, wo plaus_spec gefüllt ist (≠ NaN und ≠ leere Zeichenkette)
+        plausible = (plaus.notna() & (plaus.astype(str).str.strip() != "")).to_numpy()
+        masks["plausible"] = plausible
+        masks["lbh"] = plausible & plaus.isin(LBH_VALUES).to_numpy()
+        masks["ndh"] = plausible & plaus.isin(NDH_VALUES).to_numpy()
+    if "wuchskl" in gdf.columns:
+        masks["bl"] = (gdf["wuchskl"] == 3).to_numpy()
+    return masks
+
+def apply_rules(gdf, rules, masks=None):
     """
-    Aktualisiert HERKUNFT, HOLZART, BA, DATUM und DATUM_DFE anhand plausibler Spezies.
+    Wendet Regeln (Spalte, Maske, Wert) spaltenweise an. Regeln mit Maske "ndom" greifen nur, wenn die Spalte
+    ndom vorhanden ist (alle Zeilen), Regeln mit einer nicht berechenbaren Maske werden übersprungen.
     """
-    print("Postproccessing wird durchgeführt")
-
-    # Shapefile einlesen
-    gdf = final_result
-
-    # Nur Zeilen, wo plaus_spec gefüllt ist (≠ NaN und ≠ leere Zeichenkette)
-    plaus_col = "plaus_spec"
-    mask = gdf[plaus_col].notna() & (gdf[plaus_col].astype(str).str.strip() != "")
+    masks = rule_masks(gdf) if masks is None else masks
+    for col, mask_name, value in rules:
+        if mask_name == "ndom":
+            if "ndom" not in gdf.columns:
+                continue
+            mask_name = None
+        if mask_name is not None and mask_name not in masks:
+            continue
+        if callable(value):
+            value = value(gdf)
+
+        if mask_name is None:
+            gdf[col] = value
+            continue
+        mask = masks[mask_name]
+        # Fehlende Spalten legt .loc wie bisher mit dem Typ des Werts an (z. B. datetime64 für DATUM)
+        if mask.any():
+            gdf.loc[mask, col] = value if np.ndim(value) == 0 else value[mask]
+        elif col not in gdf.columns:
+            gdf[col] = None
+    return gdf
 
-    # HERKUNFT setzen
-    gdf.loc[mask, "HERKUNFT"] = "Baumartengruppe aus Sentinel-2 Klassifikation"
+def clear_bl_columns(gdf, masks=None):
+    """Leert für Blößen alle Spalten außer BL_KEEP_COLUMNS in einem Schritt."""
+    masks = rule_masks(gdf) if masks is None else masks
+    bl = masks.get("bl")
+    if bl is None or not bl.any():
+        return gdf
+    columns_to_clear = [col for col in gdf.columns if col not in BL_KEEP_COLUMNS]
+    if columns_to_clear:
+        gdf[columns_to_clear] = pd.DataFrame(gdf[columns_to_clear]).where(pd.Series(~bl, index=gdf.index), axis=0)
+    return gdf
 
-    # HOLZART setzen nach Baumart
-    lbh_values = {"BI", "BU", "EI", "ER", "ES", "SW", "SH"}
-    ndh_values = {"FI", "KI", "LA", "SN"}
+def prob_column(gdf):
+    """PROB als ganzzahlige Prozent (0–100, Int64), falls plaus_spec und die mittlere Wahrscheinlichkeit gesetzt sind."""
+    prob = pd.to_numeric(gdf["mean_prob1_for_majority_spec1"], errors="coerce").to_numpy(dtype="float64")
+    valid = gdf["plaus_spec"].notna().to_numpy() & ~np.isnan(prob)
+    return pd.Series(np.where(valid, np.round(prob * 100), np.nan), index=gdf.index).astype("Int64")
+
+def finalize_attributes(gdf):
+    """PROB setzen und hinter HERKUNFT4 einordnen, nicht benötigte Spalten löschen, Kategorien in Text umwandeln."""
+    gdf["PROB"] = prob_column(gdf)
+
+    cols = [col for col in gdf.columns if col != "PROB" and col not in DROP_COLUMNS]
+    insert_index = cols.index("HERKUNFT4") + 1 if "HERKUNFT4" in cols else len(cols)
+    cols.insert(insert_index, "PROB")
+    gdf = gdf[cols]
+
+    # Baumarten-Kategorien erst beim Schreiben wieder in Text umwandeln
+    categorical = [col for col in gdf.columns if isinstance(gdf[col].dtype, pd.CategoricalDtype)]
+    if categorical:
+        gdf = gdf.astype({col: object for col in categorical})
+    return gdf
 
-    gdf.loc[mask & gdf[plaus_col].isin(lbh_values), "HOLZART"] = "LBH"
-    gdf.loc[mask & gdf[plaus_col].isin(ndh_values), "HOLZART"] = "NDH"
+def write_result(gdf, output_path, file_name=None):
+    """Speichert unter file_name, sonst mit Zeitstempel."""
+    if file_name is None:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        file_name = f"final_result_{timestamp}.gpkg"
+    shapefile_path = os.path.join(output_path, file_name)
+    gdf.to_file(shapefile_path, driver="GPKG")
 
-    # BA entfernen
-    gdf["BA"] = "oA"
+    print(f"Prozess abgeschlossen. Ergebnis gespeichert unter: {shapefile_path}")
+    return gdf
 
-    # Aktuelles Datum setzen
-    today_datetime = pd.to_datetime(datetime.now().date())  # sichert richtigen Typ
-    gdf.loc[mask, "DATUM"] = today_datetime
+def postprocess(final_result, output_path, file_name=None, today=None):
+    """
+    Komplettes Postprocessing in einem Durchlauf: alle Regeln (plausible Spezies, BHOEH_DFE, Blößen) werden mit
+    einmal berechneten Masken spaltenweise angewendet, danach werden die Spalten der Blößen geleert, PROB gesetzt,
+    die Spalten geordnet und das Ergebnis gespeichert. Entspricht change_attributes, add_bhoeh,
+    change_attribute_for_bl und update_attributes nacheinander.
+    """
+    print("Postproccessing wird durchgeführt")
+    today = today or datetime.now().date()
+    gdf = final_result
+    masks = rule_masks(gdf)
+    gdf = apply_rules(gdf, plaus_rules(today) + BHOEH_RULES + bl_rules(today), masks)
+    gdf = clear_bl_columns(gdf, masks)
+    return write_result(finalize_attributes(gdf), output_path, file_name)
 
-    # DATUM_DFE anpassen
-    aktuelles_jahr = datetime.now().year
-    datum_dfe = date(aktuelles_jahr, 1, 1)
-    #gdf.loc[mask, "DATUM_DFE"] = pd.to_datetime(datum_dfe).date()
-    gdf.loc[mask, "DATUM_DFE"] = pd.to_datetime(f"{aktuelles_jahr}-01-01")
+def change_attributes(final_result, output_path=None):
+    """
+    Aktualisiert HERKUNFT, HOLZART, BA, DATUM und DATUM_DFE anhand plausibler Spezies.
+    """
+    print("Postproccessing wird durchgeführt")
+    gdf = apply_rules(final_result, plaus_rules(datetime.now().date()))
 
     # speichern
     if output_path:
-        shapefile_name = "final_result_postprocessed_test.gpkg"
-        shapefile_path = os.path.join(output_path, shapefile_name)
-        gdf.to_file(shapefile_path, driver="GPKG")
-
+        gdf.to_file(os.path.join(output_path, "final_result_postprocessed_test.gpkg"), driver="GPKG")
     return gdf
 
 def add_bhoeh(gdf):
     """
     Fügt die Spalte BHOEH_DFE hinzu, berechnet als: round(ndom * 2) / 2
     """
-    ndom_col = "ndom"
-    new_col = "BHOEH_DFE"
-
-    if ndom_col not in gdf.columns:
-        return gdf
-
-    gdf[new_col] = pd.to_numeric(gdf[ndom_col], errors="coerce").apply(lambda x: round(x * 2) / 2 if pd.notna(x) else None)
-    return gdf
+    return apply_rules(gdf, BHOEH_RULES)
 
 def change_attribute_for_bl(gdf):
     """
     Setzt HOLZART, BA und DATUM für wuchskl == 3.
-    Alle anderen Attribute (außer 'geometry', 'HOLZART', 'BA') werden gelöscht.
+    Alle anderen Attribute (außer BL_KEEP_COLUMNS) werden gelöscht.
     """
-    bl_mask = gdf["wuchskl"] == 3
-
-    # Setze 'BL' in HOLZART und BA
-    gdf.loc[bl_mask, "HOLZART"] = "BL"
-    gdf.loc[bl_mask, "BA"] = "BL"
-    # Ändere das Attribut DATUM
-    today = datetime.now().strftime("%d.%m.%Y")  # Format "15.05.2025"
-    gdf.loc[bl_mask, "DATUM"] = today
-
-    # Alle Spalten außer 'geometry', 'HOLZART', 'BA'
-    columns_to_clear = [col for col in gdf.columns if col not in ("HOLZART", "BA", "Shape", "OBJECTID", "FLAECHE", "WZ_OA",
-                                                                  "Shape_Leng", "Shape_Area", "area_m2", "BEARBEITER",
-                                                                  "DATUM", "DATUM_DFE", "geometry", "wuchskl")]
+    masks = rule_masks(gdf)
+    gdf = apply_rules(gdf, bl_rules(datetime.now().date()), masks)
+    return clear_bl_columns(gdf, masks)
 
-    for col in columns_to_clear:
-        gdf.loc[bl_mask, col] = None  # oder "" je nach Bedarf
+def update_attributes(gdf, output_path, file_name=None):
+    """Setzt PROB, ordnet und löscht Spalten und speichert das Ergebnis."""
+    return write_result(finalize_attributes(gdf), output_path, file_name)
 
-    return gdf
-
-def update_attributes(gdf, output_path):
-    prob_col = "mean_prob1_for_majority_spec1"
-    plaus_col = "plaus_spec"
-
-    # Neue PROB-Spalte als ganzzahlig (0–100), falls plaus_spec gesetzt ist
-    gdf["PROB"] = gdf.apply(
-        lambda row: round(row[prob_col] * 100) if pd.notna(row[plaus_col]) and pd.notna(row[prob_col]) else pd.NA,
-        axis=1
-    ).astype("Int64")  # <- Int64 erlaubt NA + Integer
-
-    # Spalte 'PROB' hinter 'HERKUNFT4' verschieben
-    if "HERKUNFT4" in gdf.columns:
-        cols = list(gdf.columns)
-        cols.remove("PROB")
-        insert_index = cols.index("HERKUNFT4") + 1
-        cols.insert(insert_index, "PROB")
-        gdf = gdf[cols]
-
-    # nicht benötigte Spalten löschen
-    columns_to_delete = ["mean_prob1_for_majority_spec1", "wuchskl", "ndomDiff", "OBJECTID", "plaus_spec"]
-    gdf = gdf.drop(columns=columns_to_delete)
-
-    # Speichern mit Zeitstempel
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    shapefile_name = f"final_result_{timestamp}.gpkg"
-    shapefile_path = os.path.join(output_path, shapefile_name)
-    gdf.to_file(shapefile_path, driver="GPKG")
+def polygon_chunks(polygons, target_geoms, attributes, tile_size=10000):
+    """
+    Liefert die Ergebnispolygone kachelweise, ohne das gesamte Ergebnis zu laden.
 
-    print(f"Prozess abgeschlossen. Ergebnis gespeichert unter: {shapefile_path}")
-    return gdf
+    Über die Ausdehnung der Zielgeometrien wird ein Gitter mit Kantenlänge tile_size gelegt. Für jede Kachel, in
+    der Zielgeometrien liegen, werden nur die Polygone dieser Kachel über den räumlichen Index der Datei gelesen.
+    Ein GeoDataFrame wird als ein einziger Chunk geliefert.
 
-def update_ueberhaelter_p(ueberhaelter_p, polygons_gdf, output_path):
+    Yields:
+        gpd.GeoDataFrame: Polygone mit attributes und Geometrie (Polygone an Kachelgrenzen ggf. mehrfach)
+    """
+    if not isinstance(polygons, str):
+        yield polygons[[col for col in attributes if col in polygons.columns] + [polygons.geometry.name]]
+        return
+
+    fields = pyogrio.read_info(polygons)["fields"]
+    columns = [col for col in attributes if col in fields]
+    if len(target_geoms) == 0:
+        return
+
+    tree = shapely.STRtree(target_geoms)
+    minx, miny, maxx, maxy = shapely.total_bounds(target_geoms)
+    n_x = max(1, math.ceil((maxx - minx) / tile_size))
+    n_y = max(1, math.ceil((maxy - miny) / tile_size))
+    for i in range(n_x):
+        for j in range(n_y):
+            tile = (minx + i * tile_size, miny + j * tile_size, minx + (i + 1) * tile_size, miny + (j + 1) * tile_size)
+            if len(tree.query(shapely.box(*tile))) == 0:
+                continue
+            chunk = pyogrio.read_dataframe(polygons, columns=columns, bbox=tile)
+            if not chunk.empty:
+                yield chunk
+
+def result_crs(polygons):
+    """KBS des Ergebnisses (Pfad oder GeoDataFrame)."""
+    if isinstance(polygons, str):
+        return pyogrio.read_info(polygons)["crs"]
+    return polygons.crs
+
+def update_ueberhaelter_p(ueberhaelter_p, polygons_gdf, output_path, tile_size=10000):
     """
     Aktualisiert vorhandene Attribute in points_gdf basierend auf räumlicher Zuordnung zu polygons_gdf.
+
+    polygons_gdf kann ein GeoDataFrame oder der Pfad des zusammengeführten Ergebnisses sein, das dann kachelweise
+    gelesen wird (polygon_chunks). Punkte ohne Polygon erhalten wie beim bisherigen sjoin leere Attribute.
     """
     print("Ueberhaelter_p wird angepasst")
     points_gdf = gpd.read_file(ueberhaelter_p)
     attributes_to_transfer = ["BAGR", "BA", "HOLZART"]
 
-    # Spatial Join: Punkte bekommen Attribute von Polygonen, in denen sie liegen
-    joined = gpd.sjoin(
-        points_gdf,
-        polygons_gdf[attributes_to_transfer + ["geometry"]],
-        how="left",
-        predicate="within"
-    )
+    crs = result_crs(polygons_gdf)
+    points = points_gdf if crs is None or points_gdf.crs == crs else points_gdf.to_crs(crs)
+    point_geoms = np.asarray(points.geometry.values)
+    tree = shapely.STRtree(point_geoms)
+
+    # Punkte bekommen die Attribute des (ersten) Polygons, in dem sie liegen
+    values = {attr: np.full(len(points_gdf), None, dtype=object) for attr in attributes_to_transfer}
+    assigned = np.zeros(len(points_gdf), dtype=bool)
+    for chunk in polygon_chunks(polygons_gdf, point_geoms, attributes_to_transfer, tile_size):
+        poly_idx, point_idx = tree.query(np.asarray(chunk.geometry.values), predicate="contains")
+        new = ~assigned[point_idx]
+        poly_idx, point_idx = poly_idx[new], point_idx[new]
+        point_idx, first = np.unique(point_idx, return_index=True)
+        poly_idx = poly_idx[first]
+        for attr in attributes_to_transfer:
+            if attr in chunk.columns:
+                values[attr][point_idx] = chunk[attr].to_numpy(dtype=object)[poly_idx]
+        assigned[point_idx] = True
 
     # Bestehende Attribute aktualisieren
     for attr in attributes_to_transfer:
-        joined_col = f"{attr}_right"
-        points_gdf[attr] = joined[joined_col].values
+        points_gdf[attr] = values[attr]
 
     shapefile_name = "wz_ueberhaelter_p_aktualisiert.shp"
     shapefile_path = os.path.join(output_path, shapefile_name)
@@ -144,7 +256,14 @@ def update_ueberhaelter_p(ueberhaelter_p, polygons_gdf, output_path):
     return points_gdf
 
 
-def update_ueberhaelter_f(ueberhaelter_f, polygons_gdf, output_path):
+def update_ueberhaelter_f(ueberhaelter_f, polygons_gdf, output_path, tile_size=10000):
+    """
+    Übernimmt die Attribute des Ergebnispolygons mit der größten Überlappung in die Überhälter-Flächen.
+
+    Die Paare werden über einen STRtree gebildet und nur ihre Schnittflächen berechnet (kein overlay). Das
+    Ergebnis wird bei Übergabe eines Pfads kachelweise gelesen (polygon_chunks). Flächen ohne Überlappung
+    erhalten wie bisher leere Attribute.
+    """
     print("Ueberhaelter_f wird angepasst")
     ueberhaelter_gdf = gpd.read_file(ueberhaelter_f)
     attributes_to_transfer = ["BAGR", "BA", "HOLZART"]
@@ -153,38 +272,39 @@ def update_ueberhaelter_f(ueberhaelter_f, polygons_gdf, output_path):
     if id_col not in ueberhaelter_gdf.columns:
         ueberhaelter_gdf = ueberhaelter_gdf.reset_index().rename(columns={"index": id_col})
 
-    # Schritt 2: Geometrischer Schnitt
-    intersection = gpd.overlay(ueberhaelter_gdf[[id_col, "geometry"]], polygons_gdf[attributes_to_transfer + ["geometry"]],
-                               how="intersection")
-
-    # Schritt 3: Fläche berechnen
-    intersection["area"] = intersection.geometry.area
-
-    # Schritt 4: Für jedes Zielpolygon den größten Überlappungseintrag finden
-    idx_largest = intersection.groupby(id_col)["area"].idxmax()
-    majority_matches = intersection.loc[idx_largest]
-
-    # Schritt 5: Auswahl der Spalten
-    mapping_df = majority_matches[[id_col] + attributes_to_transfer]
-
-    # Schritt 6: Join mit originalem target_gdf
-    updated_gdf = ueberhaelter_gdf.merge(mapping_df, on=id_col, how="left")
-
-    # Schritt 7: Spalten anpassen
+    crs = result_crs(polygons_gdf)
+    targets = ueberhaelter_gdf if crs is None or ueberhaelter_gdf.crs == crs else ueberhaelter_gdf.to_crs(crs)
+    target_geoms = np.asarray(targets.geometry.values)
+    shapely.prepare(target_geoms)
+    tree = shapely.STRtree(target_geoms)
+
+    # Schritt 2: Je Überhälter-Fläche das Polygon mit der größten Schnittfläche merken
+    best_area = np.zeros(len(ueberhaelter_gdf))
+    values = {attr: np.full(len(ueberhaelter_gdf), None, dtype=object) for attr in attributes_to_transfer}
+    for chunk in polygon_chunks(polygons_gdf, target_geoms, attributes_to_transfer, tile_size):
+        polys = np.asarray(chunk.geometry.values)
+        poly_idx, target_idx = tree.query(polys, predicate="intersects")
+        area = shapely.area(shapely.intersection(target_geoms[target_idx], polys[poly_idx]))
+
+        # Größte Überlappung je Fläche im Chunk, nur übernehmen, wenn sie größer als die bisherige ist
+        order = np.argsort(-area, kind="stable")
+        _, first = np.unique(target_idx[order], return_index=True)
+        best = order[first]
+        best = best[area[best] > best_area[target_idx[best]]]
+        target = target_idx[best]
+
+        best_area[target] = area[best]
+        for attr in attributes_to_transfer:
+            if attr in chunk.columns:
+                values[attr][target] = chunk[attr].to_numpy(dtype=object)[poly_idx[best]]
+
+    # Schritt 3: Attribute ersetzen, neue Spalten kommen ans Ende
+    updated_gdf = ueberhaelter_gdf
     for attr in attributes_to_transfer:
-        col_x = f"{attr}_x"
-        col_y = f"{attr}_y"
-        if col_y in updated_gdf.columns:
-            updated_gdf[attr] = updated_gdf[col_y]
-            updated_gdf.drop([col_x, col_y], axis=1, inplace=True)
-
-    # Nach dem Merge → Spalten sortieren wie im Original + neue ganz hinten
-    original_order = list(ueberhaelter_gdf.columns)
-    new_columns = [col for col in updated_gdf.columns if col not in original_order]
-    updated_gdf = updated_gdf[original_order + new_columns]
+        updated_gdf[attr] = values[attr]
 
     shapefile_name = "wz_ueberhaelter_f_aktualisiert.shp"
     shapefile_path = os.path.join(output_path, shapefile_name)
     updated_gdf.to_file(shapefile_path)
 
-    return updated_gdf
\ No newline at end of file
+    return updated_gdf
@@ -1,29 +1,99 @@
 import rasterio
 import numpy as np
 import os
+from concurrent.futures import ThreadPoolExecutor
+from rasterio.enums import Resampling
+from classification_to_vector import top_k_classes
+from functions import iter_windows, bounded_map, ThreadDatasets
 
-def compress_to_max_band_raster(input_path, output_path):
+# Übersichtsstufen der Ausgaberaster
+OVERVIEW_LEVELS = [2, 4, 8, 16, 32]
+
+def scale_probs(probs, valid):
+    """Wahrscheinlichkeiten 0–1 als uint8 0–100, ungültige Pixel → 255."""
+    scaled = np.round(np.nan_to_num(probs) * 100)
+    scaled[..., ~valid] = 255
+    return scaled.astype(np.uint8)
+
+def compress_to_max_band_raster(input_path, output_path, argmax=False, top_n=0, block_size=1024, workers=4):
+    """
+    Schreibt das Maximum über alle Klassenbänder als 8-Bit-Raster (0–100, NoData 255).
+
+    Das Klassifikationsraster wird fensterweise auf einem Thread-Pool gelesen (jeder Thread mit eigenem Dataset),
+    höchstens 2 * workers Fenster sind gleichzeitig im Speicher. Die Ausgaben sind gekachelte, komprimierte GeoTIFFs
+    mit Übersichten. Im selben Durchlauf können zusätzlich geschrieben werden:
+        argmax: Klasse mit der höchsten Wahrscheinlichkeit (*_class.tif, 1-basiert, NoData 0)
+        top_n: Top-n Klassen und Wahrscheinlichkeiten (*_top{n}.tif, Bänder class1..n, prob1..n, NoData 255)
+
+    Returns:
+        list: Pfade der geschriebenen Raster
+    """
     with rasterio.open(input_path) as src:
-        data = src.read()
-        max_vals = np.nanmax(data, axis=0)
+        meta = src.meta.copy()
+        width, height, num_classes = src.width, src.height, src.count
+
+    meta.update({
+        "driver": "GTiff",
+        "count": 1,
+        "dtype": "uint8",
+        "nodata": 255,  # gültiger NoData-Wert für uint8
+        "tiled": True,
+        "blockxsize": 512,
+        "blockysize": 512,
+        "compress": "deflate",
+        "BIGTIFF": "IF_SAFER"
+    })
+    top_n = min(top_n, num_classes)
+
+    # Dateinamen für die Ergebnisse erzeugen
+    base_name = os.path.splitext(os.path.basename(input_path))[0]
+    outputs = {"max": (os.path.join(output_path, base_name + "_maxband.tif"), dict(meta))}
+    if argmax:
+        outputs["class"] = (os.path.join(output_path, base_name + "_class.tif"), dict(meta, nodata=0))
+    if top_n:
+        outputs["top"] = (os.path.join(output_path, base_name + f"_top{top_n}.tif"), dict(meta, count=2 * top_n))
+
+    datasets = ThreadDatasets(input_path)
+
+    def process_window(window):
+        block = datasets.get().read(window=window)  # shape: (classes, rows, cols)
+        valid = ~np.isnan(block).all(axis=0)
 
         # Skalieren und NaNs → 255
-        scaled = np.round(max_vals * 100)
-        scaled[np.isnan(max_vals)] = 255
-        scaled = scaled.astype(np.uint8)
+        max_vals = np.where(valid, np.max(np.where(np.isnan(block), -np.inf, block), axis=0), 0)
+        result = {"max": scale_probs(max_vals, valid)[np.newaxis]}
+        if argmax or top_n:
+            classes, probs = top_k_classes(block, max(top_n, 1), axis=0)
+            if argmax:
+                result["class"] = np.where(valid, classes[0], 0).astype(np.uint8)[np.newaxis]
+            if top_n:
+                classes = np.where(valid, classes, 255).astype(np.uint8)
+                result["top"] = np.concatenate([classes, scale_probs(probs, valid)])
+        return window, result
 
-        meta = src.meta.copy()
-        meta.update({
-            "count": 1,
-            "dtype": "uint8",
-            "nodata": 255  # gültiger NoData-Wert für uint8
-        })
+    dsts = {}
+    try:
+        for key, (path, profile) in outputs.items():
+            dsts[key] = rasterio.open(path, "w", **profile)
+        if top_n:
+            for i in range(top_n):
+                dsts["top"].set_band_description(i + 1, f"class{i + 1}")
+                dsts["top"].set_band_description(top_n + i + 1, f"prob{i + 1}")
 
-        # Dateiname für das Ergebnis erzeugen
-        filename = os.path.splitext(os.path.basename(input_path))[0] + "_maxband.tif"
-        output_path = os.path.join(output_path, filename)
+        with datasets, ThreadPoolExecutor(workers) as executor:
+            windows = iter_windows(width, height, block_size)
+            for window, result in bounded_map(executor, process_window, windows, 2 * workers):
+                for key, data in result.items():
+                    dsts[key].write(data, window=window)
+    finally:
+        for dst in dsts.values():
+            dst.close()
 
-        with rasterio.open(output_path, 'w', **meta) as dst:
-            dst.write(scaled, 1)
+    # Übersichten aus den fertigen 8-Bit-Rastern berechnen
+    for path, _ in outputs.values():
+        with rasterio.open(path, "r+") as dst:
+            dst.build_overviews(OVERVIEW_LEVELS, Resampling.nearest)
+            dst.update_tags(ns="rio_overview", resampling="nearest")
+        print(f"Neues 8-Bit-Raster gespeichert: {path}")
 
-    print(f"Neues 8-Bit-Raster gespeichert: {output_path}")
+    return [path for path, _ in outputs.values()]
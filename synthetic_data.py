@@ -0,0 +1,155 @@
+import os
+import geopandas as gpd
+import numpy as np
+import rasterio
+import shapely
+from rasterio.features import rasterize
+from rasterio.transform import from_origin
+from rasterio.windows import bounds as window_bounds, transform as window_transform
+from functions import iter_windows
+
+# Synthetische Daten liegen in ETRS89 / UTM 32N
+CRS = "EPSG:25832"
+ORIGIN = (600000.0, 5600000.0)
+# Mittlere Bestandsfläche in m²
+MEAN_STAND_AREA = 20000
+# Weitere Baumartengruppen der WZ, die nicht im Klassifikationsraster vorkommen
+OTHER_BAGR = ["uLW", "uNW"]
+
+def synthetic_stands(n_polygons, class_mapping, seed=0):
+    """
+    Erzeugt WZ-ähnliche Bestandspolygone (Voronoi-Zellen zufälliger Punkte) mit den Attributen, die die Pipeline
+    benötigt. Je Bestand wird eine "wahre" Klasse gezogen, BAGR stimmt in etwa 60 % der Fälle mit ihr überein.
+
+    Returns:
+        tuple: (GeoDataFrame der Bestände, Array der wahren Klassen 1..n)
+    """
+    rng = np.random.default_rng(seed)
+    side = np.sqrt(n_polygons * MEAN_STAND_AREA)
+    x0, y0 = ORIGIN
+    extent = shapely.box(x0, y0, x0 + side, y0 + side)
+
+    points = shapely.multipoints(np.column_stack([rng.uniform(x0, x0 + side, n_polygons),
+                                                  rng.uniform(y0, y0 + side, n_polygons)]))
+    cells = shapely.get_parts(shapely.voronoi_polygons(points, extend_to=extent))
+    cells = shapely.intersection(cells, extent)
+    cells = cells[shapely.area(cells) > 0]
+    n = len(cells)
+
+    codes = np.array([class_mapping[c] for c in sorted(class_mapping)], dtype=object)
+    true_class = rng.integers(1, len(codes) + 1, n)
+    bagr = codes[true_class - 1].copy()
+    disagree = rng.random(n) >= 0.6
+    bagr[disagree] = rng.choice(np.concatenate([codes, OTHER_BAGR]), disagree.sum())
+    bagr1 = np.where(rng.random(n) < 0.5, rng.choice(codes, n), None)
+    bagr2 = np.where(rng.random(n) < 0.3, rng.choice(codes, n), None)
+
+    gdf = gpd.GeoDataFrame({
+        "BAGR": bagr,
+        "BAGR1": bagr1,
+        "BAGR2": bagr2,
+        "FLAECHE": shapely.area(cells),
+        "HERKUNFT": "Forsteinrichtung",
+        "HERKUNFT4": "WZ",
+        "HOLZART": None,
+        "BA": "oA",
+        "ALTER_HOEH": rng.integers(5, 150, n),
+        "ALTER_WDB": rng.integers(5, 150, n),
+        "SICHER": rng.integers(1, 4, n),
+        "ERRORCODE": np.zeros(n, dtype=int),
+        "BEARBEITER": "synthetisch",
+        "WZ_OA": rng.integers(1, 10, n)
+    }, geometry=cells, crs=CRS)
+    return gdf, true_class
+
+def write_synthetic_raster(path, geoms, bounds, pixel_size, count, dtype, nodata, fill_block, block_size=1024):
+    """
+    Schreibt ein Raster blockweise: je Block werden die Bestände als Label (Index + 1, 0 = außerhalb) gebrannt und
+    fill_block(labels, rng) liefert die Werte (count, rows, cols). Der Zufall ist je Block reproduzierbar.
+    """
+    minx, miny, maxx, maxy = bounds
+    width = int(np.ceil((maxx - minx) / pixel_size))
+    height = int(np.ceil((maxy - miny) / pixel_size))
+    transform = from_origin(minx, maxy, pixel_size, pixel_size)
+    tree = shapely.STRtree(geoms)
+
+    profile = {
+        "driver": "GTiff", "width": width, "height": height, "count": count, "dtype": dtype, "nodata": nodata,
+        "crs": CRS, "transform": transform, "tiled": True, "blockxsize": 256, "blockysize": 256, "compress": "deflate"
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        for window in iter_windows(width, height, block_size):
+            win_transform = window_transform(window, transform)
+            idx = tree.query(shapely.box(*window_bounds(window, transform)))
+            labels = np.zeros((window.height, window.width), dtype="int32")
+            if len(idx):
+                labels = rasterize(zip(geoms[idx], idx + 1), out_shape=labels.shape, transform=win_transform,
+                                   fill=0, dtype="int32")
+            rng = np.random.default_rng([int(window.row_off), int(window.col_off)])
+            dst.write(fill_block(labels, rng).astype(dtype), window=window)
+    return path
+
+def make_synthetic_data(output_dir, n_polygons=2000, class_mapping=None, seed=0, with_ndom=False):
+    """
+    Erzeugt einen vollständigen synthetischen Eingangsdatensatz: WZ-Polygone, ein Klassifikationsraster
+    (10 m, ein Wahrscheinlichkeitsband je Klasse, NaN außerhalb der Bestände) sowie wuchskl und ndomDiff (5 m)
+    und optional ndom (2 m), sodass das Resampling wie bei den echten Daten greift.
+
+    Returns:
+        dict: {"wz": Pfad, "classification": Pfad, "tif_dict": {Name: Pfad}}
+    """
+    if class_mapping is None:
+        from main import CLASS_MAPPING
+        class_mapping = CLASS_MAPPING
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    stands, true_class = synthetic_stands(n_polygons, class_mapping, seed)
+    geoms = np.asarray(stands.geometry.values)
+    bounds = tuple(stands.total_bounds)
+    n_classes = len(class_mapping)
+    print(f"{len(stands):,} synthetische Bestände, {bounds[2] - bounds[0]:.0f} m Kantenlänge")
+
+    # Je Bestand: Deutlichkeit der wahren Klasse und Rasterattribute
+    strength = rng.uniform(0.5, 4.0, len(stands))
+    wuchskl = rng.choice([1, 2, 3, 4], len(stands), p=[0.3, 0.3, 0.1, 0.3])
+    ndom_diff = rng.integers(1, 9, len(stands))
+    height = rng.uniform(5, 35, len(stands))
+
+    def classification_block(labels, block_rng):
+        logits = block_rng.normal(0, 1, (n_classes,) + labels.shape)
+        inside = labels > 0
+        rows, cols = np.nonzero(inside)
+        stand = labels[rows, cols] - 1
+        logits[true_class[stand] - 1, rows, cols] += strength[stand]
+        probs = np.exp(logits)
+        probs /= probs.sum(axis=0)
+        probs[:, ~inside] = np.nan
+        return probs
+
+    def stand_values(values, nodata):
+        lookup = np.concatenate([[nodata], values])
+        return lambda labels, block_rng: lookup[labels][np.newaxis]
+
+    wz_path = os.path.join(output_dir, "wz_synthetic.shp")
+    stands.to_file(wz_path)
+
+    tif_dict = {
+        "wuchskl": write_synthetic_raster(os.path.join(output_dir, "wuchskl_synthetic.tif"), geoms, bounds, 5, 1,
+                                          "uint8", 0, stand_values(wuchskl, 0)),
+        "ndomDiff": write_synthetic_raster(os.path.join(output_dir, "ndomDiff_synthetic.tif"), geoms, bounds, 5, 1,
+                                           "uint8", 0, stand_values(ndom_diff, 0)),
+        "ndom": None
+    }
+    if with_ndom:
+        def ndom_block(labels, block_rng):
+            values = np.concatenate([[np.nan], height])[labels]
+            return (values + block_rng.normal(0, 2, labels.shape))[np.newaxis]
+
+        tif_dict["ndom"] = write_synthetic_raster(os.path.join(output_dir, "ndom_synthetic.tif"), geoms, bounds, 2, 1,
+                                                  "float32", None, ndom_block)
+
+    classification = write_synthetic_raster(os.path.join(output_dir, "classification_synthetic.tif"), geoms, bounds,
+                                            10, n_classes, "float32", None, classification_block)
+
+    return {"wz": wz_path, "classification": classification, "tif_dict": tif_dict}
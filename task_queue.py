@@ -0,0 +1,347 @@
+import json
+import multiprocessing
+import os
+import pickle
+import shutil
+import socket
+import threading
+import time
+import traceback
+import uuid
+from pipeline import process_patch, estimate_patch_memory, run_stage
+from zonal_rasterstats import close_pool
+
+# Warteschlange für die verteilte Verarbeitung über ein gemeinsames Verzeichnis (ohne Broker).
+#
+# Jede Aufgabe ist eine JSON-Datei, die je Zustand in einem eigenen Ordner liegt:
+#     pending/  veröffentlicht, noch nicht beansprucht
+#     claimed/  von einem Worker bearbeitet, je Beanspruchung eigener Dateiname (Änderungszeit = letztes Lebenszeichen)
+#     done/     abgeschlossen, mit Pfad des Ergebnisses
+#     failed/   nach MAX_ATTEMPTS Versuchen fehlgeschlagen, mit Fehlermeldung
+# Zustandswechsel erfolgen ausschließlich über os.rename, das auf demselben Dateisystem atomar ist: von mehreren
+# Workern, die dieselbe Aufgabe beanspruchen wollen, gewinnt genau einer. Eine Aufgabe wird vor dem Ändern unter
+# einen eigenen Namen (*.moving) umbenannt, sodass nur ihr aktueller Besitzer sie schreibt. In claimed/ trägt der
+# Dateiname die Kennung der Beanspruchung: ein Worker, dessen Lease abgelaufen ist, findet seine Datei nicht mehr und
+# kann die Beanspruchung eines anderen Workers weder verlängern noch abschließen. Patch-Ergebnisse entstehen in einem
+# eigenen Ordner je Beanspruchung und werden erst nach dieser Prüfung an ihren Platz verschoben. Die Konfiguration des
+# Laufs liegt als config.pkl, die Datei published markiert die vollständig veröffentlichte Warteschlange.
+
+# Zustände einer Aufgabe, je Zustand ein Ordner in der Warteschlange
+STATES = ("pending", "claimed", "done", "failed")
+# Wartezeit zwischen zwei Abfragen der Warteschlange in Sekunden
+POLL_INTERVAL = 5
+# Zeit ohne Lebenszeichen, nach der eine beanspruchte Aufgabe wieder freigegeben wird (Sekunden)
+LEASE_SECONDS = 900
+# Anzahl Versuche je Aufgabe, bevor sie als fehlgeschlagen gilt
+MAX_ATTEMPTS = 3
+
+def state_folder(queue_dir, state):
+    return os.path.join(queue_dir, state)
+
+def write_json_atomic(data, path):
+    """Schreibt JSON über eine temporäre Datei und os.replace, sodass nie eine halbe Datei sichtbar ist."""
+    tmp_path = f"{path}.{socket.gethostname()}_{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+def read_task(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def task_names(queue_dir, state, suffix=".json"):
+    """Aufgaben eines Zustands, in Veröffentlichungsreihenfolge (mit suffix=".moving" die gerade verschobenen)."""
+    folder = state_folder(queue_dir, state)
+    if not os.path.exists(folder):
+        return []
+    return sorted(f for f in os.listdir(folder) if f.endswith(suffix))
+
+def claim_file(name, claim):
+    """Dateiname einer Aufgabe in claimed/ für die Beanspruchung claim."""
+    return f"{os.path.splitext(name)[0]}.{claim}.json"
+
+def queue_status(queue_dir):
+    """Anzahl Aufgaben je Zustand. Aufgaben, die gerade verschoben werden (*.moving), zählen als beansprucht."""
+    status = {state: len(task_names(queue_dir, state)) for state in STATES}
+    status["claimed"] += sum(len(task_names(queue_dir, state, ".moving")) for state in STATES)
+    return status
+
+def publish_tasks(queue_dir, patch_paths, config):
+    """
+    Legt eine neue Warteschlange mit einer Aufgabe je Patch an. Große Patches (geschätzter Speicherbedarf) werden
+    zuerst beansprucht, damit sie nicht am Ende allein laufen. Alle Pfade in patch_paths und config müssen für
+    alle Worker erreichbar sein.
+    """
+    shutil.rmtree(queue_dir, ignore_errors=True)
+    for state in STATES:
+        os.makedirs(state_folder(queue_dir, state))
+
+    with open(os.path.join(queue_dir, "config.pkl"), "wb") as f:
+        pickle.dump(config, f)
+
+    ordered = sorted(patch_paths, key=lambda path: estimate_patch_memory(path, config["classification"]), reverse=True)
+    for i, chunk_path in enumerate(ordered):
+        name = f"{i:05d}_{os.path.splitext(os.path.basename(chunk_path))[0]}.json"
+        write_json_atomic({"name": name, "patch": chunk_path, "attempts": 0},
+                          os.path.join(state_folder(queue_dir, "pending"), name))
+
+    write_json_atomic({"tasks": len(ordered), "published": time.time()}, os.path.join(queue_dir, "published"))
+    print(f"{len(ordered)} Aufgaben in {queue_dir} veröffentlicht")
+
+def load_config(queue_dir):
+    with open(os.path.join(queue_dir, "config.pkl"), "rb") as f:
+        return pickle.load(f)
+
+def claim_task(queue_dir, worker_id):
+    """
+    Beansprucht die nächste freie Aufgabe über ein atomares rename von pending/ nach claimed/. Die Aufgabe erhält
+    eine neue Kennung (claim), die auch im Dateinamen in claimed/ steht.
+
+    Returns:
+        tuple: (Name, Aufgabe) oder None, wenn keine Aufgabe frei ist
+    """
+    for name in task_names(queue_dir, "pending"):
+        private = take_task(queue_dir, name, "pending")
+        if private is None:
+            continue  # ein anderer Worker war schneller
+        task = read_task(private)
+        task.update(worker=worker_id, claim=uuid.uuid4().hex, claimed=time.time(), attempts=task["attempts"] + 1)
+        # Frisch geschrieben, die Änderungszeit ist damit das erste Lebenszeichen
+        put_task(queue_dir, claim_file(name, task["claim"]), task, private, "claimed")
+        return name, task
+    return None
+
+def take_task(queue_dir, name, source):
+    """
+    Übernimmt eine Aufgabe über ein atomares rename auf einen eigenen Namen. Die Datei wird vorher berührt, damit
+    die *.moving-Datei erst nach lease_seconds als verwaist gilt (requeue_expired).
+
+    Returns:
+        str: Pfad der übernommenen Datei oder None, wenn die Aufgabe nicht (mehr) in source liegt
+    """
+    path = os.path.join(state_folder(queue_dir, source), name)
+    private = f"{path}.{socket.gethostname()}_{os.getpid()}_{threading.get_ident()}.moving"
+    try:
+        os.utime(path)
+        os.rename(path, private)
+    except FileNotFoundError:
+        return None
+    return private
+
+def put_task(queue_dir, name, task, private, target):
+    """Schreibt eine übernommene Aufgabe und legt sie im Zustand target unter name ab."""
+    write_json_atomic(task, private)
+    os.rename(private, os.path.join(state_folder(queue_dir, target), name))
+
+def take_claim(queue_dir, name, task):
+    """
+    Übernimmt die eigene Beanspruchung einer Aufgabe. None, wenn sie verloren ist (Lease abgelaufen, Aufgabe neu
+    vergeben oder schon abgeschlossen); die Datei eines anderen Workers wird dann nicht angefasst.
+    """
+    return take_task(queue_dir, claim_file(name, task["claim"]), "claimed")
+
+def complete_task(queue_dir, name, task, result_path, staged_path=None):
+    """
+    Schließt eine eigene Aufgabe ab. Ein im Ordner der Beanspruchung geschriebenes Ergebnis (staged_path) wird erst
+    nach der Prüfung der Beanspruchung mit os.replace nach result_path verschoben.
+
+    Returns:
+        bool: False, wenn die Beanspruchung verloren war und das Ergebnis verworfen wurde
+    """
+    private = take_claim(queue_dir, name, task)
+    if private is None:
+        print(f"Aufgabe {name} wurde zwischenzeitlich neu vergeben, Ergebnis wird verworfen")
+        return False
+    if staged_path is not None:
+        os.replace(staged_path, result_path)
+    task.update(result=result_path, finished=time.time())
+    put_task(queue_dir, name, task, private, "done")
+    return True
+
+def fail_task(queue_dir, name, task, error, max_attempts=MAX_ATTEMPTS):
+    """Gibt eine fehlgeschlagene Aufgabe erneut frei oder verschiebt sie nach max_attempts Versuchen nach failed/."""
+    private = take_claim(queue_dir, name, task)
+    if private is None:
+        return False
+    task.update(error=error)
+    put_task(queue_dir, name, task, private, "failed" if task["attempts"] >= max_attempts else "pending")
+    return True
+
+def release_task(queue_dir, name, source, error, max_attempts):
+    """
+    Übernimmt eine verwaiste Aufgabe und gibt sie wieder frei bzw. verschiebt sie nach max_attempts Versuchen nach
+    failed/. error kann {worker} für den letzten Worker enthalten. Eine Aufgabe, deren Ergebnis schon an seinem
+    Platz liegt (finished), kommt nach done/.
+    """
+    private = take_task(queue_dir, name, source)
+    if private is None:
+        return False
+    task = read_task(private)
+    if "finished" in task:
+        target = "done"
+    else:
+        task.update(error=error.format(worker=task.get("worker")))
+        target = "failed" if task["attempts"] >= max_attempts else "pending"
+    put_task(queue_dir, task["name"], task, private, target)
+    return True
+
+def requeue_expired(queue_dir, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+    """
+    Gibt beanspruchte Aufgaben ohne Lebenszeichen seit lease_seconds wieder frei (Worker abgestürzt, z. B. durch
+    Speichermangel). Nach max_attempts Versuchen kommt die Aufgabe nach failed/, damit ein Patch, der seinen
+    Worker jedes Mal beendet, nicht endlos neu vergeben wird. Ebenso werden *.moving-Dateien freigegeben, deren
+    Worker zwischen take_task und put_task abgebrochen ist.
+
+    Returns:
+        int: Anzahl freigegebener bzw. fehlgeschlagener Aufgaben
+    """
+    def stale(state, name):
+        try:
+            return now - os.path.getmtime(os.path.join(state_folder(queue_dir, state), name)) > lease_seconds
+        except FileNotFoundError:
+            return False
+
+    expired = 0
+    now = time.time()
+    for name in task_names(queue_dir, "claimed"):
+        if stale("claimed", name):
+            error = f"Kein Lebenszeichen von Worker {{worker}} seit {lease_seconds} s"
+            expired += release_task(queue_dir, name, "claimed", error, max_attempts)
+    for state in STATES:
+        for name in task_names(queue_dir, state, ".moving"):
+            if stale(state, name):
+                error = f"Zustandswechsel seit {lease_seconds} s nicht abgeschlossen"
+                expired += release_task(queue_dir, name, state, error, max_attempts)
+    if expired:
+        print(f"{expired} Aufgaben ohne Lebenszeichen wieder freigegeben bzw. als fehlgeschlagen markiert")
+    return expired
+
+class Heartbeat:
+    """
+    Aktualisiert die Änderungszeit einer beanspruchten Aufgabe in einem Hintergrund-Thread, solange der Block läuft.
+    Ist die Datei verschwunden (Beanspruchung verloren), endet der Thread.
+    """
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _beat(self):
+        while not self._stop.wait(self.interval):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                break
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+def run_worker(queue_dir, worker_id=None, lease_seconds=LEASE_SECONDS, poll_interval=POLL_INTERVAL, stage=run_stage,
+               process=process_patch):
+    """
+    Worker: wartet auf die Veröffentlichung, beansprucht Aufgaben und verarbeitet je Aufgabe einen Patch mit
+    process(Patch-Pfad, config, stage), standardmäßig process_patch. process schreibt in einen eigenen Ordner der
+    Beanspruchung (config["output_folder"]/<claim>.tmp), das Ergebnis wird von complete_task in den Ergebnisordner
+    verschoben. Der Worker endet, wenn keine Aufgabe mehr frei oder in Bearbeitung ist.
+
+    Returns:
+        int: Anzahl verarbeiteter Aufgaben
+    """
+    worker_id = worker_id or f"{socket.gethostname()}_{os.getpid()}"
+    while not os.path.exists(os.path.join(queue_dir, "published")):
+        time.sleep(poll_interval)
+    config = load_config(queue_dir)
+
+    processed = 0
+    try:
+        while True:
+            requeue_expired(queue_dir, lease_seconds)
+            claimed = claim_task(queue_dir, worker_id)
+            if claimed is None:
+                status = queue_status(queue_dir)
+                if status["pending"] == 0 and status["claimed"] == 0:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            name, task = claimed
+            print(f"Worker {worker_id}: {name}")
+            staging = os.path.join(config["output_folder"], f"{task['claim']}.tmp")
+            os.makedirs(staging)
+            try:
+                with Heartbeat(os.path.join(state_folder(queue_dir, "claimed"), claim_file(name, task["claim"])),
+                               lease_seconds / 3):
+                    staged_path = process(task["patch"], dict(config, output_folder=staging), stage)
+            except Exception:
+                fail_task(queue_dir, name, task, traceback.format_exc())
+            else:
+                result_path = os.path.join(config["output_folder"], os.path.basename(staged_path))
+                processed += complete_task(queue_dir, name, task, result_path, staged_path)
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+    finally:
+        close_pool()
+
+    print(f"Worker {worker_id} beendet ({processed} Aufgaben)")
+    return processed
+
+def run_local_workers(queue_dir, n_workers, lease_seconds=LEASE_SECONDS, poll_interval=POLL_INTERVAL, stage=run_stage,
+                      process=process_patch):
+    """Startet n_workers Worker-Prozesse auf diesem Rechner (z. B. als Ersatz für einen Cluster in Tests)."""
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(queue_dir, None, lease_seconds, poll_interval, stage, process))
+        for _ in range(n_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    return workers
+
+def wait_for_tasks(queue_dir, lease_seconds=LEASE_SECONDS, poll_interval=POLL_INTERVAL, on_done=None, workers=()):
+    """
+    Koordinator: wartet, bis alle Aufgaben abgeschlossen oder fehlgeschlagen sind, und gibt Aufgaben abgestürzter
+    Worker wieder frei.
+
+    Parameters:
+        on_done (callable): Optional, wird je abgeschlossener Aufgabe mit (Patch-Pfad, Ergebnis-Pfad) aufgerufen.
+        workers (list): Lokale Worker-Prozesse aus run_local_workers, die am Ende eingesammelt werden.
+
+    Returns:
+        list: Pfade der Patch-Ergebnisse
+    """
+    reported = set()
+    results = []
+    while True:
+        requeue_expired(queue_dir, lease_seconds)
+        # Zustand vor dem Einsammeln prüfen, damit keine gerade abgeschlossene Aufgabe übersehen wird
+        status = queue_status(queue_dir)
+        for name in task_names(queue_dir, "done"):
+            if name in reported:
+                continue
+            task = read_task(os.path.join(state_folder(queue_dir, "done"), name))
+            results.append(task["result"])
+            reported.add(name)
+            if on_done is not None:
+                on_done(task["patch"], task["result"])
+
+        if status["pending"] == 0 and status["claimed"] == 0:
+            break
+        time.sleep(poll_interval)
+
+    for worker in workers:
+        worker.join()
+
+    failed = task_names(queue_dir, "failed")
+    if failed:
+        errors = [read_task(os.path.join(state_folder(queue_dir, "failed"), name))["error"] for name in failed]
+        raise RuntimeError(f"{len(failed)} Aufgaben fehlgeschlagen:\n" + "\n".join(errors))
+
+    print(f"Alle {len(results)} Aufgaben abgeschlossen")
+    return results
@@ -0,0 +1,64 @@
+# Ursprüngliche groupby/apply-Plausibilität (Baseline, unverändert) als Referenz für tests/test_plausibility.py
+
+import pandas as pd
+
+def get_mode(series):
+    try:
+        return series.mode().iloc[0]
+    except IndexError:
+        return None
+
+def compute_majority_spec(post_union, id_col, union_area_col, wzba_area_col, prob1_col, spec_col):
+    """
+    Liest das Shapefile ein, konvertiert relevante Spalten zu numerisch und berechnet die Mehrheit spec1 pro Fläche.
+    """
+    print("Prüfung der Plausibilität wird durchgeführt")
+    gdf = post_union
+
+    # Spalten sicher in numerisch umwandeln
+    gdf[union_area_col] = pd.to_numeric(gdf[union_area_col], errors="coerce")
+    gdf[wzba_area_col] = pd.to_numeric(gdf[wzba_area_col], errors="coerce")
+    gdf[prob1_col] = pd.to_numeric(gdf[prob1_col], errors="coerce")
+
+    gdf['majority_spec1'] = gdf.groupby(id_col)[spec_col].transform(get_mode)
+
+    return gdf
+
+def compute_mode_filtered_stats(gdf, id_col, union_area_col, prob1_col, spec_col):
+    mode_filtered = gdf[gdf[spec_col] == gdf['majority_spec1']]
+
+    sum_area = mode_filtered.groupby(id_col)[union_area_col].sum().reset_index(name='mode_sum_union_area')
+    mean_prob1 = mode_filtered.groupby(id_col)[prob1_col].mean().reset_index(name='mean_prob1_for_majority_spec1')
+
+    gdf = gdf.merge(sum_area, on=id_col, how='left')
+    gdf = gdf.merge(mean_prob1, on=id_col, how='left')
+
+    return gdf
+
+def filter_gdf_by_area(gdf, wzba_area_col):
+    union_area_sum_col = "mode_sum_union_area"
+    return gdf[gdf[union_area_sum_col] >= gdf[wzba_area_col] / 2].copy()
+
+def aggregate_final_values(gdf_filtered, id_col, wzba_area_col):
+    return gdf_filtered.groupby(id_col).agg({
+        'mean_prob1_for_majority_spec1': 'first',
+        'majority_spec1': 'first',
+        'BAGR': 'first',
+        'BAGR1': 'first',
+        'BAGR2': 'first',
+        'mode_sum_union_area': 'first',
+        wzba_area_col: 'first',
+    }).reset_index()
+
+def determine_plaus_spec(row):
+    if row['mode_sum_union_area'] >= row['FLAECHE'] / 2:
+        if row['mean_prob1_for_majority_spec1'] > 0.9:
+            return row['majority_spec1']
+        elif row['mean_prob1_for_majority_spec1'] > 0.7 and row['majority_spec1'] in (row['BAGR'], row['BAGR1'], row['BAGR2']):
+            return row['majority_spec1']
+    return None
+
+def apply_plausibility(final_aggregated):
+    final_aggregated['plaus_spec'] = final_aggregated.apply(determine_plaus_spec, axis=1)
+
+    return final_aggregated
@@ -0,0 +1,32 @@
+import geopandas as gpd
+import numpy as np
+import rasterio
+import shapely
+from rasterio.transform import from_origin
+from shapely.geometry import Polygon, box
+from classification_to_vector import distance_keep_mask
+from functions import PatchContext
+
+def test_distance_mask_matches_point_distances(tmp_path):
+    # Spitze Ecken und schräge Kanten, viele Pixelzentren nahe der gerundeten Pufferränder
+    polygons = gpd.GeoDataFrame(geometry=[
+        Polygon([(20, 20), (45, 24), (27, 51)]),
+        shapely.affinity.rotate(box(60, 55, 75, 70), 30),
+        box(30.25, 70.25, 31.25, 71.25)
+    ], crs="EPSG:25832")
+    transform = from_origin(0, 100, 0.5, 0.5)
+    path = str(tmp_path / "classification.tif")
+    with rasterio.open(path, "w", driver="GTiff", width=200, height=200, count=1, dtype="uint8", crs="EPSG:25832",
+                       transform=transform) as dst:
+        dst.write(np.zeros((1, 200, 200), dtype=np.uint8))
+    max_dist = 10
+
+    mask = distance_keep_mask(PatchContext(polygons), path, max_dist)
+
+    # Abstand jedes Pixelzentrums wie in filter_points_by_distance
+    rows, cols = np.indices(mask.shape)
+    x, y = transform * (cols.ravel() + 0.5, rows.ravel() + 0.5)
+    distance = shapely.distance(shapely.points(x, y), shapely.union_all(polygons.geometry.values))
+    expected = (distance <= max_dist).reshape(mask.shape)
+    assert expected.any() and not expected.all()
+    np.testing.assert_array_equal(mask, expected)
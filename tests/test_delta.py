@@ -0,0 +1,37 @@
+import fiona
+import geopandas as gpd
+import pandas as pd
+from shapely.geometry import box
+from delta import keep_unchanged_results
+from functions import merge_shapefiles
+
+def write_patch(path, objectids, probs):
+    gdf = gpd.GeoDataFrame({
+        "OBJECTID": objectids,
+        "PROB": pd.Series(probs, dtype="Int64"),
+        "geometry": [box(i, 0, i + 1, 1) for i in objectids]
+    }, crs="EPSG:25832")
+    gdf.to_file(path, driver="GPKG")
+
+def test_prob_stays_integer_after_delta_merge(tmp_path):
+    # Vorheriger vollständiger Lauf: PROB mit Nullwerten (Blößen)
+    patches = tmp_path / "patches"
+    results = tmp_path / "results"
+    patches.mkdir()
+    results.mkdir()
+    write_patch(patches / "final_result_1.gpkg", [0, 1, 2], [85, None, 70])
+    write_patch(patches / "final_result_2.gpkg", [3, 4], [None, 90])
+    previous_merged = merge_shapefiles(str(patches), str(results))
+
+    # Delta-Lauf: Polygon 1 wird neu berechnet, der Rest übernommen
+    delta_patches = tmp_path / "delta_patches"
+    delta_patches.mkdir()
+    gpd.GeoDataFrame(geometry=[box(1, 0, 2, 1)], crs="EPSG:25832").to_file(tmp_path / "wz_delta.gpkg", driver="GPKG")
+    write_patch(delta_patches / "final_result_1.gpkg", [1], [60])
+    keep_unchanged_results(previous_merged, str(tmp_path / "wz_delta.gpkg"), str(delta_patches))
+    merged = merge_shapefiles(str(delta_patches), str(results))
+
+    with fiona.open(merged) as src:
+        assert src.schema["properties"]["PROB"].split(":")[0].startswith("int")
+    result = gpd.read_file(merged).set_index("OBJECTID").sort_index()
+    assert result["PROB"].astype("Int64").tolist() == [85, 60, 70, pd.NA, 90]
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import pytest
+import legacy_plausibility as legacy
+from plausibility import aggregate_majority_spec, apply_plausibility
+
+def test_tie_goes_to_alphabetically_smallest_species():
+    # Kategorienreihenfolge wie im Klassifikationsraster: FI vor BU
+    species = pd.CategoricalDtype(["FI", "KI", "LA", "BU", "EI"])
+    post_union = pd.DataFrame({
+        "OBJECTID": [1, 1, 1, 1, 2, 2, 2],
+        "spec1": pd.Series(["FI", "BU", "FI", "BU", "KI", "FI", "KI"], dtype=species),
+        "prob1": [0.9, 0.8, 0.7, 0.6, 0.5, 0.9, 0.7],
+        "area_m2": [10.0, 20.0, 30.0, 40.0, 5.0, 5.0, 5.0],
+        "FLAECHE": [100.0] * 4 + [15.0] * 3,
+        "BAGR": pd.Series(["FI"] * 4 + ["KI"] * 3, dtype=species),
+        "BAGR1": pd.Series([None] * 7, dtype=species),
+        "BAGR2": pd.Series([None] * 7, dtype=species)
+    })
+
+    aggregated = aggregate_majority_spec(post_union, "OBJECTID", "area_m2", "FLAECHE", "prob1", "spec1")
+
+    # Gleiches Ergebnis wie Series.mode() auf Text
+    legacy = post_union.groupby("OBJECTID")["spec1"].apply(lambda s: s.astype(str).mode().iloc[0])
+    assert list(aggregated["majority_spec1"]) == list(legacy) == ["BU", "KI"]
+    np.testing.assert_allclose(aggregated["mode_sum_union_area"], [60.0, 10.0])
+    np.testing.assert_allclose(aggregated["mean_prob1_for_majority_spec1"], [0.7, 0.6])
+
+def random_fragments(seed, n_ids=300):
+    """
+    Zufällige Verschneidungsfragmente: 1-5 Fragmente je Fläche, teils ohne spec1 oder prob1. Die
+    Wahrscheinlichkeiten sind Vielfache von 1/32, sodass Mittelwerte unabhängig von der Summationsreihenfolge exakt
+    sind. Eigene Flächen mit einem oder zwei gleichen Fragmenten treffen die Schwellen 0.5/0.7/0.9 und die halbe
+    WZ-Fläche genau.
+    """
+    rng = np.random.default_rng(seed)
+    species = np.array(["BU", "EI", "FI", "KI", None], dtype=object)
+    rows = []
+    for oid in range(1, n_ids + 1):
+        bagr = rng.choice(species, 3)
+        n = rng.integers(1, 6)
+        specs = rng.choice(species, n, p=[0.3, 0.15, 0.3, 0.15, 0.1])
+        probs = np.where(rng.random(n) < 0.1, np.nan, rng.integers(8, 33, n) / 32)
+        areas = rng.choice([10.0, 20.0, 30.0], n)
+        flaeche = areas.sum() * rng.choice([1.0, 1.5, 2.0, 3.0])
+        rows += [(oid, s, p, a, flaeche, *bagr) for s, p, a in zip(specs, probs, areas)]
+
+    # Schwellenwerte exakt
+    oid = n_ids
+    for prob in (0.5, 0.7, 0.9):
+        for n in (1, 2):
+            for bagr in ("FI", "KI"):
+                oid += 1
+                rows += [(oid, "FI", prob, 20.0, 40.0 * n, bagr, None, None)] * n
+
+    return pd.DataFrame(rows, columns=["OBJECTID", "spec1", "prob1", "area_m2", "FLAECHE", "BAGR", "BAGR1", "BAGR2"])
+
+@pytest.mark.parametrize("seed", range(5))
+def test_matches_legacy_groupby_chain(seed):
+    post_union = random_fragments(seed)
+
+    # Ursprüngliche Kette aus main.py
+    gdf = legacy.compute_majority_spec(post_union.copy(), "OBJECTID", "area_m2", "FLAECHE", "prob1", "spec1")
+    gdf = legacy.compute_mode_filtered_stats(gdf, "OBJECTID", "area_m2", "prob1", "spec1")
+    gdf_filtered = legacy.filter_gdf_by_area(gdf, "FLAECHE")
+    expected = legacy.apply_plausibility(legacy.aggregate_final_values(gdf_filtered, "OBJECTID", "FLAECHE"))
+
+    aggregated = aggregate_majority_spec(post_union.copy(), "OBJECTID", "area_m2", "FLAECHE", "prob1", "spec1")
+    result = apply_plausibility(aggregated, "FLAECHE")
+
+    assert list(result["OBJECTID"]) == list(expected["OBJECTID"])
+    for col in ("majority_spec1", "plaus_spec", "BAGR", "BAGR1", "BAGR2"):
+        assert list(result[col]) == list(expected[col]), col
+    for col in ("mode_sum_union_area", "mean_prob1_for_majority_spec1", "FLAECHE"):
+        np.testing.assert_array_equal(result[col].to_numpy(dtype=float), expected[col].to_numpy(dtype=float))
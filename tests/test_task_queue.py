@@ -0,0 +1,149 @@
+import os
+import time
+import pytest
+import task_queue
+from task_queue import (MAX_ATTEMPTS, publish_tasks, claim_task, claim_file, complete_task, fail_task, take_task,
+                        requeue_expired, queue_status, read_task, state_folder, task_names, Heartbeat,
+                        run_local_workers, wait_for_tasks)
+
+def fake_process(chunk_path, config, stage):
+    """Ersatz für process_patch: Patches mit "bad" im Namen schlagen fehl."""
+    time.sleep(0.05)
+    if "bad" in chunk_path:
+        raise ValueError(f"Patch {chunk_path} fehlerhaft")
+    result_path = os.path.join(config["output_folder"], chunk_path + ".gpkg")
+    with open(result_path, "w") as f:
+        f.write(chunk_path)
+    return result_path
+
+@pytest.fixture
+def queue_dir(tmp_path, monkeypatch):
+    # Ohne echte Patches: Speicherschätzung für die Reihenfolge der Aufgaben überspringen
+    monkeypatch.setattr(task_queue, "estimate_patch_memory", lambda path, classification: 0)
+    return str(tmp_path / "queue")
+
+def claimed_path(queue_dir, name, task):
+    return os.path.join(state_folder(queue_dir, "claimed"), claim_file(name, task["claim"]))
+
+def expire(path):
+    """Lässt die Lease einer beanspruchten Aufgabe ablaufen."""
+    old = time.time() - 3600
+    os.utime(path, (old, old))
+
+def test_claim_and_complete(queue_dir):
+    publish_tasks(queue_dir, ["patch_1", "patch_2"], {"classification": None})
+
+    first = claim_task(queue_dir, "w1")
+    second = claim_task(queue_dir, "w2")
+    assert claim_task(queue_dir, "w3") is None
+    assert {first[1]["patch"], second[1]["patch"]} == {"patch_1", "patch_2"}
+    assert first[1]["attempts"] == 1 and first[1]["worker"] == "w1"
+    assert queue_status(queue_dir) == {"pending": 0, "claimed": 2, "done": 0, "failed": 0}
+
+    name, task = first
+    assert complete_task(queue_dir, name, task, "result.gpkg")
+    assert read_task(os.path.join(state_folder(queue_dir, "done"), name))["result"] == "result.gpkg"
+    assert queue_status(queue_dir) == {"pending": 0, "claimed": 1, "done": 1, "failed": 0}
+
+def test_failure_is_retried_then_failed(queue_dir):
+    publish_tasks(queue_dir, ["patch_1"], {"classification": None})
+
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        name, task = claim_task(queue_dir, "w1")
+        assert task["attempts"] == attempt
+        fail_task(queue_dir, name, task, "Fehler")
+
+    assert queue_status(queue_dir) == {"pending": 0, "claimed": 0, "done": 0, "failed": 1}
+    assert read_task(os.path.join(state_folder(queue_dir, "failed"), name))["error"] == "Fehler"
+
+def test_expired_lease_is_requeued_then_failed(queue_dir):
+    publish_tasks(queue_dir, ["patch_1"], {"classification": None})
+
+    # Frische Lease bleibt bestehen
+    name, task = claim_task(queue_dir, "w1")
+    assert requeue_expired(queue_dir, lease_seconds=60) == 0
+
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        if attempt > 1:
+            name, task = claim_task(queue_dir, "w1")
+        expire(claimed_path(queue_dir, name, task))
+        assert requeue_expired(queue_dir, lease_seconds=60) == 1
+        expected = "failed" if attempt == MAX_ATTEMPTS else "pending"
+        assert queue_status(queue_dir)[expected] == 1
+        assert queue_status(queue_dir)["claimed"] == 0
+
+    assert "w1" in read_task(os.path.join(state_folder(queue_dir, "failed"), name))["error"]
+
+def test_stale_worker_does_not_touch_requeued_task(queue_dir):
+    publish_tasks(queue_dir, ["patch_1"], {"classification": None})
+    name, task = claim_task(queue_dir, "w1")
+    expire(claimed_path(queue_dir, name, task))
+    requeue_expired(queue_dir, lease_seconds=60)
+
+    # Der langsame Worker meldet sich nach Ablauf der Lease zurück
+    assert not complete_task(queue_dir, name, task, "result.gpkg")
+    assert queue_status(queue_dir) == {"pending": 1, "claimed": 0, "done": 0, "failed": 0}
+    assert "result" not in read_task(os.path.join(state_folder(queue_dir, "pending"), name))
+
+def test_stale_worker_does_not_touch_reclaimed_task(queue_dir, tmp_path):
+    publish_tasks(queue_dir, ["patch_1"], {"classification": None})
+    name, stale_task = claim_task(queue_dir, "w1")
+    stale_path = claimed_path(queue_dir, name, stale_task)
+    expire(stale_path)
+    requeue_expired(queue_dir, lease_seconds=60)
+    _, task = claim_task(queue_dir, "w2")
+    path = claimed_path(queue_dir, name, task)
+    assert path != stale_path
+
+    # Das Lebenszeichen des alten Workers endet, ohne die Lease des neuen zu verlängern
+    expire(path)
+    with Heartbeat(stale_path, 0.01) as heartbeat:
+        heartbeat._thread.join(timeout=1)
+        assert not heartbeat._thread.is_alive()
+    assert time.time() - os.path.getmtime(path) > 60
+
+    # Weder Abschluss noch Fehler des alten Workers ändern die neue Beanspruchung, sein Ergebnis wird nicht übernommen
+    staged_path = tmp_path / "staged.gpkg"
+    staged_path.write_text("alt")
+    result_path = tmp_path / "result.gpkg"
+    assert not complete_task(queue_dir, name, stale_task, str(result_path), str(staged_path))
+    assert not fail_task(queue_dir, name, stale_task, "Fehler")
+    assert not result_path.exists()
+    assert queue_status(queue_dir) == {"pending": 0, "claimed": 1, "done": 0, "failed": 0}
+    assert read_task(path)["worker"] == "w2"
+
+    # Der neue Besitzer schließt ab
+    assert complete_task(queue_dir, name, task, str(result_path), str(staged_path))
+    assert result_path.read_text() == "alt"
+    assert queue_status(queue_dir) == {"pending": 0, "claimed": 0, "done": 1, "failed": 0}
+
+def test_abandoned_move_is_released(queue_dir):
+    publish_tasks(queue_dir, ["patch_1", "patch_2"], {"classification": None})
+    # Worker bricht zwischen take_task und put_task ab
+    private = take_task(queue_dir, task_names(queue_dir, "pending")[0], "pending")
+    assert queue_status(queue_dir)["claimed"] == 1
+    assert requeue_expired(queue_dir, lease_seconds=60) == 0
+
+    expire(private)
+    assert requeue_expired(queue_dir, lease_seconds=60) == 1
+    assert not os.path.exists(private)
+    assert queue_status(queue_dir) == {"pending": 2, "claimed": 0, "done": 0, "failed": 0}
+
+def test_local_workers_process_all_tasks(queue_dir, tmp_path):
+    patches = [f"patch_{i}" for i in range(8)] + ["patch_bad"]
+    output_folder = tmp_path / "results"
+    output_folder.mkdir()
+    publish_tasks(queue_dir, patches, {"classification": None, "output_folder": str(output_folder)})
+
+    done = []
+    workers = run_local_workers(queue_dir, 3, lease_seconds=30, poll_interval=0.05, process=fake_process)
+    with pytest.raises(RuntimeError, match="1 Aufgaben fehlgeschlagen"):
+        wait_for_tasks(queue_dir, lease_seconds=30, poll_interval=0.05,
+                       on_done=lambda patch, result: done.append((patch, result)), workers=workers)
+
+    assert sorted(done) == sorted((patch, str(output_folder / f"{patch}.gpkg")) for patch in patches[:-1])
+    assert sorted(os.listdir(output_folder)) == sorted(f"{patch}.gpkg" for patch in patches[:-1])
+    assert all(worker.exitcode == 0 for worker in workers)
+    failed = task_names(queue_dir, "failed")
+    assert len(failed) == 1
+    assert read_task(os.path.join(state_folder(queue_dir, "failed"), failed[0]))["attempts"] == MAX_ATTEMPTS
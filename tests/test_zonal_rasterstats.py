@@ -0,0 +1,34 @@
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import box
+from zonal_rasterstats import zonal_stats_partial
+
+def write_raster(path, data, nodata=None):
+    with rasterio.open(path, "w", driver="GTiff", width=data.shape[1], height=data.shape[0], count=1,
+                       dtype=data.dtype, transform=from_origin(0, 10, 1, 1), nodata=nodata) as dst:
+        dst.write(data, 1)
+    return str(path)
+
+def test_pixels_outside_the_raster_are_ignored(tmp_path):
+    # Raster ohne NoData, Polygone ragen größtenteils über den Rand (boundless)
+    data = np.full((10, 10), 3, dtype=np.uint8)
+    data[:, :2] = 2
+    path = write_raster(tmp_path / "wuchskl.tif", data)
+    feats = [box(-20, -20, 1, 30), box(8, 5, 40, 6), box(2, 2, 5, 5)]
+
+    stats = zonal_stats_partial((feats, path, "wuchskl"))
+
+    # Ohne Maske zählten die Füllwerte (0) außerhalb des Rasters als Mehrheit
+    assert [s["majority"] for s in stats] == [2, 3, 3]
+
+def test_nodata_sentinel_avoids_valid_values(tmp_path):
+    # Minimum und Maximum des Datentyps kommen als gültige Werte vor, 0 nur außerhalb des Rasters
+    data = np.full((10, 10), 5, dtype=np.uint8)
+    data[0, 0], data[9, 9] = 0, 255
+    path = write_raster(tmp_path / "ndomDiff.tif", data)
+    feats = [box(-5, -5, 15, 15)]
+
+    stats = zonal_stats_partial((feats, path, "ndomDiff"))
+
+    assert stats[0]["majority"] == 5
@@ -1,10 +1,79 @@
 import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
 import os
 
-def intersect_polygons(wz_wuchskl_ndomDiff, top3_classes_probs_spec, output_path=None):
+def clip_pairs(polys, cells):
+    """
+    Schneidet Polygone mit achsenparallelen Rechtecken (paarweise). Vollständig überdeckte Zellen werden direkt
+    übernommen, nur Randzellen werden paarweise mit shapely.intersection geschnitten (clip_by_rect nimmt in
+    shapely 2.0 nur ein Rechteck je Aufruf).
+
+    Returns:
+        tuple: (Schnittgeometrien, Flächen in m²)
+    """
+    result = cells.copy()
+    partial = ~shapely.covers(polys, cells)
+    result[partial] = shapely.intersection(polys[partial], cells[partial])
+
+    # Wie overlay (keep_geom_type) nur flächige Anteile behalten, Linien und Punkte an Zellrändern verwerfen
+    collections = np.flatnonzero(shapely.get_type_id(result) == 7)
+    for i in collections:
+        parts = shapely.get_parts(result[i])
+        result[i] = shapely.union_all(parts[shapely.get_type_id(parts) == 3])
+
+    return result, shapely.area(result)
+
+def intersect_rectangles(gdf1, gdf2, batch_size=5000):
+    """
+    Intersection der Polygone aus gdf1 mit den achsenparallelen Rechtecken aus gdf2 (Rasterzellen).
+
+    Die Paare werden mit einer STRtree-Abfrage für alle Polygone auf einmal gebildet, geschnitten wird vektorisiert
+    über clip_by_rect. Die Flächen (area_m2) entstehen im selben Schritt, die Attribute werden nur über die
+    Indizes der Paare zusammengesetzt.
+    """
+    polys = np.asarray(gdf1.geometry.values)
+    cells = np.asarray(gdf2.geometry.values)
+    shapely.prepare(polys)
+    tree = shapely.STRtree(cells)
+
+    parts = {"poly": [], "cell": [], "geometry": [], "area": []}
+    for start in range(0, len(polys), batch_size):
+        poly_idx, cell_idx = tree.query(polys[start:start + batch_size], predicate="intersects")
+        poly_idx += start
+        geometry, area = clip_pairs(polys[poly_idx], cells[cell_idx])
+
+        keep = area > 0
+        parts["poly"].append(poly_idx[keep])
+        parts["cell"].append(cell_idx[keep])
+        parts["geometry"].append(geometry[keep])
+        parts["area"].append(area[keep])
+
+    if parts["poly"]:
+        poly_idx, cell_idx, geometry, area = (np.concatenate(parts[key]) for key in ("poly", "cell", "geometry", "area"))
+    else:
+        poly_idx = cell_idx = np.empty(0, dtype=np.int64)
+        geometry, area = np.empty(0, dtype=object), np.empty(0)
+
+    attributes1 = gdf1.drop(columns=gdf1.geometry.name).iloc[poly_idx].reset_index(drop=True)
+    attributes2 = gdf2.drop(columns=gdf2.geometry.name).iloc[cell_idx].reset_index(drop=True)
+    # Doppelte Spaltennamen wie bei overlay mit _1/_2 kennzeichnen
+    common = attributes1.columns.intersection(attributes2.columns)
+    attributes1 = attributes1.rename(columns={col: f"{col}_1" for col in common})
+    attributes2 = attributes2.rename(columns={col: f"{col}_2" for col in common})
+
+    df = pd.concat([attributes1, attributes2], axis=1)
+    df["area_m2"] = area
+    return gpd.GeoDataFrame(df, geometry=geometry, crs=gdf1.crs)
+
+def intersect_polygons(wz_wuchskl_ndomDiff, top3_classes_probs_spec, output_path=None, method="rect"):
     """
     Führt eine geometrische Intersection (Schnitt) zweier Shapefiles durch.
     Nur überlappende Flächen bleiben erhalten.
+
+    method="rect" nutzt aus, dass die Rasterzellen achsenparallele Rechtecke sind (intersect_rectangles) und
+    liefert area_m2 direkt mit, method="overlay" verwendet wie bisher gpd.overlay für beliebige Geometrien.
     """
     gdf1 = wz_wuchskl_ndomDiff
     gdf2 = top3_classes_probs_spec
@@ -13,7 +82,10 @@ def intersect_polygons(wz_wuchskl_ndomDiff, top3_classes_probs_spec, output_path
         gdf2 = gdf2.to_crs(gdf1.crs)
 
     print("Intersection wird durchgeführt")
-    gdf_intersect = gpd.overlay(gdf1, gdf2, how="intersection")
+    if method == "rect":
+        gdf_intersect = intersect_rectangles(gdf1, gdf2)
+    else:
+        gdf_intersect = gpd.overlay(gdf1, gdf2, how="intersection")
 
     if output_path:
         shapefile_name = "union_wz_classification.shp"
@@ -22,6 +94,18 @@ def intersect_polygons(wz_wuchskl_ndomDiff, top3_classes_probs_spec, output_path
 
     return gdf_intersect
 
+def species_differs(a, b):
+    """
+    spec1 != BAGR ohne Beachtung der Groß-/Kleinschreibung, leere Werte gelten wie bisher als verschieden.
+    Haben beide Spalten das gemeinsame Baumarten-Dictionary, wird nur über die Integer-Codes verglichen.
+    """
+    if (isinstance(a.dtype, pd.CategoricalDtype) and isinstance(b.dtype, pd.CategoricalDtype) and
+            a.cat.categories.equals(b.cat.categories)):
+        lower_codes, _ = pd.factorize(a.cat.categories.str.lower())
+        codes_a, codes_b = a.cat.codes.to_numpy(), b.cat.codes.to_numpy()
+        return (codes_a < 0) | (codes_b < 0) | (lower_codes[codes_a] != lower_codes[codes_b])
+    return (a.str.lower() != b.str.lower()).to_numpy()
+
 def filter_polygons(union_wz_classification, output_path=None, area_threshold=50):
     """
     Filtert Polygone nach Mindestfläche, gültigen IDs und optional nach Baumart-Kürzel (spec1).
@@ -34,7 +118,7 @@ def filter_polygons(union_wz_classification, output_path=None, area_threshold=50
 
     mask = (
             (gdf["area_m2"] >= area_threshold) &
-            (gdf["spec1"].str.lower() != gdf["BAGR"].str.lower())
+            species_differs(gdf["spec1"], gdf["BAGR"])
     )
 
     gdf_filtered = gdf[mask].copy()
@@ -6,16 +6,57 @@ Created on Fri Nov 26 09:52:04 2021
 """
 
 import itertools
+import math
 import multiprocessing
-import geopandas as gpd
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
 from rasterstats import zonal_stats
-import fiona
 import numpy as np
 import os
+import pandas as pd
 import rasterio
+import shapely
 from rasterio.enums import Resampling
+from rasterio.features import rasterize
+from rasterio.windows import Window, from_bounds
+from functions import iter_windows, bounded_map, as_patch, ThreadDatasets
+from cache import raster_key, cached_file, store_file, file_folder, geometry_hashes, zonal_key, lookup_zonal, store_zonal
+from manifest import fingerprint
 
-def resample_raster(tif_path, output_folder, resolution, method):
+# Anzahl Chunks je Prozessorkern und geschätzter Fixaufwand je Polygon (in Stützpunkten)
+CHUNKS_PER_CORE = 4
+FEATURE_OVERHEAD = 50
+
+# GDAL-Datentypen für die virtuellen Resampling-Raster (VRT)
+GDAL_DTYPES = {
+    "uint8": "Byte", "int8": "Int8", "uint16": "UInt16", "int16": "Int16", "uint32": "UInt32",
+    "int32": "Int32", "float32": "Float32", "float64": "Float64"
+}
+
+# Prozesspool, der über alle Raster und Patches eines Laufs wiederverwendet wird
+_POOL = None
+# Je Prozess offen gehaltene Raster {(Pfad, Größe, Änderungszeit): Dataset}
+_RASTERS = {}
+
+def resampled_grid(src, resolution):
+    """Berechnet Breite, Höhe und Transformation des Rasters bei der Zielauflösung (gleiche Ausdehnung)."""
+    x_res, y_res = src.res
+    new_width = int(src.width * x_res / resolution)
+    new_height = int(src.height * y_res / resolution)
+    transform = src.transform * src.transform.scale(
+        src.width / new_width,
+        src.height / new_height
+    )
+    return new_width, new_height, transform
+
+def resample_raster(tif_path, output_folder, resolution, method, max_memory_mb=1024, workers=4):
+    """
+    Resampled ein Raster fensterweise auf die Zielauflösung.
+
+    Es wird in Streifen über die volle Breite gearbeitet, deren Höhe so gewählt ist, dass alle gleichzeitig
+    bearbeiteten Streifen zusammen max_memory_mb nicht überschreiten. Die Streifen werden parallel gelesen und
+    resampled (jeder Thread mit eigenem Dataset) und in Reihenfolge geschrieben.
+    """
     with rasterio.open(tif_path) as src:
         x_res, y_res = src.res
 
@@ -33,79 +74,249 @@ def resample_raster(tif_path, output_folder, resolution, method):
 
         print(f"Resampling von {tif_path} auf {resolution}m Auflösung")
 
-        # Neue Breite und Höhe berechnen
-        scale_x = x_res / resolution
-        scale_y = y_res / resolution
-        new_width = int(src.width * scale_x)
-        new_height = int(src.height * scale_y)
-
-        # Transform anpassen
-        transform = src.transform * src.transform.scale(
-            src.width / new_width,
-            src.height / new_height
-        )
+        new_width, new_height, transform = resampled_grid(src, resolution)
 
         profile = src.profile.copy()
         profile.update({
+            "driver": "GTiff",
             "height": new_height,
             "width": new_width,
-            "transform": transform
+            "transform": transform,
+            "tiled": True,
+            "blockxsize": 512,
+            "blockysize": 512,
+            "compress": "deflate",
+            "BIGTIFF": "IF_SAFER"
         })
+        count = src.count
+        src_transform = src.transform
+        row_bytes = new_width * count * np.dtype(src.dtypes[0]).itemsize
 
-        # Resampling Methode definieren
-        resampling_method = getattr(Resampling, method)
-
-        # Neues Raster schreiben
-        with rasterio.open(out_path, "w", **profile) as dst:
-            for i in range(1, src.count + 1):
-                dst.write(
-                    src.read(
-                        i,
-                        out_shape=(new_height, new_width),
-                        resampling=resampling_method
-                    ),
-                    i
-                )
-        print("Resampling abgeschlossen")
-        return out_path
+    # Streifenhöhe aus dem Speicherlimit (Vielfaches der Blockhöhe, falls möglich)
+    pending = workers * 2
+    rows = max(1, int(max_memory_mb * 1024 ** 2 // (pending * row_bytes)))
+    if rows >= 512:
+        rows -= rows % 512
+    windows = [Window(0, row_off, new_width, min(rows, new_height - row_off)) for row_off in range(0, new_height, rows)]
+
+    # Resampling Methode definieren
+    resampling_method = getattr(Resampling, method)
+    datasets = ThreadDatasets(tif_path)
+
+    def resample_window(window):
+        src_window = from_bounds(*rasterio.windows.bounds(window, transform), transform=src_transform)
+        data = datasets.get().read(
+            out_shape=(count, window.height, window.width),
+            window=src_window,
+            resampling=resampling_method
+        )
+        return window, data
+
+    # Neues Raster schreiben
+    with datasets, rasterio.open(out_path, "w", **profile) as dst, ThreadPoolExecutor(workers) as executor:
+        for window, data in bounded_map(executor, resample_window, windows, pending):
+            dst.write(data, window=window)
+
+    print("Resampling abgeschlossen")
+    return out_path
+
+def write_resampled_vrt(tif_path, output_folder, resolution, method):
+    """
+    Virtuelles Resampling: schreibt eine VRT-Datei, die das Raster erst beim Lesen auf die Zielauflösung
+    resampled. Es werden nur die Fenster berechnet, die die Zonalstatistik tatsächlich liest.
+    """
+    with rasterio.open(tif_path) as src:
+        x_res, y_res = src.res
+        if abs(x_res - resolution) < 1e-6 and abs(y_res - resolution) < 1e-6:
+            print(f"TIFF hat bereits 1m Auflösung: {tif_path}")
+            return tif_path
+
+        if output_folder is None:
+            output_folder = os.path.dirname(tif_path)
+        base_name = os.path.splitext(os.path.basename(tif_path))[0]
+        out_path = os.path.join(output_folder, base_name + (f"_{resolution}m.vrt"))
 
-def resample_rasters_from_dict(tif_dict, output_folder, resolution, method):
+        print(f"Virtuelles Resampling von {tif_path} auf {resolution}m Auflösung")
+        new_width, new_height, transform = resampled_grid(src, resolution)
+        source = escape(os.path.abspath(tif_path))
+
+        lines = [f'<VRTDataset rasterXSize="{new_width}" rasterYSize="{new_height}">']
+        if src.crs is not None:
+            lines.append(f"  <SRS>{escape(src.crs.to_wkt())}</SRS>")
+        lines.append(f"  <GeoTransform>{transform.c!r}, {transform.a!r}, {transform.b!r}, "
+                     f"{transform.f!r}, {transform.d!r}, {transform.e!r}</GeoTransform>")
+        for band, (dtype, nodata) in enumerate(zip(src.dtypes, src.nodatavals), start=1):
+            lines.append(f'  <VRTRasterBand dataType="{GDAL_DTYPES[dtype]}" band="{band}">')
+            if nodata is not None:
+                lines.append(f"    <NoDataValue>{nodata!r}</NoDataValue>")
+            lines.append(f'    <ComplexSource resampling="{method}">')
+            lines.append(f'      <SourceFilename relativeToVRT="0">{source}</SourceFilename>')
+            lines.append(f"      <SourceBand>{band}</SourceBand>")
+            lines.append(f'      <SrcRect xOff="0" yOff="0" xSize="{src.width}" ySize="{src.height}"/>')
+            lines.append(f'      <DstRect xOff="0" yOff="0" xSize="{new_width}" ySize="{new_height}"/>')
+            if nodata is not None:
+                lines.append(f"      <NODATA>{nodata!r}</NODATA>")
+            lines.append("    </ComplexSource>")
+            lines.append("  </VRTRasterBand>")
+        lines.append("</VRTDataset>")
+
+    with open(out_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    return out_path
+
+def resample_cached(tif_path, output_folder, resolution, method, max_memory_mb=1024, workers=4, cache_dir=None):
+    """
+    resample_raster mit Cache: Das Ergebnis wird unter (Inhalts-Hash, Auflösung, Methode) im Cache-Ordner abgelegt
+    und bei unverändertem Eingangsraster wiederverwendet.
+    """
+    if cache_dir is None:
+        return resample_raster(tif_path, output_folder, resolution, method, max_memory_mb, workers)
+
+    key = fingerprint("resample", raster_key(tif_path, cache_dir), resolution, method)
+    cached = cached_file(cache_dir, key)
+    if cached is not None:
+        print(f"Resampling aus dem Cache: {tif_path}")
+        return cached
+
+    out_path = resample_raster(tif_path, file_folder(cache_dir, key), resolution, method, max_memory_mb, workers)
+    if out_path != tif_path:
+        store_file(cache_dir, key, out_path)
+    return out_path
+
+def resample_rasters_from_dict(tif_dict, output_folder, resolution, method, mode="stream", max_memory_mb=1024, workers=4,
+                               cache_dir=None):
     """Resample alle TIFFs im Dictionary auf 1m Auflösung, wenn nötig.
 
     Args:
         tif_dict (dict): Dictionary mit {name: tif_path}
         output_folder (str, optional): Zielordner für resamplete TIFFs.
                                        Standard: gleiche Ordner wie Eingabe.
+        mode (str): "stream" = fensterweises Resampling in eine GeoTIFF-Datei,
+                    "virtual" = VRT, die nur die gelesenen Fenster bei Bedarf resampled.
+        max_memory_mb (int): Speicherobergrenze für alle Raster zusammen (nur "stream").
+        workers (int): Anzahl Threads je Raster (nur "stream").
+        cache_dir (str): Optionaler Cache-Ordner (cache.py), resamplete Raster werden dort abgelegt und
+                         wiederverwendet (nur "stream").
 
     Returns:
         dict: Neues Dictionary mit {name: resampled_tif_path}
     """
-    resampled_dict = {}
-    for name, tif_path in tif_dict.items():
-        if tif_path is not None:
-            resampled_path = resample_raster(tif_path, output_folder, resolution, method)
-            resampled_dict[name] = resampled_path
-    return resampled_dict
+    layers = {name: tif_path for name, tif_path in tif_dict.items() if tif_path is not None}
+    if not layers:
+        return {}
+
+    if mode == "virtual":
+        return {name: write_resampled_vrt(tif_path, output_folder, resolution, method) for name, tif_path in layers.items()}
+
+    # Raster parallel bearbeiten, das Speicherlimit wird auf die Raster aufgeteilt
+    memory_per_raster = max_memory_mb / len(layers)
+    with ThreadPoolExecutor(len(layers)) as executor:
+        futures = {
+            name: executor.submit(resample_cached, tif_path, output_folder, resolution, method, memory_per_raster, workers,
+                                  cache_dir)
+            for name, tif_path in layers.items()
+        }
+        return {name: future.result() for name, future in futures.items()}
 
 
-def chunks(data, n):
-    """Yield successive n-sized chunks from a slice-able iterable."""
-    for i in range(0, len(data), n):
-        yield data[i:i + n]
+def get_pool(cores):
+    """Gibt den Prozesspool für die Zonalstatistik zurück und legt ihn beim ersten Aufruf an."""
+    global _POOL
+    if _POOL is None:
+        _POOL = multiprocessing.Pool(cores)
+    return _POOL
+
+def close_pool():
+    """Beendet den Prozesspool und schließt die im Hauptprozess offenen Raster."""
+    global _POOL
+    if _POOL is not None:
+        _POOL.close()
+        _POOL.join()
+        _POOL = None
+    for src in _RASTERS.values():
+        src.close()
+    _RASTERS.clear()
+
+def open_raster(tif_path):
+    """Öffnet ein Raster einmal je Prozess und hält es für folgende Chunks offen."""
+    stat = os.stat(tif_path)
+    key = (tif_path, stat.st_size, stat.st_mtime_ns)
+    if key not in _RASTERS:
+        _RASTERS[key] = rasterio.open(tif_path)
+    return _RASTERS[key]
+
+def balanced_chunks(geoms, n_chunks):
+    """
+    Teilt die (räumlich sortierten) Geometrien in zusammenhängende Chunks mit etwa gleichem Aufwand.
+    Der Aufwand je Polygon wird über die Anzahl Stützpunkte plus einen Fixanteil geschätzt.
+
+    Returns:
+        list: Index-Arrays je Chunk
+    """
+    if len(geoms) == 0:
+        return []
+    n_chunks = max(1, min(n_chunks, len(geoms)))
+    cost = np.cumsum(shapely.get_num_coordinates(geoms) + FEATURE_OVERHEAD)
+    splits = np.searchsorted(cost, cost[-1] * np.arange(1, n_chunks) / n_chunks)
+    return [idx for idx in np.split(np.arange(len(geoms)), splits) if len(idx)]
+
+def read_chunk_window(src, geoms):
+    """
+    Liest das Rasterfenster über der Ausdehnung eines Chunks (plus 1 Pixel Rand) aus einem offenen Raster. Das
+    Ergebnis ist maskiert: NoData-Pixel und Pixel außerhalb des Rasters (boundless) gelten als ungültig.
+    """
+    window = from_bounds(*shapely.total_bounds(geoms), transform=src.transform)
+    col_off = math.floor(window.col_off) - 1
+    row_off = math.floor(window.row_off) - 1
+    window = Window(col_off, row_off,
+                    math.ceil(window.col_off + window.width) + 1 - col_off,
+                    math.ceil(window.row_off + window.height) + 1 - row_off)
+
+    inside = (col_off >= 0 and row_off >= 0 and
+              col_off + window.width <= src.width and row_off + window.height <= src.height)
+    array = src.read(1, window=window, boundless=not inside, masked=True)
+    return array, src.window_transform(window)
+
+def with_nodata(array, nodata):
+    """
+    rasterstats braucht für Arrays einen NoData-Wert. Die maskierten Pixel aus read_chunk_window werden damit
+    gefüllt, sodass auch Pixel außerhalb des Rasters nicht in die Statistik eingehen. Hat das Raster keinen, wird ein
+    unter den gültigen Pixeln nicht vorkommender Wert gewählt (NaN bzw. Minimum/Maximum des Datentyps).
+    """
+    data, mask = np.ma.getdata(array), np.ma.getmaskarray(array)
+    if nodata is None:
+        if np.issubdtype(data.dtype, np.floating):
+            nodata = np.nan
+        else:
+            info = np.iinfo(data.dtype)
+            valid = data[~mask]
+            nodata = next((candidate for candidate in (info.min, info.max) if not (valid == candidate).any()), None)
+            if nodata is None:
+                data, nodata = data.astype(np.float64), np.nan
+    return np.where(mask, np.array(nodata, dtype=data.dtype), data), nodata
 
 def zonal_stats_partial(args):
     feats, tif_path, name = args
 
+    # Raster bleibt im Worker offen, gelesen wird nur das Fenster des Chunks
+    src = open_raster(tif_path)
+    array, affine = read_chunk_window(src, feats)
+    array, nodata = with_nodata(array, src.nodata)
+
     if name == "ndom":
         return zonal_stats(
-            feats, tif_path,
+            feats, array,
+            affine=affine,
+            nodata=nodata,
             stats="max",
             add_stats={'mean_above_80': mean_above_80th_percentile},
             all_touched=True)
     else:
         return zonal_stats(
             feats,
-            tif_path,
+            array,
+            affine=affine,
+            nodata=nodata,
             stats="majority",
             all_touched=True
         )
@@ -126,33 +337,231 @@ def mean_above_80th_percentile(array):
     return np.mean(values_above_80) if len(values_above_80) > 0 else np.nan
 
 def run_zonal_stats_parallel(features, tif_path, cores, name):
-    p = multiprocessing.Pool(cores)
-    args = [(chunk, tif_path, name) for chunk in chunks(features, cores)]
-    stats_lists = p.map(zonal_stats_partial, args)
-    p.close()
-    p.join()
-    return list(itertools.chain(*stats_lists))
-
-def calculate_zonal_stats(shapefile_path, tif_dict, cores, output_path=None):
-    multiprocessing.freeze_support()  # Wichtig für Windows
+    """
+    Berechnet die Zonalstatistik im gemeinsamen Prozesspool (bzw. seriell bei cores <= 1).
+
+    Die Polygone werden entlang der Hilbert-Kurve sortiert, damit jeder Chunk ein kompaktes Rasterfenster liest,
+    und nach Anzahl Stützpunkten in etwa gleich aufwendige Chunks aufgeteilt.
+
+    Parameters:
+        features (gpd.GeoSeries): Geometrien des Patches
+    """
+    order = np.argsort(features.hilbert_distance().to_numpy(), kind="stable")
+    geoms = np.asarray(features.values)[order]
+    args = [(list(geoms[idx]), tif_path, name) for idx in balanced_chunks(geoms, cores * CHUNKS_PER_CORE)]
+
+    if cores > 1:
+        stats_lists = get_pool(cores).map(zonal_stats_partial, args)
+    else:
+        stats_lists = [zonal_stats_partial(a) for a in args]
 
-    with fiona.open(shapefile_path) as src:
-        features = list(src)
+    # Ergebnisse in die ursprüngliche Reihenfolge zurücksortieren
+    stats = [None] * len(order)
+    for position, stat in zip(order, itertools.chain(*stats_lists)):
+        stats[position] = stat
+    return stats
+
+def cached_zonal_values(features, tif_path, name, cache_dir, compute, engine="rasterstats"):
+    """
+    Zonalstatistik je Polygon mit Cache: Werte werden je (Geometrie-Hash, Raster-Schlüssel) gespeichert, berechnet
+    werden nur die fehlenden Polygone über compute(Index-Array), das die Werte in gleicher Reihenfolge liefert.
+    engine ("rasterstats" oder "labels") trennt die Einträge der beiden Verfahren.
+    """
+    stat = "mean_above_80" if name == "ndom" else "majority"
+    key = zonal_key(tif_path, stat, cache_dir, engine)
+    hashes = geometry_hashes(np.asarray(features.values))
+    found = lookup_zonal(cache_dir, key, hashes)
+
+    missing = np.array([i for i, h in enumerate(hashes) if h not in found], dtype=np.int64)
+    print(f"{len(hashes) - len(missing)} von {len(hashes)} Polygonen aus dem Cache ({name})")
+    if len(missing):
+        computed = [None if v is None else float(v) for v in compute(missing)]
+        store_zonal(cache_dir, key, [hashes[i] for i in missing], computed)
+        found.update(zip((hashes[i] for i in missing), computed))
+    return [found[h] for h in hashes]
+
+def majority_float32(values):
+    """Mehrheitsklassen kompakt als float32 (NaN = keine gültigen Pixel)."""
+    return pd.to_numeric(pd.Series(list(values), dtype=object), errors="coerce").to_numpy(dtype=np.float32)
+
+def calculate_zonal_stats(patch, tif_dict, cores, output_path=None, cache_dir=None):
+    multiprocessing.freeze_support()  # Wichtig für Windows
 
-    # Bestehende Datei laden oder Original
-    shape = gpd.read_file(shapefile_path)
+    # Polygone des Patches (PatchContext oder Pfad), die Attribute werden an einer Kopie ergänzt
+    shape = as_patch(patch).gdf.copy()
+    features = shape.geometry
 
     # Für jedes Raster Attribut berechnen und speichern
     for name, tif_path in tif_dict.items():
+        if name == "ndom" and tif_path is None:
+            continue
         print(f"Berechne zonal_stats für: {name}")
-        stats = run_zonal_stats_parallel(features, tif_path, cores, name)
-        if name == "ndom":
-            if tif_path is not None:
-                shape[name] = [a["mean_above_80"] for a in stats]
+        stat = "mean_above_80" if name == "ndom" else "majority"
+
+        def compute(idx, tif_path=tif_path, name=name, stat=stat):
+            return [a[stat] for a in run_zonal_stats_parallel(features.iloc[idx], tif_path, cores, name)]
+
+        if cache_dir is None:
+            shape[name] = compute(np.arange(len(features)))
+        else:
+            shape[name] = cached_zonal_values(features, tif_path, name, cache_dir, compute)
+        if name != "ndom":
+            shape[name] = majority_float32(shape[name])
+
+    shape["OBJECTID"] = np.arange(1, len(shape) + 1, dtype=np.int32)
+
+    # Ausgabe vorbereiten
+    if output_path:
+        shapefile_name = "added_values.shp"
+        shapefile_path = os.path.join(output_path, shapefile_name)
+        shape.to_file(shapefile_path)
+
+    return shape
+
+def label_majority(geoms, raster_paths, block_size=2048, tree=None):
+    """
+    Berechnet die Mehrheit (majority) mehrerer deckungsgleicher Raster für alle Polygone in einem Durchlauf.
+
+    Je Fenster über der Patch-Ausdehnung werden die Polygone einmal in ein Label-Raster (Polygon-Index + 1)
+    gebrannt, anschließend wird für jedes Raster dasselbe Fenster gelesen und die Pixel je (Label, Wert)
+    gezählt. Wie bei rasterstats gewinnt bei Gleichstand der kleinste Wert.
+
+    Hinweis: Ein Pixel kann nur einem Polygon zugeordnet werden. Randpixel, die mit all_touched mehrere
+    Polygone berühren, gehen an das kleinere Polygon (es wird zuletzt gebrannt).
+
+    Parameters:
+        geoms (np.ndarray): shapely-Polygone des Patches
+        raster_paths (list): Pfade der Raster mit identischem Gitter
+        block_size (int): Kantenlänge der Fenster in Pixeln
+        tree (shapely.STRtree): Optional, vorhandener räumlicher Index über geoms (PatchContext.tree)
+
+    Returns:
+        dict: {Pfad: Array der Mehrheitswerte je Polygon (None ohne gültige Pixel)}
+    """
+    srcs = [rasterio.open(path) for path in raster_paths]
+    try:
+        ref = srcs[0]
+        if tree is None:
+            tree = shapely.STRtree(geoms)
+        areas = shapely.area(geoms)
+        counts = {path: [] for path in raster_paths}
+
+        # Nur Fenster über der Ausdehnung der Polygone
+        region = from_bounds(*shapely.total_bounds(geoms), transform=ref.transform)
+        row_off = max(math.floor(region.row_off), 0)
+        col_off = max(math.floor(region.col_off), 0)
+        row_end = min(math.ceil(region.row_off + region.height), ref.height)
+        col_end = min(math.ceil(region.col_off + region.width), ref.width)
+
+        for block in iter_windows(max(col_end - col_off, 0), max(row_end - row_off, 0), block_size):
+            window = Window(block.col_off + col_off, block.row_off + row_off, block.width, block.height)
+            win_transform = ref.window_transform(window)
+            idx = tree.query(shapely.box(*rasterio.windows.bounds(window, ref.transform)))
+            if len(idx) == 0:
+                continue
+
+            # Große Polygone zuerst, kleine überschreiben gemeinsame Randpixel
+            idx = idx[np.argsort(-areas[idx], kind="stable")]
+            labels = rasterize(
+                zip(geoms[idx], idx + 1),
+                out_shape=(window.height, window.width),
+                transform=win_transform,
+                fill=0,
+                all_touched=True,
+                dtype="int32"
+            )
+            covered = labels > 0
+            if not covered.any():
+                continue
+            block_labels = labels[covered] - 1
+
+            for path, src in zip(raster_paths, srcs):
+                values = src.read(1, window=window)[covered]
+                valid = np.ones(len(values), dtype=bool)
+                if np.issubdtype(values.dtype, np.floating):
+                    valid &= ~np.isnan(values)
+                if src.nodata is not None:
+                    valid &= values != src.nodata
+                counts[path].append(
+                    pd.DataFrame({"label": block_labels[valid], "value": values[valid]})
+                    .groupby(["label", "value"]).size()
+                )
+    finally:
+        for src in srcs:
+            src.close()
+
+    result = {}
+    for path, parts in counts.items():
+        majority = np.full(len(geoms), None, dtype=object)
+        if parts:
+            pixel_count = pd.concat(parts).groupby(level=["label", "value"]).sum().reset_index(name="count")
+            pixel_count = pixel_count.sort_values(["label", "count", "value"], ascending=[True, False, True])
+            pixel_count = pixel_count.drop_duplicates("label")
+            majority[pixel_count["label"].to_numpy()] = pixel_count["value"].to_numpy(dtype=float)
+        result[path] = majority
+    return result
+
+def calculate_zonal_stats_labels(patch, tif_dict, cores, output_path=None, cache_dir=None):
+    """
+    Alternative zu calculate_zonal_stats mit Label-Raster: Alle deckungsgleichen Raster werden in einem
+    gemeinsamen fensterweisen Durchlauf ausgewertet, jedes Polygon wird dabei nur einmal je Fenster rasterisiert.
+    ndom (max / mean_above_80) wird weiterhin über rasterstats berechnet. Mit cache_dir werden nur die Polygone
+    ohne Cache-Eintrag gelabelt.
+
+    Returns:
+        gpd.GeoDataFrame: Gleiche Spalten wie calculate_zonal_stats.
+    """
+    multiprocessing.freeze_support()  # Wichtig für Windows
+
+    patch = as_patch(patch)
+    shape = patch.gdf.copy()
+    geoms = patch.geoms
+
+    # Raster mit identischem Gitter gruppieren
+    grids = {}
+    for name, tif_path in tif_dict.items():
+        if name == "ndom" or tif_path is None:
+            continue
+        with rasterio.open(tif_path) as src:
+            grid = (tuple(src.transform), src.width, src.height)
+        grids.setdefault(grid, []).append((name, tif_path))
+
+    for layers in grids.values():
+        print(f"Berechne zonal_stats (Label-Raster) für: {', '.join(name for name, _ in layers)}")
+        raster_paths = [tif_path for _, tif_path in layers]
+        if cache_dir is None:
+            majority = label_majority(geoms, raster_paths, tree=patch.tree)
+            for name, tif_path in layers:
+                shape[name] = majority[tif_path]
+            continue
+
+        # Fehlende Polygone sind meist für alle Raster der Gruppe gleich, dann bleibt es bei einem Durchlauf
+        computed = {}
+        for name, tif_path in layers:
+            def compute(idx, tif_path=tif_path):
+                if idx.tobytes() not in computed:
+                    computed[idx.tobytes()] = label_majority(geoms[idx], raster_paths)
+                return computed[idx.tobytes()][tif_path]
+
+            shape[name] = cached_zonal_values(shape.geometry, tif_path, name, cache_dir, compute, "labels")
+
+    if tif_dict.get("ndom") is not None:
+        print("Berechne zonal_stats für: ndom")
+
+        def compute(idx):
+            return [a["mean_above_80"] for a in run_zonal_stats_parallel(shape.geometry.iloc[idx], tif_dict["ndom"], cores, "ndom")]
+
+        if cache_dir is None:
+            shape["ndom"] = compute(np.arange(len(shape)))
         else:
-            shape[name] = [a["majority"] for a in stats]
+            shape["ndom"] = cached_zonal_values(shape.geometry, tif_dict["ndom"], "ndom", cache_dir, compute)
 
-    shape["OBJECTID"] = range(1, len(shape) + 1)
+    # Spaltenreihenfolge wie in tif_dict
+    shape = shape[[col for col in shape.columns if col not in tif_dict] + [name for name in tif_dict if name in shape.columns]]
+    for name in tif_dict:
+        if name != "ndom" and name in shape.columns:
+            shape[name] = majority_float32(shape[name])
+    shape["OBJECTID"] = np.arange(1, len(shape) + 1, dtype=np.int32)
 
     # Ausgabe vorbereiten
     if output_path:
@@ -160,4 +569,4 @@ def calculate_zonal_stats(shapefile_path, tif_dict, cores, output_path=None):
         shapefile_path = os.path.join(output_path, shapefile_name)
         shape.to_file(shapefile_path)
 
-    return shape
\ No newline at end of file
+    return shape